@@ -0,0 +1,107 @@
+"""
+Benchmark de punta a punta contra el servidor local de fake_ckan: mide la cosecha de package_search y el
+throughput del crawl de distribuciones para distintos motores y niveles de concurrencia. Uso:
+
+    python -m checker_and_broadcaster.benchmarks.bench_crawl --scale 1 --workers 10 50 --engines threads async
+
+Los resultados quedan en un json para comparar entre commits o configuraciones.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+from checker_and_broadcaster import distribution_processor as dp
+from checker_and_broadcaster import parser as pars
+from checker_and_broadcaster.benchmarks.bench_parser import _git_commit
+from checker_and_broadcaster.benchmarks.fake_ckan import start_in_process
+
+
+class _Harvester(pars.Parser):
+    """Sólo los métodos de cosecha del parser, sin base de datos"""
+    def __init__(self):
+        self._init_runtime_state()
+
+
+def bench_harvest(base_url):
+    """Descripcion: Cosecha completa de package_search contra el servidor local
+    Returns: devuelve (segundos, datasets, distribuciones cosechadas en el formato de full_distributions)"""
+    pars.CKAN_PACKAGE_SEARCH = f"{base_url}/api/3/action/package_search"
+    start = time.perf_counter()
+    raw = _Harvester()._get_raw_state()
+    elapsed = time.perf_counter() - start
+    distributions = {r["id"]: {"url": r["url"], "size": None} for p in raw.values() for r in p["resources"]}
+    return elapsed, len(raw), distributions
+
+
+def bench_crawl(distributions, engine, workers, delay, cache_path=None):
+    """Descripcion: Crawl de todas las distribuciones con un motor y una concurrencia dados
+    Returns: devuelve un diccionario con tiempos y cantidad de errores"""
+    processor = dp.DistributionProcessor(max_workers=workers, concurrency=workers, engine=engine, delay=delay,
+                                         max_retries=0, cache_path=cache_path)
+    start = time.perf_counter()
+    results = processor.process_distributions_concurrent(distributions)
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for row in results if row[3])
+    return {"engine": engine, "workers": workers, "seconds": elapsed, "distributions": len(results),
+            "errors": errors, "per_second": len(results) / elapsed if elapsed else None}
+
+
+def run(scale=1.0, engines=("threads",), workers=(10,), hosts=4, latency=0.0, error_rate=0.0, max_rows=10000,
+        delay=0.0, revalidate=True):
+    """Descripcion: Levanta el servidor local, cosecha y corre el crawl para cada combinación de motor y
+    concurrencia. Con revalidate se repite cada crawl con el cache de validadores de la corrida anterior,
+    como en una corrida diaria sin cambios
+    Returns: devuelve el reporte completo"""
+    results = []
+    base_url, shutdown = start_in_process(scale, hosts=hosts, latency=latency, error_rate=error_rate,
+                                          max_rows=max_rows)
+    try:
+        harvest_seconds, datasets, distributions = bench_harvest(base_url)
+        for engine in engines:
+            for n in workers:
+                with tempfile.TemporaryDirectory() as directory:
+                    cache_path = os.path.join(directory, "distribution_cache.json")
+                    results.append(dict(bench_crawl(distributions, engine, n, delay, cache_path), run="cold"))
+                    if revalidate:
+                        results.append(dict(bench_crawl(distributions, engine, n, delay, cache_path), run="warm"))
+    finally:
+        shutdown()
+    return {"commit": _git_commit(), "python": platform.python_version(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "config": {"scale": scale, "hosts": hosts, "latency": latency, "error_rate": error_rate,
+                       "max_rows": max_rows, "delay": delay},
+            "harvest": {"seconds": harvest_seconds, "datasets": datasets, "distributions": len(distributions)},
+            "results": results}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--scale", type=float, default=1.0)
+    arg_parser.add_argument("--engines", nargs="+", choices=dp.DistributionProcessor.ENGINES, default=["threads"])
+    arg_parser.add_argument("--workers", nargs="+", type=int, default=[10])
+    arg_parser.add_argument("--hosts", type=int, default=4)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--max-rows", type=int, default=10000)
+    arg_parser.add_argument("--delay", type=float, default=0.0, help="intervalo mínimo entre pedidos a un host")
+    arg_parser.add_argument("--output", default="bench_crawl.json")
+    args = arg_parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    report = run(args.scale, args.engines, args.workers, args.hosts, args.latency, args.error_rate, args.max_rows,
+                 args.delay)
+    harvest = report["harvest"]
+    print(f"cosecha: {harvest['datasets']} datasets en {harvest['seconds']:.2f} s")
+    for r in report["results"]:
+        print(f"{r['engine']:<8} {r['workers']:>4} workers {r['run']:<5} {r['distributions']:>7} distribuciones "
+              f"{r['seconds']:>8.2f} s {r['per_second']:>9.1f}/s {r['errors']:>5} errores")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Benchmark de las etapas de comparación del parser sobre estados sintéticos con la forma de
+last_ckan_state.json. Uso:
+
+    python -m checker_and_broadcaster.benchmarks.bench_parser --scales 1 10 100 --output bench.json
+    python -m checker_and_broadcaster.benchmarks.bench_parser --compare bench.json
+
+Los resultados quedan en un json para comparar corridas entre commits.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from checker_and_broadcaster import parser as pars
+from checker_and_broadcaster import stages
+
+# tamaño actual del portal: 1210 datasets y 6509 distribuciones
+BASE_DATASETS = 1210
+DISTRIBUTIONS_PER_DATASET = 6509 / 1210
+TEMAS = ["econ", "agri", "educ", "ener", "envi", "gove", "heal", "intr", "just", "regi", "soci", "tech", "tran"]
+NODOS = [f"nodo-{i}" for i in range(60)]
+STAGES = ("merge", "dataset_events", "distribution_events", "datapoint_events")
+
+
+def generate_state(scale=1.0, seed=0):
+    """Descripcion: Genera un estado sintético de scale veces el tamaño actual del portal
+    Returns: devuelve un diccionario con la forma de last_ckan_state.json"""
+    rng = random.Random(seed)
+    data = {}
+    for i in range(int(BASE_DATASETS * scale)):
+        data[f"ds-{i}"] = _dataset(rng, f"ds-{i}", rng.randint(1, int(2 * DISTRIBUTIONS_PER_DATASET)))
+    return _wrap(data)
+
+
+def _dataset(rng, dataset_id, n_distributions):
+    nodo = rng.choice(NODOS)
+    temas = rng.sample(TEMAS, rng.randint(0, 3))
+    return {"org": {"maintainer": f"Mantenedor {nodo}", "nodo_title": nodo.title(), "nodo_alias": nodo},
+            "temas": {"temas_alias": temas, "temas_nombres": [t.upper() for t in temas]},
+            "title": f"Dataset {dataset_id}",
+            "name": dataset_id,
+            "distributions": {f"{dataset_id}-d{j}": {"url": f"http://example.org/{dataset_id}/{j}.csv",
+                                                     "name": f"Recurso {j}",
+                                                     "size": float(rng.randint(1, 100000)) if rng.random() < 0.7
+                                                     else None}
+                              for j in range(n_distributions)}}
+
+
+def _wrap(data):
+    return {"total_datasets": len(data),
+            "total_distributions": sum(len(v["distributions"]) for v in data.values()),
+            "harvested_at": datetime.now(timezone.utc).isoformat(),
+            "data": data}
+
+
+def evolve_state(previous, new_rate=0.01, absent_rate=0.005, grown_rate=0.05, seed=1):
+    """Descripcion: Arma el estado siguiente a partir de uno previo. new_rate y absent_rate son la proporción
+    de datasets y distribuciones nuevas y ausentes; grown_rate la de distribuciones cuyo tamaño crece
+    Returns: devuelve un estado nuevo (el previo no se modifica)"""
+    rng = random.Random(seed)
+    data = {}
+    for dataset_id, dataset in previous["data"].items():
+        if rng.random() < absent_rate:
+            continue
+        distributions = {}
+        for dist_id, dist in dataset["distributions"].items():
+            if rng.random() < absent_rate:
+                continue
+            size = dist["size"]
+            if size is not None and rng.random() < grown_rate:
+                size += rng.randint(1, 1000)
+            distributions[dist_id] = dict(dist, size=size)
+        if rng.random() < new_rate:
+            dist_id = f"{dataset_id}-new"
+            distributions[dist_id] = {"url": f"http://example.org/{dist_id}.csv", "name": "Nuevo", "size": 1.0}
+        data[dataset_id] = dict(dataset, distributions=distributions)
+    for i in range(int(len(previous["data"]) * new_rate)):
+        dataset_id = f"new-{seed}-{i}"
+        data[dataset_id] = _dataset(rng, dataset_id, rng.randint(1, 5))
+    return _wrap(data)
+
+
+class _FakeProcessor:
+    """Devuelve tamaños sintéticos sin red para medir sólo la escritura de resultados en el estado"""
+    def __init__(self, **kwargs):
+        self.estimated = set()
+
+    def process_distributions_concurrent(self, distributions, on_result=None):
+        results = [[dist_id, dist["url"], float(len(dist_id)), None] for dist_id, dist in distributions.items()]
+        for result in results:
+            on_result(result)
+        return results
+
+
+class BenchParser(pars.Parser):
+    """Parser armado a mano sobre dos estados, sin base de datos ni red, como TestParser"""
+    def __init__(self, previous_state, current_state, directory):
+        self._init_runtime_state()
+        self.persistance_directory = directory
+        self.stage_cache = stages.StageCache(os.path.join(directory, "runs"), "bench")
+        self.previous_state = previous_state
+        self.current_state = current_state
+        self.parseable_datasets = list(current_state["data"])
+        self.colnames_ds_events = ["dataset_id", "dataset_title", "temas_alias", "nodo_alias", "maintainer", "url",
+                                   "event_type"]
+        self.colnames_dist_events = ["distribution_id", "distribution_name"] + self.colnames_ds_events
+        self.missing_dataset_ids = []
+        self.missing_dataset_titles = []
+        self.dataset_events = None
+
+
+def _measure(function, repeat):
+    """Descripcion: Ejecuta function repeat veces midiendo tiempo y luego una vez más con tracemalloc
+    Returns: devuelve (tiempos, pico de memoria en bytes, resultado)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timings, peak, result
+
+
+def _count(result):
+    return 0 if result is None else len(result)
+
+
+def bench_scale(scale, repeat=3, new_rate=0.01, absent_rate=0.005, grown_rate=0.05, seed=0):
+    """Descripcion: Mide cada etapa sobre un par de estados sintéticos de la escala pedida
+    Returns: devuelve una lista de resultados, uno por etapa"""
+    previous = generate_state(scale, seed)
+    current = evolve_state(previous, new_rate, absent_rate, grown_rate, seed + 1)
+    counted = evolve_state(previous, new_rate, absent_rate, grown_rate, seed + 1)
+    with tempfile.TemporaryDirectory() as directory:
+        parser = BenchParser(previous, current, directory)
+
+        def fresh(method):
+            # el índice de distribuciones se cachea por estado; se descarta para medir cada corrida completa
+            def call():
+                parser._distribution_indexes.clear()
+                return method()
+            return call
+
+        def merge():
+            parser.current_state = counted
+            parser._count_distributions()
+
+        original_processor = pars.dp.DistributionProcessor
+        pars.dp.DistributionProcessor = _FakeProcessor
+        try:
+            measured = {"merge": _measure(merge, repeat)}
+        finally:
+            pars.dp.DistributionProcessor = original_processor
+        parser.current_state = current
+        measured["dataset_events"] = _measure(fresh(parser._get_dataset_events), repeat)
+        parser.dataset_events = measured["dataset_events"][2]
+        measured["distribution_events"] = _measure(fresh(parser._get_distribution_events), repeat)
+        measured["datapoint_events"] = _measure(fresh(parser._get_datapoint_events), repeat)
+
+    results = []
+    for stage in STAGES:
+        timings, peak, result = measured[stage]
+        results.append({"scale": scale, "stage": stage,
+                        "datasets": current["total_datasets"], "distributions": current["total_distributions"],
+                        "rows": counted["total_distributions"] if stage == "merge" else _count(result),
+                        "seconds_min": min(timings),
+                        "seconds_median": statistics.median(timings), "peak_bytes": peak})
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales=(1, 10, 100), repeat=3, **rates):
+    """Descripcion: Corre el benchmark para todas las escalas
+    Returns: devuelve el reporte completo"""
+    results = []
+    for scale in scales:
+        results.extend(bench_scale(scale, repeat, **rates))
+    return {"commit": _git_commit(), "python": platform.python_version(),
+            "created_at": datetime.now(timezone.utc).isoformat(), "repeat": repeat, "rates": rates,
+            "results": results}
+
+
+def compare(report, baseline):
+    """Descripcion: Compara un reporte contra otro guardado, por escala y etapa
+    Returns: devuelve una lista de líneas legibles con la variación de tiempo y memoria"""
+    previous = {(r["scale"], r["stage"]): r for r in baseline["results"]}
+    lines = []
+    for r in report["results"]:
+        before = previous.get((r["scale"], r["stage"]))
+        if not before:
+            continue
+        time_ratio = r["seconds_min"] / before["seconds_min"] if before["seconds_min"] else float("inf")
+        memory_ratio = r["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] else float("inf")
+        lines.append(f"{r['scale']:>6}x {r['stage']:<20} tiempo x{time_ratio:.2f}  memoria x{memory_ratio:.2f}")
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--scales", nargs="+", type=float, default=[1, 10, 100])
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--new-rate", type=float, default=0.01)
+    arg_parser.add_argument("--absent-rate", type=float, default=0.005)
+    arg_parser.add_argument("--grown-rate", type=float, default=0.05)
+    arg_parser.add_argument("--output", default="bench_parser.json")
+    arg_parser.add_argument("--compare", help="reporte previo contra el que comparar")
+    args = arg_parser.parse_args()
+    logging.disable(logging.INFO)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    report = run(args.scales, args.repeat, new_rate=args.new_rate, absent_rate=args.absent_rate,
+                 grown_rate=args.grown_rate)
+    for r in report["results"]:
+        print(f"{r['scale']:>6}x {r['stage']:<20} {r['distributions']:>9} distribuciones "
+              f"{r['seconds_min'] * 1000:>10.1f} ms {r['peak_bytes'] / 2 ** 20:>8.1f} MiB {r['rows']:>7} filas")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    if baseline:
+        print("\n".join(compare(report, baseline)))
+
+
+if __name__ == "__main__":
+    main()
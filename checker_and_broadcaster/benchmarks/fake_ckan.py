@@ -0,0 +1,279 @@
+"""
+Servidor local que reemplaza a datos.gob.ar para benchmarks de punta a punta. Sirve package_search a partir
+de un estado (last_ckan_state.json o uno sintético) y distribuciones csv/json sintéticas con tamaño, latencia,
+tasa de errores, ETag y Range configurables. Cada host es una dirección 127.0.0.N distinta, así el rate limit
+y el circuit breaker por host del DistributionProcessor se comportan como contra servidores reales. La corrida
+de punta a punta usa su propio directorio y su propia base para no tocar assets ni la base de producción. Uso:
+
+    python -m checker_and_broadcaster.benchmarks.fake_ckan --state assets/last_ckan_state.json --hosts 4
+    CKAN_BASE_URL=http://127.0.0.1:8800 python checker_main.py --no-broadcast \
+        --persistance-dir /tmp/datob-bench --database-url sqlite:////tmp/datob-bench/datob.db
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FQ_MODIFIED = re.compile(r"metadata_modified:\[(\S+) TO \*\]")
+RANGE = re.compile(r"bytes=(\d+)-$")
+
+
+class FakeCkan:
+    """
+    Portal CKAN de mentira. latency se suma a cada respuesta de distribución y host_latency agrega una demora
+    extra por host (índice desde 0). Los tamaños se derivan del id de cada distribución, así dos corridas con
+    la misma semilla ven exactamente los mismos archivos
+    """
+    def __init__(self, state, hosts=4, port=0, latency=0.0, host_latency=None, error_rate=0.0,
+                 min_rows=10, max_rows=10000, etags=True, ranges=True, seed=0):
+        self.state = state
+        self.hosts = hosts
+        self.port = port
+        self.latency = latency
+        self.host_latency = host_latency or {}
+        self.error_rate = error_rate
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.etags = etags
+        self.ranges = ranges
+        self.seed = seed
+        self.modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+        self.extra_rows = {}
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._servers = []
+        self.packages = []
+        self.distributions = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _distribution_url(self, dist_id, url):
+        host = int(hashlib.sha1(dist_id.encode()).hexdigest(), 16) % self.hosts
+        extension = "json" if str(url or "").lower().endswith(".json") else "csv"
+        return f"http://127.0.0.{host + 1}:{self.port}/files/{dist_id}.{extension}"
+
+    def _build_packages(self):
+        """Arma los paquetes de package_search a partir del estado, con las urls apuntando a este servidor"""
+        for dataset_id, dataset in self.state["data"].items():
+            resources = []
+            for dist_id, dist in dataset["distributions"].items():
+                self.distributions[dist_id] = dist
+                resources.append({"id": dist_id, "name": dist.get("name"),
+                                  "url": self._distribution_url(dist_id, dist.get("url"))})
+            temas = dataset.get("temas", {})
+            self.packages.append({
+                "id": dataset_id, "title": dataset.get("title"), "name": dataset.get("name"),
+                "maintainer": dataset.get("org", {}).get("maintainer"),
+                "organization": {"title": dataset.get("org", {}).get("nodo_title"),
+                                 "name": dataset.get("org", {}).get("nodo_alias")},
+                "groups": [{"name": a, "display_name": n}
+                           for a, n in zip(temas.get("temas_alias", []), temas.get("temas_nombres", []))],
+                "resources": resources,
+                "metadata_modified": self.modified})
+
+    def rows(self, dist_id):
+        digest = int(hashlib.sha1(f"{self.seed}:{dist_id}".encode()).hexdigest(), 16)
+        return self.min_rows + digest % (self.max_rows - self.min_rows + 1) + self.extra_rows.get(dist_id, 0)
+
+    def grow(self, fraction=0.05, rows=100):
+        """Agrega filas al final de una fracción de las distribuciones, como una actualización de datos"""
+        with self._lock:
+            for dist_id in self.distributions:
+                if self._random.random() < fraction:
+                    self.extra_rows[dist_id] = self.extra_rows.get(dist_id, 0) + rows
+                    self.modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            return self._random.random() < self.error_rate
+
+    def package_search(self, query):
+        packages = self.packages
+        match = FQ_MODIFIED.search(query.get("fq", [""])[0])
+        if match:
+            since = match.group(1).rstrip("Z")
+            packages = [p for p in packages if p["metadata_modified"] >= since]
+        start = int(query.get("start", ["0"])[0])
+        rows = int(query.get("rows", ["10"])[0])
+        page = packages[start:start + rows]
+        if query.get("fl"):
+            fields = query["fl"][0].split(",")
+            page = [{k: _solr_field(p[k]) for k in fields if k in p and k != "resources"} for p in page]
+        return {"success": True, "result": {"count": len(packages), "results": page}}
+
+    def start(self):
+        for host in range(self.hosts):
+            server = ThreadingHTTPServer((f"127.0.0.{host + 1}", self.port), _Handler)
+            server.daemon_threads = True
+            server.fake = self
+            server.host_index = host
+            # el primer servidor elige un puerto libre y los demás hosts usan el mismo
+            self.port = server.server_address[1]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers.append(server)
+        # las urls de las distribuciones llevan el puerto, así que los paquetes se arman con los servidores arriba
+        self._build_packages()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+
+def _solr_field(value):
+    """Como CKAN con fl=: los campos anidados llegan aplanados desde el índice de Solr (organization y groups
+    como nombres) y resources no se devuelve"""
+    if isinstance(value, dict):
+        return value.get("name")
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return [item.get("name") for item in value]
+    return value
+
+
+@lru_cache(maxsize=256)
+def _body(dist_id, rows, extension):
+    if extension == "json":
+        return json.dumps([{"id": i, "valor": i * 7 % 1000} for i in range(rows)]).encode()
+    lines = [b"id,valor"] + [f"{i},{i * 7 % 1000}".encode() for i in range(rows)]
+    return b"\n".join(lines) + b"\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers y cuerpo salen en dos escrituras: sin TCP_NODELAY cada respuesta espera el ACK demorado
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        if url.path.endswith("/api/3/action/package_search"):
+            return self._send(200, json.dumps(fake.package_search(parse_qs(url.query))).encode(),
+                              {"Content-Type": "application/json"})
+        match = re.match(r"/files/(.+)\.(csv|json)$", url.path)
+        if not match or match.group(1) not in fake.distributions:
+            return self._send(404)
+        dist_id, extension = match.groups()
+
+        time.sleep(fake.latency + fake.host_latency.get(self.server.host_index, 0))
+        if fake.should_fail():
+            return self._send(500, b"error simulado")
+
+        rows = fake.rows(dist_id)
+        headers = {"Content-Type": "application/json" if extension == "json" else "text/csv"}
+        if fake.etags:
+            # el contenido depende sólo del id y la cantidad de filas: el ETag se calcula sin generar el cuerpo
+            etag = f'"{hashlib.sha1(f"{dist_id}:{rows}".encode()).hexdigest()[:16]}"'
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, headers={"ETag": etag})
+        body = _body(dist_id, rows, extension)
+        if not fake.ranges:
+            return self._send(200, body, headers)
+        headers["Accept-Ranges"] = "bytes"
+        requested = RANGE.match(self.headers.get("Range", ""))
+        if requested:
+            start = int(requested.group(1))
+            if start >= len(body):
+                return self._send(416, headers={"Content-Range": f"bytes */{len(body)}"})
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            return self._send(206, body[start:], headers)
+        return self._send(200, body, headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+def _serve(scale, options, ready, stop):
+    from checker_and_broadcaster.benchmarks.bench_parser import generate_state
+    fake = FakeCkan(generate_state(scale), **options).start()
+    ready.put(fake.port)
+    stop.wait()
+    fake.stop()
+
+
+def start_in_process(scale=1.0, **options):
+    """
+    Levanta el servidor con un estado sintético en otro proceso, para que no compita por el GIL con el crawl
+    que se quiere medir. Returns: (base_url, función que lo detiene)
+    """
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Queue(), context.Event()
+    process = context.Process(target=_serve, args=(scale, options, ready, stop), daemon=True)
+    process.start()
+    port = ready.get(timeout=120)
+
+    def shutdown():
+        stop.set()
+        process.join(timeout=10)
+
+    return f"http://127.0.0.1:{port}", shutdown
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--state", help="estado a servir; si no se indica se genera uno sintético")
+    arg_parser.add_argument("--scale", type=float, default=1.0, help="escala del estado sintético")
+    arg_parser.add_argument("--hosts", type=int, default=4)
+    arg_parser.add_argument("--port", type=int, default=8800)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--slow-host", action="append", default=[], metavar="N:SEGUNDOS",
+                            help="latencia extra para el host N (se puede repetir)")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--max-rows", type=int, default=10000)
+    arg_parser.add_argument("--no-etags", action="store_true")
+    arg_parser.add_argument("--no-ranges", action="store_true")
+    args = arg_parser.parse_args()
+
+    if args.state:
+        with open(args.state, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    else:
+        from checker_and_broadcaster.benchmarks.bench_parser import generate_state
+        state = generate_state(args.scale)
+    host_latency = {int(h): float(s) for h, s in (item.split(":") for item in args.slow_host)}
+    fake = FakeCkan(state, hosts=args.hosts, port=args.port, latency=args.latency, host_latency=host_latency,
+                    error_rate=args.error_rate, max_rows=args.max_rows, etags=not args.no_etags,
+                    ranges=not args.no_ranges).start()
+    print(f"CKAN_BASE_URL={fake.base_url} ({len(fake.packages)} datasets, {len(fake.distributions)} distribuciones)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -139,6 +139,8 @@ class Broadcaster():
                     dataset_title = self.escape_markdown(df["dataset_title"].iloc[0])
                     url = df["url"].iloc[0]
                     message = f"{maintainer} agregó nuevos datos al recurso [{name}]({url}) dentro del dataset {dataset_title}"
+                    if "estimated" in df.columns and df["estimated"].iloc[0]:
+                        message += self.escape_markdown(" (según una estimación del tamaño del recurso)")
                     total_subs = self.get_users_by_dataset(dataset_id)
                     await self.send_update(total_subs,message)
 
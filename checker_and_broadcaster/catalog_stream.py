@@ -0,0 +1,136 @@
+import codecs
+import json
+import re
+from typing import Iterable, Iterator
+
+CHUNK_SIZE = 1 << 16
+MAX_PACKAGE_SIZE = 64 << 20
+
+
+class CatalogStreamError(ValueError):
+    """Respuesta de package_search inválida, truncada o con success=false"""
+
+
+class PackageSearchReader:
+    """
+    Decodificador incremental de una respuesta de package_search de CKAN
+    ({"success": ..., "result": {"count": N, "results": [paquete, ...], ...}}). Recorre el stream en una
+    sola pasada y entrega los paquetes de result.results de a uno, así la memoria queda acotada por el
+    paquete más grande y no por la página completa. count queda disponible al terminar de iterar
+    """
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.count = None
+        self.success = None
+        self.error = None
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._final = False
+
+    def _read(self) -> None:
+        """Agrega el próximo buffer; al agotarse el stream marca final"""
+        if self._final:
+            raise CatalogStreamError("Respuesta de package_search truncada")
+        chunk = next(self.chunks, None)
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        if chunk is None:
+            self._final = True
+            self._buffer += self._text.decode(b"", final=True)
+        else:
+            self._buffer += self._text.decode(chunk)
+
+    def _peek(self) -> str:
+        """Devuelve el próximo caracter que no es espacio, leyendo más data si hace falta ("" al final)"""
+        while True:
+            self._pos = self._WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._final:
+                return ""
+            self._read()
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise CatalogStreamError(f"Respuesta de package_search inesperada: se esperaba {char!r}")
+        self._pos += 1
+
+    def _value(self):
+        """Decodifica el valor completo que empieza en la posición actual, leyendo más data si está cortado"""
+        self._peek()
+        while True:
+            remaining = len(self._buffer) - self._pos
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                if self._final or remaining > MAX_PACKAGE_SIZE:
+                    raise CatalogStreamError(f"Respuesta de package_search inválida: {e}")
+                value = end = None
+            # un número al final del buffer puede continuar en el próximo
+            if end is not None and (end < len(self._buffer) or self._final):
+                self._pos = end
+                return value
+            # se lee hasta duplicar lo pendiente para no decodificar un paquete grande una vez por buffer
+            while not self._final and len(self._buffer) - self._pos < 2 * remaining + 1:
+                self._read()
+
+    def _members(self) -> Iterator[str]:
+        """Recorre las claves de un objeto; el valor de cada una debe consumirse antes de pedir la siguiente"""
+        self._expect("{")
+        first = True
+        while True:
+            char = self._peek()
+            if char == "}":
+                self._pos += 1
+                return
+            if not first:
+                self._expect(",")
+            key = self._value()
+            if not isinstance(key, str):
+                raise CatalogStreamError("Respuesta de package_search inesperada: clave inválida")
+            self._expect(":")
+            first = False
+            yield key
+
+    def _items(self) -> Iterator:
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            char = self._peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise CatalogStreamError("Respuesta de package_search inesperada: se esperaba ',' o ']'")
+
+    def __iter__(self) -> Iterator[dict]:
+        seen_results = False
+        for key in self._members():
+            if key != "result":
+                value = self._value()
+                if key == "success":
+                    self.success = value
+                elif key == "error":
+                    self.error = value
+                continue
+            for result_key in self._members():
+                if result_key == "results":
+                    seen_results = True
+                    for package in self._items():
+                        yield package
+                elif result_key == "count":
+                    self.count = self._value()
+                else:
+                    # facets, sort y demás: se decodifican y se descartan
+                    self._value()
+        if self.success is False:
+            raise CatalogStreamError(f"package_search devolvió un error: {self.error}")
+        if self.count is None or not seen_results:
+            raise CatalogStreamError("Respuesta de package_search sin result.count o result.results")
@@ -1,5 +1,9 @@
 import parser as pars
 import broadcast as broad
+import stages
+from handler_subscriber import profiling
+import argparse
+import contextlib
 import os
 import logging
 from sqlalchemy import create_engine
@@ -17,32 +21,82 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-async def message_sending(broadcaster):
+async def message_sending(broadcaster, metrics=None, profiler=None):
     try:
-        await broadcaster.send_new_dataset_message()
-        await broadcaster.send_new_distribution_message()
-        await broadcaster.send_new_datapoint_message()
+        for name in ("send_new_dataset_message", "send_new_distribution_message", "send_new_datapoint_message"):
+            with contextlib.ExitStack() as timers:
+                if metrics:
+                    timers.enter_context(metrics.timer(f"broadcast_{name}"))
+                if profiler:
+                    timers.enter_context(profiler.stage(f"broadcast_{name}"))
+                await getattr(broadcaster, name)()
     except Exception as e:
         raise e
 
 
 
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Parsea el catálogo y notifica las novedades")
+    arg_parser.add_argument("--run-id", help="corrida a usar; por defecto se crea una nueva")
+    arg_parser.add_argument("--from-stage", choices=stages.STAGES, default="harvest",
+                            help="etapa desde la que se ejecuta; las anteriores se leen del cache de la corrida")
+    arg_parser.add_argument("--to-stage", choices=stages.STAGES, default="dump",
+                            help="última etapa a ejecutar")
+    arg_parser.add_argument("--no-broadcast", action="store_true",
+                            help="no envía notificaciones (útil para re-ejecutar corridas)")
+    arg_parser.add_argument("--rebroadcast", action="store_true",
+                            help="vuelve a notificar los eventos de un replay (por defecto un replay no notifica)")
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="retoma la última corrida desde la primera etapa sin salida cacheada")
+    arg_parser.add_argument("--keep-runs", type=int, default=pars.keep_runs,
+                            help="corridas cacheadas que se conservan en assets/runs (0: todas; por defecto "
+                                 "KEEP_RUNS o 10)")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="perfila cpu y memoria de cada etapa en assets/profiles (igual que DATOB_PROFILE=1)")
+    arg_parser.add_argument("--persistance-dir",
+                            help="directorio de estado, faltantes, dumps y corridas cacheadas en lugar de assets "
+                                 "(útil para benchmarks y pruebas que no deben tocar los archivos vigentes)")
+    arg_parser.add_argument("--database-url", default=database_url,
+                            help="base de suscriptores y del backend sql; por defecto DATABASE_URL")
+    args = arg_parser.parse_args()
+    persistance_directory = args.persistance_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 "..", "assets")
+    runs_directory = os.path.join(persistance_directory, "runs")
+    if (args.resume or args.from_stage != "harvest") and not args.run_id:
+        args.run_id = stages.StageCache.latest_run(runs_directory)
+    if args.resume and args.run_id:
+        cache = stages.StageCache(runs_directory, args.run_id)
+        pending = [stage for stage in stages.STAGES if not cache.has(stage)]
+        if pending:
+            args.from_stage = pending[0]
+        else:
+            # la última corrida terminó: no hay nada que retomar y se arranca una nueva
+            args.run_id, args.from_stage = None, "harvest"
+    return args
+
+
 if __name__ == '__main__':
-    db_engine = create_engine(database_url, echo=True)
+    args = parse_args()
+    db_engine = create_engine(args.database_url, echo=True)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+    profiler = profiling.from_env("checker", force=args.profile)
 
+parser = None
 try:
     # -------------------------------
     # PARSEO: Compara estado actual y anterior del portal incluyendo cambios en tamaño en
     #distribuciones de datasets con suscriptores
     # -------------------------------
-    parser = pars.Parser(db_engine, SessionLocal)
-    parser.dump_current_nodes()
-    parser.dump_current_themes()
-    parser.dump_current_datasets()
-    parser.dump_error_report()
-    parser.save_current_state()
+    parser = pars.Parser(db_engine, SessionLocal, run_id=args.run_id, start=args.from_stage, end=args.to_stage,
+                         profiler=profiler, keep_runs=args.keep_runs, persistance_directory=args.persistance_dir)
     events = parser.serialize_events()
+    if parser.replay and not (args.no_broadcast or args.rebroadcast):
+        # los suscriptores ya recibieron estos eventos cuando la corrida se ejecutó por primera vez
+        logging.info(f"La corrida {parser.run_id} es un replay: no se envían notificaciones (usar --rebroadcast)")
+    if args.no_broadcast or (parser.replay and not args.rebroadcast):
+        parser.metrics.finish(success=True)
+        parser.export_metrics()
+        raise SystemExit(0)
 
     # ------------------------------------------------------------------------
     # BROADCAST: Envía mensajes de acuerdo al evento tratando de no replicar.
@@ -54,9 +108,11 @@ try:
     broadcaster.db_engine = db_engine
     broadcaster.db_session = SessionLocal()
     broadcaster.set_events(events)
-    asyncio.run(message_sending(broadcaster))
-    pers_directory = broadcaster.persistance_directory
-    error_path = os.path.join(pers_directory, "error_report.csv")
+    asyncio.run(message_sending(broadcaster, parser.metrics, profiler))
+    parser.metrics.finish(success=True)
+    parser.export_metrics()
+    # en un replay el reporte de errores queda en el directorio de la corrida
+    error_path = os.path.join(parser.output_directory, "error_report.csv")
     message = "Datob parseó y mandó notificaciones correctamente"
     subject = "Reporte Datob (Parser y Broadcaster)"
     body = "\n\nDistribuciones que no se pudieron parsear\n\n"
@@ -75,6 +131,9 @@ try:
 
 except Exception as e:
 
+    if parser is not None:
+        parser.metrics.finish(success=False)
+        parser.export_metrics()
     broadcaster = broad.Broadcaster()
     message = f"Ocurrió el siguiente error: {e}"
     subject = "Error - Reporte Datob (Parser y Broadcaster)"
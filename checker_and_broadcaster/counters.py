@@ -0,0 +1,523 @@
+import codecs
+import json
+import re
+import struct
+import zlib
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+MAX_JSON_VALUE_SIZE = 64 << 20
+LF, CR, QUOTE = 10, 13, 34
+
+
+class CsvRowCounter:
+    """
+    Contador de filas de un csv/txt que procesa buffers de bytes completos en lugar de una línea por vez.
+    Una fila empieza en cada byte que no es fin de línea (\\n o \\r) y sigue a un fin de línea, así las
+    líneas vacías no se cuentan. Los saltos de línea dentro de campos entre comillas no cortan la fila.
+    Si al terminar quedó una comilla sin cerrar (p. ej. un txt que no es csv) se usa el conteo sin comillas
+    """
+    def __init__(self):
+        self.rows = 0
+        self.plain_rows = 0
+        self.in_quotes = False
+        self.at_line_start = True
+        self.plain_at_line_start = True
+
+    @staticmethod
+    def _count_starts(ends: np.ndarray, length: int, at_line_start: bool) -> int:
+        """Cantidad de filas que empiezan en un buffer de largo length con fines de línea en ends"""
+        if ends.size == 0:
+            return 1 if at_line_start else 0
+        starts = int(np.count_nonzero(np.diff(ends) > 1))
+        if ends[0] > 0 and at_line_start:
+            starts += 1
+        if ends[-1] < length - 1:
+            starts += 1
+        return starts
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        length = len(chunk)
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        ends = np.flatnonzero((data == LF) | (data == CR))
+
+        self.plain_rows += self._count_starts(ends, length, self.plain_at_line_start)
+        self.plain_at_line_start = bool(ends.size and ends[-1] == length - 1)
+
+        quotes = np.flatnonzero(data == QUOTE)
+        if quotes.size or self.in_quotes:
+            # un fin de línea está entre comillas si antes hay una cantidad impar de comillas;
+            # las comillas escapadas ("") suman dos y no cambian el estado
+            inside = (np.searchsorted(quotes, ends) + self.in_quotes) & 1
+            ends = ends[inside == 0]
+            self.in_quotes = bool((quotes.size + self.in_quotes) & 1)
+        self.rows += self._count_starts(ends, length, self.at_line_start)
+        self.at_line_start = bool(ends.size and ends[-1] == length - 1)
+
+    def result(self) -> int:
+        return self.plain_rows if self.in_quotes else self.rows
+
+    def get_state(self) -> Dict:
+        """Estado serializable para retomar el conteo sobre bytes agregados al final del archivo"""
+        return {"rows": self.rows, "plain_rows": self.plain_rows, "in_quotes": self.in_quotes,
+                "at_line_start": self.at_line_start, "plain_at_line_start": self.plain_at_line_start}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> "CsvRowCounter":
+        counter = cls()
+        for key, value in state.items():
+            setattr(counter, key, value)
+        return counter
+
+
+def estimate_csv_rows(sample: bytes, total_length: int) -> Optional[int]:
+    """
+    Estima las filas de un csv a partir de una muestra de su comienzo: calcula el ancho promedio de las
+    filas completas de la muestra y lo escala al tamaño total en bytes. None si la muestra no alcanza
+    """
+    last_end = max(sample.rfind(b"\n"), sample.rfind(b"\r"))
+    if last_end < 0:
+        return None
+    complete = sample[:last_end + 1]
+    rows = count_csv_rows([complete])
+    if not rows:
+        return None
+    return round(total_length * rows / len(complete))
+
+
+def count_csv_rows(chunks: Iterable[bytes]) -> int:
+    """Cuenta las filas no vacías de un csv/txt a partir de un iterable de buffers de bytes"""
+    counter = CsvRowCounter()
+    for chunk in chunks:
+        counter.feed(chunk)
+    return counter.result()
+
+
+class JsonRowCounter:
+    """
+    Contador incremental de registros de un json que procesa el stream en una sola pasada:
+    - si el documento es un array, cuenta sus elementos
+    - si es un objeto, cuenta los elementos de la primera clave cuyo valor es un array (o 1 si no hay)
+    - si hay más de un valor de nivel superior o el json es inválido, lo trata como JSON Lines y cuenta
+      las líneas que empiezan con "{"
+    Sólo se decodifica un elemento por vez, así la memoria queda acotada por el elemento más grande
+    """
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+    _LINE_WHITESPACE = re.compile(rb"[ \t\r\f\v]*")
+    _OBJECT_LINE = re.compile(rb"^[ \t\r\f\v]*\{", re.MULTILINE)
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.retry_at = 0
+        self.state = "start"
+        self.top = None
+        self.counting = False
+        self.array_count = 0
+        self.size = None
+        self.scalar_type = None
+        self.line_count = 0
+        self.line_pending = True
+
+    def _feed_lines(self, chunk: bytes) -> None:
+        """Conteo en paralelo de líneas que empiezan con "{" por si el documento resulta ser JSON Lines"""
+        first_break = chunk.find(b"\n")
+        end = len(chunk) if first_break == -1 else first_break
+        if self.line_pending:
+            start = self._LINE_WHITESPACE.match(chunk, 0, end).end()
+            if start < end:
+                self.line_count += chunk[start] == ord("{")
+                self.line_pending = False
+        if first_break == -1:
+            return
+        self.line_count += len(self._OBJECT_LINE.findall(chunk, first_break + 1))
+        last_break = chunk.rfind(b"\n")
+        self.line_pending = self._LINE_WHITESPACE.match(chunk, last_break + 1).end() == len(chunk)
+
+    def _decode_value(self, final: bool):
+        """Decodifica el valor que empieza en self.pos. Devuelve (True, valor) o (False, None) si falta data"""
+        remaining = len(self.buffer) - self.pos
+        try:
+            value, end = self._decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            if final or remaining > MAX_JSON_VALUE_SIZE:
+                self.state = "lines"
+                return False, None
+            # se reintenta cuando el valor pendiente haya duplicado su tamaño, para no decodificar
+            # un elemento grande una vez por cada buffer que llega
+            self.retry_at = remaining * 2
+            return False, None
+        if not final and (end == len(self.buffer) or (isinstance(value, (int, float))
+                                                      and self.buffer[end] in ".eE+-")):
+            # un número al final del buffer puede continuar en el próximo
+            self.retry_at = remaining + 1
+            return False, None
+        self.pos = end
+        return True, value
+
+    def _scan_array(self) -> bool:
+        """
+        Loop ajustado sobre los elementos de un array que están completos en el buffer. Se detiene ante
+        el cierre del array o ante un elemento que podría seguir en el próximo buffer, que queda para
+        _decode_value. Devuelve True si avanzó
+        """
+        buffer, pos, length = self.buffer, self.pos, len(self.buffer)
+        decode, whitespace = self._decoder.raw_decode, self._WHITESPACE.match
+        start, count = pos, 0
+        try:
+            while pos < length:
+                char = buffer[pos]
+                if char == ",":
+                    pos += 1
+                elif char in " \t\n\r":
+                    pos = whitespace(buffer, pos).end()
+                elif char == "]":
+                    break
+                else:
+                    value, end = decode(buffer, pos)
+                    if end == length or (buffer[end] in ".eE+-" and isinstance(value, (int, float))):
+                        break
+                    pos = end
+                    count += 1
+        except json.JSONDecodeError:
+            pass
+        self.pos = pos
+        if self.counting:
+            self.array_count += count
+        return pos != start
+
+    def _parse(self, final: bool = False) -> None:
+        buffer = self.buffer
+        while self.state != "lines":
+            self.pos = self._WHITESPACE.match(buffer, self.pos).end()
+            if self.pos == len(buffer):
+                return
+            char = buffer[self.pos]
+            state = self.state
+
+            if state == "start":
+                if char == "\ufeff":
+                    self.pos += 1
+                elif char == "[":
+                    self.pos += 1
+                    self.top, self.state, self.counting = "array", "array", True
+                elif char == "{":
+                    self.pos += 1
+                    self.top, self.state = "object", "key"
+                else:
+                    ok, value = self._decode_value(final)
+                    if not ok:
+                        return
+                    self.top, self.state, self.scalar_type = "scalar", "after", type(value)
+
+            elif state == "array":
+                if char != "]" and self._scan_array():
+                    continue
+                if char == ",":
+                    self.pos += 1
+                elif char == "]":
+                    self.pos += 1
+                    if self.counting:
+                        self.size, self.counting = self.array_count, False
+                    self.state = "key" if self.top == "object" else "after"
+                else:
+                    ok, _ = self._decode_value(final)
+                    if not ok:
+                        return
+                    self.array_count += self.counting
+
+            elif state == "key":
+                if char == ",":
+                    self.pos += 1
+                elif char == "}":
+                    self.pos += 1
+                    if self.size is None:
+                        self.size = 1
+                    self.state = "after"
+                elif char == '"':
+                    ok, _ = self._decode_value(final)
+                    if not ok:
+                        return
+                    self.state = "colon"
+                else:
+                    self.state = "lines"
+
+            elif state == "colon":
+                if char == ":":
+                    self.pos += 1
+                    self.state = "value"
+                else:
+                    self.state = "lines"
+
+            elif state == "value":
+                if char == "[":
+                    self.pos += 1
+                    self.state = "array"
+                    self.counting, self.array_count = self.size is None, 0
+                else:
+                    ok, _ = self._decode_value(final)
+                    if not ok:
+                        return
+                    self.state = "key"
+
+            elif state == "after":
+                # hay un segundo valor de nivel superior: es JSON Lines
+                self.state = "lines"
+
+        if self.state == "lines":
+            self.buffer, self.pos = "", 0
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        self._feed_lines(chunk)
+        if self.state == "lines":
+            return
+        self.buffer = self.buffer[self.pos:] + self._text.decode(chunk)
+        self.pos = 0
+        if len(self.buffer) >= self.retry_at:
+            self.retry_at = 0
+            self._parse()
+
+    def result(self) -> Tuple[Optional[int], Optional[str]]:
+        """Devuelve (size, error) una vez consumido todo el stream"""
+        if self.state != "lines":
+            self.buffer = self.buffer[self.pos:] + self._text.decode(b"", final=True)
+            self.pos = 0
+            self._parse(final=True)
+        if self.state == "after":
+            if self.top == "scalar":
+                return None, f"Unexpected JSON structure: {self.scalar_type}"
+            return self.size, None
+        if self.state != "lines":
+            # documento truncado o vacío
+            self.state = "lines"
+        return self.line_count, None
+
+
+def count_json_rows(chunks: Iterable[bytes]) -> Tuple[Optional[int], Optional[str]]:
+    """Cuenta los registros de un json o JSON Lines a partir de un iterable de buffers de bytes"""
+    counter = JsonRowCounter()
+    for chunk in chunks:
+        counter.feed(chunk)
+    return counter.result()
+
+
+def detect_format(url: str, content_type: str) -> Optional[str]:
+    """
+    Decide cómo contar una distribución a partir de la extensión de la url y el Content-Type.
+    Los formatos comprimidos van primero porque suelen servirse con el Content-Type del contenido
+    Returns: "gzip", "zip", "xlsx", "csv", "json" o None si no está soportado
+    """
+    path = urlsplit(url).path.lower()
+    if path.endswith(".gz") or "gzip" in content_type:
+        return "gzip"
+    if path.endswith(".xlsx") or "spreadsheetml" in content_type:
+        return "xlsx"
+    if path.endswith(".zip") or "zip" in content_type:
+        return "zip"
+    if "csv" in content_type or path.endswith((".csv", ".txt")):
+        return "csv"
+    if "json" in content_type or path.endswith(".json"):
+        return "json"
+    return None
+
+
+def gunzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Descomprime un stream gzip (incluso con varios miembros) sin superar CHUNK_SIZE por buffer"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class XlsxSheetRowCounter:
+    """Cuenta los elementos <row> del xml de una hoja de xlsx, buffer a buffer"""
+    _ROW = re.compile(rb"<(?:\w{1,10}:)?row[\s/>]")
+    _CARRY = 16
+
+    def __init__(self):
+        self.rows = 0
+        self.carry = b""
+
+    def feed(self, chunk: bytes) -> None:
+        data = self.carry + chunk
+        # los matches que terminan dentro del carry ya se contaron con el buffer anterior
+        self.rows += sum(1 for match in self._ROW.finditer(data) if match.end() > len(self.carry))
+        self.carry = data[-self._CARRY:]
+
+    def result(self) -> int:
+        return self.rows
+
+
+class ZipRowCounter:
+    """
+    Recorre un zip como stream, leyendo los headers locales de cada archivo sin esperar al directorio
+    central, y suma las filas de los miembros contables: csv/txt en un zip común, o las hojas
+    (xl/worksheets/*.xml) en un xlsx. Los miembros deflate se descomprimen incrementalmente
+    """
+    LOCAL_HEADER = b"PK\x03\x04"
+    DESCRIPTOR = b"PK\x07\x08"
+    END_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+    _SHEET = re.compile(r"xl/worksheets/[^/]+\.xml$")
+
+    def __init__(self, xlsx: bool = False):
+        self.xlsx = xlsx
+        self.buffer = b""
+        self.state = "header"
+        self.member = None
+        self.counted = 0
+        self.rows = 0
+
+    def _new_counter(self, name: str):
+        name = name.lower()
+        if self.xlsx:
+            return XlsxSheetRowCounter() if self._SHEET.match(name) else None
+        return CsvRowCounter() if name.endswith((".csv", ".txt")) else None
+
+    def _parse_header(self) -> bool:
+        if len(self.buffer) < 30:
+            return False
+        signature = self.buffer[:4]
+        if signature in self.END_SIGNATURES:
+            self.state = "done"
+            return False
+        if signature != self.LOCAL_HEADER:
+            raise ValueError("Estructura de zip inválida")
+        flags, method = struct.unpack("<HH", self.buffer[6:10])
+        compressed, = struct.unpack("<I", self.buffer[18:22])
+        name_length, extra_length = struct.unpack("<HH", self.buffer[26:30])
+        header_length = 30 + name_length + extra_length
+        if len(self.buffer) < header_length:
+            return False
+        name = self.buffer[30:30 + name_length].decode("utf-8", errors="ignore")
+        if compressed == 0xFFFFFFFF:
+            compressed = self._zip64_compressed_size(self.buffer[30 + name_length:header_length])
+        has_descriptor = bool(flags & 0x08)
+        if method not in (0, 8):
+            raise ValueError(f"Método de compresión no soportado: {method}")
+        if method == 0 and (has_descriptor or compressed is None):
+            raise ValueError("Zip sin tamaño declarado para un archivo sin comprimir")
+        counter = self._new_counter(name)
+        self.member = {
+            "counter": counter,
+            "remaining": None if has_descriptor else compressed,
+            "decompressor": zlib.decompressobj(-zlib.MAX_WBITS) if method == 8 else None,
+            "descriptor": has_descriptor,
+        }
+        self.buffer = self.buffer[header_length:]
+        self.state = "data"
+        return True
+
+    @staticmethod
+    def _zip64_compressed_size(extra: bytes) -> Optional[int]:
+        position = 0
+        while position + 4 <= len(extra):
+            header_id, size = struct.unpack("<HH", extra[position:position + 4])
+            if header_id == 0x0001 and size >= 16:
+                return struct.unpack("<Q", extra[position + 12:position + 20])[0]
+            position += 4 + size
+        return None
+
+    def _parse_data(self) -> bool:
+        member = self.member
+        counter, decompressor = member["counter"], member["decompressor"]
+        if decompressor is None or (counter is None and member["remaining"] is not None):
+            # sin comprimir, o un miembro que no se cuenta y cuyo tamaño se conoce: se avanza sin descomprimir
+            take = min(len(self.buffer), member["remaining"])
+            data, self.buffer = self.buffer[:take], self.buffer[take:]
+            member["remaining"] -= take
+            if counter is not None and data:
+                counter.feed(data)
+            if member["remaining"] == 0:
+                self._finish_member()
+                return True
+            return False
+
+        while self.buffer and not decompressor.eof:
+            data = decompressor.decompress(self.buffer, CHUNK_SIZE)
+            self.buffer = decompressor.unconsumed_tail
+            if counter is not None and data:
+                counter.feed(data)
+        if decompressor.eof:
+            self.buffer = decompressor.unused_data + self.buffer
+            self._finish_member()
+            return True
+        return False
+
+    def _finish_member(self) -> None:
+        if self.member["counter"] is not None:
+            self.rows += self.member["counter"].result()
+            self.counted += 1
+        self.state = "descriptor" if self.member["descriptor"] else "header"
+        self.member = None
+
+    def _parse_descriptor(self, final: bool) -> bool:
+        # firma opcional + crc + tamaños de 4 bytes (o de 8 en zip64)
+        if len(self.buffer) < 28 and not final:
+            return False
+        offset = 4 if self.buffer.startswith(self.DESCRIPTOR) else 0
+        for size in (12, 20):
+            following = self.buffer[offset + size:offset + size + 4]
+            if following == self.LOCAL_HEADER or following in self.END_SIGNATURES:
+                self.buffer = self.buffer[offset + size:]
+                self.state = "header"
+                return True
+        self.state = "done"
+        return False
+
+    def feed(self, chunk: bytes, final: bool = False) -> None:
+        self.buffer += chunk
+        progress = True
+        while progress and self.state != "done":
+            if self.state == "header":
+                progress = self._parse_header()
+            elif self.state == "data":
+                progress = self._parse_data()
+            else:
+                progress = self._parse_descriptor(final)
+
+    def result(self) -> Tuple[Optional[int], Optional[str]]:
+        self.feed(b"", final=True)
+        if not self.counted:
+            kind = "hojas" if self.xlsx else "archivos csv"
+            return None, f"Zip sin {kind} para contar"
+        return self.rows, None
+
+
+def count_archive_rows(archive_format: str, url: str, chunks: Iterable[bytes]) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Cuenta filas de distribuciones comprimidas: gzip de csv/txt/json, zip con csv o xlsx
+    Returns: (size, error)
+    """
+    if archive_format == "gzip":
+        inner = urlsplit(url).path.lower()
+        inner = inner[:-3] if inner.endswith(".gz") else inner
+        if inner.endswith(".json"):
+            return count_json_rows(gunzip(chunks))
+        if inner.endswith((".csv", ".txt")):
+            return count_csv_rows(gunzip(chunks)), None
+        return None, f"Unsupported compressed content: {inner}"
+
+    counter = ZipRowCounter(xlsx=archive_format == "xlsx")
+    for chunk in chunks:
+        counter.feed(chunk)
+        if counter.state == "done":
+            break
+    return counter.result()
@@ -1,21 +1,267 @@
 import requests
-import json
+import asyncio
+import hashlib
+import os
+import re
+import threading
 import time
-from typing import Dict, List
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import logging
+from checker_and_broadcaster import utils
+from checker_and_broadcaster import hosts
+from checker_and_broadcaster import counters
+from checker_and_broadcaster import journal as crawl_journal
+from checker_and_broadcaster import metrics as run_metrics
 
 logger = logging.getLogger(__name__)
+
+TAIL_SIZE = 256
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class ValidatorCache:
+    """
+    Cache persistente por distribución con los validadores HTTP (ETag, Last-Modified, Content-Length)
+    y la última cantidad de filas conocida. Permite revalidar una distribución sin descargarla de nuevo
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            entries = utils.read_json(path)
+            if isinstance(entries, dict):
+                self._entries = entries
+            else:
+                logger.warning(f"No se pudo leer el cache de validadores {path}: {entries}")
+
+    def get(self, distribution_id: str, url: str) -> Optional[Dict]:
+        """Devuelve la entrada cacheada si existe y corresponde a la misma url"""
+        entry = self._entries.get(distribution_id)
+        if entry and entry.get("url") == url and entry.get("size") is not None:
+            return entry
+        return None
+
+    def set(self, distribution_id: str, url: str, validators: Dict, size, extra: Optional[Dict] = None) -> None:
+        """Guarda validadores y conteo. extra lleva el estado para el conteo incremental de csv"""
+        with self._lock:
+            self._entries[distribution_id] = {"url": url, "size": size, **validators, **(extra or {})}
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+        utils.write_json(self.path, entries)
+
+    @staticmethod
+    def get_validators(response) -> Dict:
+        """Extrae los validadores relevantes de los headers de una respuesta"""
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_length": response.headers.get("Content-Length"),
+        }
+
+    @staticmethod
+    def conditional_headers(entry: Dict) -> Dict:
+        """Headers para un GET condicional a partir de una entrada cacheada"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    @staticmethod
+    def same_validators(entry: Dict, validators: Dict) -> bool:
+        """
+        Un archivo se considera sin cambios si coincide el ETag o, a falta de ETag, si coinciden
+        Last-Modified y Content-Length. Sin ningún validador no se puede afirmar nada
+        """
+        if entry.get("etag") and validators.get("etag"):
+            return entry["etag"] == validators["etag"]
+        if entry.get("last_modified") and validators.get("last_modified"):
+            return (entry["last_modified"] == validators["last_modified"]
+                    and entry.get("content_length") == validators.get("content_length"))
+        return False
+
+
+class TailTracker:
+    """Envuelve un iterable de buffers y lleva la cuenta de bytes leídos y los últimos TAIL_SIZE bytes"""
+    def __init__(self, chunks, length: int = 0):
+        self.chunks = chunks
+        self.length = length
+        self.tail = b""
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.length += len(chunk)
+            self.tail = chunk[-TAIL_SIZE:] if len(chunk) >= TAIL_SIZE else (self.tail + chunk)[-TAIL_SIZE:]
+            yield chunk
+
+    def incremental_state(self, counter: counters.CsvRowCounter, accept_ranges: Optional[str]) -> Dict:
+        """Datos a persistir para pedir sólo la cola del archivo en la próxima corrida"""
+        return {"kind": "csv", "offset": self.length, "tail": hashlib.sha1(self.tail).hexdigest(),
+                "tail_size": len(self.tail), "counter": counter.get_state(), "accept_ranges": accept_ranges}
+
+
 class DistributionProcessor:
-    def __init__(self, max_workers: int = 10, delay: float = 0.1, max_retries: int = 2):
+    ENGINES = ("threads", "async")
+
+    def __init__(self, max_workers: int = 10, delay: float = 0.1, max_retries: int = 2,
+                 cache_path: Optional[str] = None, engine: str = "threads", concurrency: int = 100,
+                 queue_size: int = 200, burst: float = 5, estimate_threshold: Optional[int] = None,
+                 sample_bytes: int = 1 << 20, exact_every: int = 10, change_threshold: float = 0.05,
+                 journal_path: Optional[str] = None, resume_window: timedelta = timedelta(hours=12),
+                 metrics: Optional[run_metrics.RunMetrics] = None):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Motor desconocido: {engine}. Opciones: {', '.join(self.ENGINES)}")
         self.max_workers = max_workers
         self.delay = delay
         self.max_retries = max_retries
+        self.cache = ValidatorCache(cache_path) if cache_path else None
+        self.engine = engine
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        # csv de más de estimate_threshold bytes se estiman a partir de una muestra, con un conteo exacto
+        # cada exact_every corridas o cuando la estimación se aleja más de change_threshold del último exacto
+        self.estimate_threshold = estimate_threshold
+        self.sample_bytes = sample_bytes
+        self.exact_every = exact_every
+        self.change_threshold = change_threshold
+        self.estimated = set()
+        # diario de resultados para retomar el crawl si el proceso muere; se ignoran entradas más viejas
+        # que resume_window
+        self.journal_path = journal_path
+        self.resume_window = resume_window
+        # bytes descargados y resultado de cada distribución por host; revalidated son las que el
+        # cache de validadores resolvió sin volver a contar
+        self.metrics = metrics
+        self.revalidated = set()
+        # delay es el intervalo mínimo entre pedidos al mismo host, no una pausa global
+        pool_size = concurrency if engine == "async" else max_workers
+        self.hosts = hosts.HostPool(rate_per_host=1 / delay if delay else None, burst=burst,
+                                    pool_maxsize=pool_size)
+
+    @staticmethod
+    def _incremental_start(cached: Optional[Dict]) -> Optional[int]:
+        """
+        Byte desde el cual pedir un csv append-only: el offset de la corrida anterior menos los
+        últimos bytes ya vistos, que se usan para verificar que el archivo no fue reescrito
+        """
+        if not cached or cached.get("kind") != "csv" or cached.get("accept_ranges") != "bytes":
+            return None
+        if not cached.get("offset") or not cached.get("counter"):
+            return None
+        return cached["offset"] - cached.get("tail_size", 0)
+
+    @staticmethod
+    def _count_appended(response, cached: Dict, start: int):
+        """
+        Cuenta las filas agregadas a partir de una respuesta 206. Devuelve (size, validators, extra)
+        o None si el solapamiento no coincide con la cola guardada (el archivo fue reescrito)
+        """
+        match = CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != start:
+            return None
+
+        chunks = response.iter_content(chunk_size=counters.CHUNK_SIZE)
+        overlap = b""
+        rest = b""
+        for chunk in chunks:
+            overlap += chunk
+            if len(overlap) >= cached["tail_size"]:
+                overlap, rest = overlap[:cached["tail_size"]], overlap[cached["tail_size"]:]
+                break
+        if hashlib.sha1(overlap).hexdigest() != cached["tail"]:
+            return None
+
+        counter = counters.CsvRowCounter.from_state(cached["counter"])
+        tracker = TailTracker(_prepend(rest, chunks), length=cached["offset"])
+        tracker.tail = overlap
+        for chunk in tracker:
+            counter.feed(chunk)
+
+        validators = ValidatorCache.get_validators(response)
+        validators["content_length"] = str(tracker.length)
+        extra = tracker.incremental_state(counter, cached.get("accept_ranges"))
+        extra.update({"exact_size": counter.result(), "runs_since_exact": 0})
+        return counter.result(), validators, extra
 
-    def _calculate_distribution_size(self, distribution_id: str, distribution: Dict) -> List:
+    def _should_estimate(self, cached: Optional[Dict], response) -> bool:
+        if not self.estimate_threshold or not cached or response.headers.get("Content-Encoding"):
+            return False
+        length = response.headers.get("Content-Length", "")
+        if not length.isdigit() or int(length) < self.estimate_threshold:
+            return False
+        return cached.get("runs_since_exact", self.exact_every) < self.exact_every
+
+    def _read_sample(self, response) -> bytes:
+        sample = b""
+        for chunk in response.iter_content(chunk_size=self.sample_bytes):
+            sample += chunk
+            if len(sample) >= self.sample_bytes:
+                break
+        return sample
+
+    def _estimate_size(self, distribution_id: str, sample: bytes, response, cached: Dict):
         """
-        Función que calcula la cantidad de filas/registros de un csv o un json
+        Estima las filas a partir de los primeros sample_bytes del cuerpo. Conserva el estado del último
+        conteo exacto (incluido el incremental) y agenda un conteo exacto si la estimación cambió demasiado
+        Returns: (size, extra) o (None, None) si la muestra no alcanza para estimar
+        """
+        size = counters.estimate_csv_rows(sample, int(response.headers["Content-Length"]))
+        if size is None:
+            return None, None
+
+        extra = {k: v for k, v in cached.items() if k not in ("url", "size", "etag", "last_modified",
+                                                               "content_length")}
+        runs = cached.get("runs_since_exact", 0) + 1
+        exact_size = cached.get("exact_size")
+        if exact_size and abs(size - exact_size) / exact_size > self.change_threshold:
+            runs = self.exact_every
+        extra.update({"estimated": True, "runs_since_exact": runs})
+        self.estimated.add(distribution_id)
+        return size, extra
+
+    @contextmanager
+    def _get(self, session, url: str, headers: Dict):
+        """GET en streaming que al cerrarse suma a las métricas los bytes leídos de la respuesta"""
+        with session.get(url, headers=headers, timeout=self.hosts.timeout(url), stream=True) as response:
+            try:
+                yield response
+            finally:
+                if self.metrics:
+                    self.metrics.add_bytes(url, _bytes_read(response))
+
+    def _record_outcome(self, result: List, skipped: bool = False) -> None:
+        if not self.metrics:
+            return
+        distribution_id, url, _, error = result
+        if error:
+            outcome = "failed"
+        elif skipped or distribution_id in self.revalidated:
+            outcome = "skipped"
+        else:
+            outcome = "counted"
+        self.metrics.record_distribution(url, outcome)
+
+    def _calculate_distribution_size(self, distribution_id: str, distribution: Dict,
+                                     reserved: bool = False) -> List:
+        """
+        Función que calcula la cantidad de filas/registros de un csv, un json o de csv/hojas dentro
+        de un gzip, zip o xlsx. Si la distribución
+        está en el cache de validadores hace un GET condicional y reutiliza el conteo anterior
+        cuando el servidor responde 304 o los validadores no cambiaron. Si un csv creció y el servidor
+        acepta rangos, sólo se descarga la cola nueva y se suma al conteo anterior. Cada intento usa la sesión
+        compartida del host y espera un token de su rate limiter (salvo el primero si reserved=True), con
+        timeout derivado de la latencia del host y backoff con jitter entre reintentos. Si el host
+        acumuló demasiadas fallas en la corrida, la distribución falla sin hacer el pedido
         Returns: [distribution_id, url, size, error]
         """
         url = distribution.get("url", "")
@@ -27,85 +273,286 @@ class DistributionProcessor:
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
         }
 
+        cached = self.cache.get(distribution_id, url) if self.cache else None
+        if cached:
+            headers.update(ValidatorCache.conditional_headers(cached))
+        start = self._incremental_start(cached)
+        if start is not None:
+            headers["Range"] = f"bytes={start}-"
+
+        session = self.hosts.session(url)
         attempts = 0
         while attempts <= self.max_retries:
+            if self.hosts.is_open(url):
+                return [distribution_id, url, None, f"Circuit open for host {hosts.get_host(url)}"]
+            retryable = True
             try:
-                with requests.get(url, headers=headers, verify=False, timeout=30, stream=True) as response:
+                if attempts or not reserved:
+                    self.hosts.acquire(url)
+                with self._get(session, url, headers) as response:
+                    if response.status_code >= 500:
+                        self.hosts.record_failure(url)
+                    else:
+                        self.hosts.record_success(url, response.elapsed.total_seconds())
+
+                    if cached and response.status_code == 304:
+                        if cached.get("estimated"):
+                            self.estimated.add(distribution_id)
+                        self.revalidated.add(distribution_id)
+                        return [distribution_id, url, cached["size"], None]
+
+                    if start is not None and response.status_code in (206, 416):
+                        appended = None
+                        if response.status_code == 206:
+                            appended = self._count_appended(response, cached, start)
+                        if appended is not None:
+                            size, validators, extra = appended
+                            self.cache.set(distribution_id, url, validators, size, extra)
+                            return [distribution_id, url, size, None]
+                        # el archivo se achicó o fue reescrito: se vuelve a contar completo
+                        logger.info(f"{distribution_id} fue reescrito, se cuenta completo")
+                        for header in ("Range", "If-None-Match", "If-Modified-Since"):
+                            headers.pop(header, None)
+                        cached = start = None
+                        continue
+
+                    if response.status_code >= 500:
+                        # los 5xx son fallas transitorias del servidor: se reintentan como los errores de red
+                        raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
                     if response.status_code != 200:
                         error = f"HTTP {response.status_code}"
                         return [distribution_id, url, size, error]
 
+                    validators = ValidatorCache.get_validators(response)
+                    if cached and ValidatorCache.same_validators(cached, validators):
+                        if cached.get("estimated"):
+                            self.estimated.add(distribution_id)
+                        self.revalidated.add(distribution_id)
+                        return [distribution_id, url, cached["size"], None]
+
                     content_type = response.headers.get('Content-Type', '').lower()
+                    data_format = counters.detect_format(url, content_type)
+                    extra = None
 
                     # CSV / text
-                    if 'csv' in content_type or url.endswith(('.csv', '.txt')):
+                    if data_format == "csv":
                         try:
-                            size = sum(1 for _ in response.iter_lines() if _)
+                            sample = b""
+                            if self._should_estimate(cached, response):
+                                sample = self._read_sample(response)
+                                size, extra = self._estimate_size(distribution_id, sample, response, cached)
+                            if size is None:
+                                counter = counters.CsvRowCounter()
+                                tracker = TailTracker(_prepend(sample, response.iter_content(
+                                    chunk_size=counters.CHUNK_SIZE)))
+                                for chunk in tracker:
+                                    counter.feed(chunk)
+                                size = counter.result()
+                                extra = tracker.incremental_state(counter, response.headers.get("Accept-Ranges"))
+                                extra.update({"exact_size": size, "runs_since_exact": 0})
+                        except requests.exceptions.RequestException:
+                            raise
                         except Exception as e:
+                            # el archivo está mal formado: volver a bajarlo da el mismo error
                             error = f"CSV/Text parsing error: {str(e)}"
+                            retryable = False
+
+                    # JSON / JSON Lines en una sola pasada
+                    elif data_format == "json":
+                        try:
+                            size, error = counters.count_json_rows(
+                                response.iter_content(chunk_size=counters.CHUNK_SIZE))
+                            retryable = size is not None
+                        except requests.exceptions.RequestException:
+                            raise
+                        except Exception as e:
+                            error = f"JSON parsing error: {str(e)}"
+                            retryable = False
 
-                    # JSON
-                    elif 'json' in content_type or url.endswith('.json'):
+                    # gzip, zip con csv y xlsx, descomprimidos como stream
+                    elif data_format in ("gzip", "zip", "xlsx"):
                         try:
-                            text = response.content.decode('utf-8', errors='ignore')
-                            data = json.loads(text)
-                            if isinstance(data, list):
-                                size = len(data)
-                            elif isinstance(data, dict):
-                                array_keys = [k for k, v in data.items() if isinstance(v, list)]
-                                size = len(data[array_keys[0]]) if array_keys else 1
-                            else:
-                                error = f"Unexpected JSON structure: {type(data)}"
-                        except json.JSONDecodeError:
-                            # fallback to JSON lines
-                            try:
-                                with requests.get(url, headers=headers, verify=False, timeout=30, stream=True) as r2:
-                                    size = sum(1 for line in r2.iter_lines() if line.strip().startswith(b"{"))
-                            except Exception as e:
-                                error = f"JSON parsing error: {str(e)}"
+                            size, error = counters.count_archive_rows(
+                                data_format, url, response.iter_content(chunk_size=counters.CHUNK_SIZE))
+                            retryable = size is not None
+                        except requests.exceptions.RequestException:
+                            raise
+                        except Exception as e:
+                            error = f"Compressed parsing error: {str(e)}"
+                            retryable = False
 
                     else:
                         error = f"Unsupported content type: {content_type}"
+                        retryable = False
 
                 # success
                 if size is not None:
+                    if self.cache:
+                        self.cache.set(distribution_id, url, validators, size, extra)
                     return [distribution_id, url, size, error]
 
             except requests.exceptions.Timeout:
                 error = "Request timeout"
+                self.hosts.record_failure(url)
             except requests.exceptions.ConnectionError:
                 error = "Connection error"
+                self.hosts.record_failure(url)
+            except requests.exceptions.HTTPError as e:
+                error = str(e)
             except requests.exceptions.RequestException as e:
                 error = f"Request error: {str(e)}"
             except Exception as e:
                 error = f"Unexpected error: {str(e)}"
 
+            # los errores propios del contenido (formato no soportado, estructura inesperada) no se reintentan
+            if not retryable:
+                return [distribution_id, url, size, error]
+
             # retry logic
             attempts += 1
             if attempts <= self.max_retries:
                 logger.warning(f"Retry {attempts} for {distribution_id} after error: {error}")
-                time.sleep(1)
+                time.sleep(self.hosts.backoff(attempts))
 
         # final fallback if all retries fail
         return [distribution_id, url, size, error or f"Failed after {self.max_retries} retries"]
 
-    def process_distributions_concurrent(self, distributions: Dict[str, Dict]) -> List[List]:
+    def process_distributions_concurrent(self, distributions: Dict[str, Dict],
+                                         on_result: Optional[Callable[[List], None]] = None) -> List[List]:
         """
-        Funcion que corre calculate_distribution_size en paralelo para las distribuciones listadas
+        Funcion que corre calculate_distribution_size en paralelo para las distribuciones listadas.
+        Usa el pool de threads o el motor asincrónico según self.engine. Si se pasa on_result, se llama
+        con cada fila en el thread que llama a esta función a medida que van terminando.
+        Con journal_path cada fila se escribe en el diario apenas termina, y las distribuciones que el
+        diario ya tiene contadas (misma url, sin error, dentro de resume_window) no se vuelven a descargar
         """
+        journal = crawl_journal.CrawlJournal(self.journal_path, self.resume_window) if self.journal_path else None
+        resumed = []
+        if journal:
+            for entry in journal.resume(distributions):
+                result = entry["result"]
+                if entry.get("estimated"):
+                    self.estimated.add(result[0])
+                resumed.append(result)
+                self._record_outcome(result, skipped=True)
+                if on_result:
+                    on_result(result)
+            if resumed:
+                logger.info(f"Se retoman {len(resumed)} distribuciones ya contadas del diario {self.journal_path}")
+            done = {result[0] for result in resumed}
+            distributions = {k: v for k, v in distributions.items() if k not in done}
+
+        def record(result):
+            self._record_outcome(result)
+            if journal:
+                journal.append(result, estimated=result[0] in self.estimated)
+            if on_result:
+                on_result(result)
+
+        try:
+            if self.engine == "async":
+                results = asyncio.run(self.process_distributions_async(distributions, record))
+            else:
+                results = self._process_distributions_threads(distributions, record)
+        finally:
+            if journal:
+                journal.close()
+        return resumed + results
+
+    def _process_distributions_threads(self, distributions: Dict[str, Dict],
+                                       on_result: Callable[[List], None]) -> List[List]:
         results = []
         total = len(distributions)
 
         def worker(item):
             dist_id, dist_data = item
             logger.info(f"Processing {dist_id} - {dist_data.get('url', '')}")
-            result = self._calculate_distribution_size(dist_id, dist_data)
-            time.sleep(self.delay)
-            return result
+            return self._calculate_distribution_size(dist_id, dist_data)
 
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             futures = {executor.submit(worker, item): item for item in distributions.items()}
             for future in tqdm(as_completed(futures), total=total, desc="Processing distributions"):
-                results.append(future.result())
+                result = future.result()
+                results.append(result)
+                on_result(result)
+
+        self.hosts.close()
+        if self.cache:
+            self.cache.save()
+        return results
+
+    async def process_distributions_async(self, distributions: Dict[str, Dict],
+                                          on_result: Optional[Callable[[List], None]] = None) -> List[List]:
+        """
+        Motor asincrónico: un productor carga las distribuciones en una cola acotada (queue_size) y
+        self.concurrency corrutinas las consumen, por lo que nunca hay más de concurrency descargas
+        en vuelo. Los resultados salen por una segunda cola acotada a medida que terminan.
+        Returns: las mismas filas [distribution_id, url, size, error] que el motor de threads
+        """
+        work_queue = asyncio.Queue(maxsize=self.queue_size)
+        result_queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_running_loop()
+        # requests es bloqueante: cada descarga corre en un thread del executor y las corrutinas
+        # esperan el turno del rate limiter del host sin ocupar un thread. Más threads que conexiones
+        # en los pools de los hosts sólo abrirían conexiones que el pool después descarta
+        active_hosts = {hosts.get_host(data.get("url", "")) for data in distributions.values()}
+        executor = ThreadPoolExecutor(max_workers=max(1, self.hosts.pool_maxsize * len(active_hosts)))
+
+        async def producer():
+            for item in distributions.items():
+                await work_queue.put(item)
+            for _ in range(self.concurrency):
+                await work_queue.put(None)
+
+        async def consumer():
+            while True:
+                item = await work_queue.get()
+                if item is None:
+                    return
+                dist_id, dist_data = item
+                url = dist_data.get("url", "")
+                # cada distribución publica un resultado pase lo que pase: el loop de resultados espera
+                # exactamente uno por distribución y si falta uno se queda esperando para siempre
+                result = [dist_id, url, None, "Unexpected error: processing was cancelled"]
+                try:
+                    logger.info(f"Processing {dist_id} - {url}")
+                    await asyncio.sleep(self.hosts.reserve(url))
+                    result = await loop.run_in_executor(executor, self._calculate_distribution_size,
+                                                        dist_id, dist_data, True)
+                except Exception as e:
+                    result = [dist_id, url, None, f"Unexpected error: {str(e)}"]
+                finally:
+                    await result_queue.put(result)
+
+        results = []
+        try:
+            tasks = [asyncio.create_task(producer())]
+            tasks += [asyncio.create_task(consumer()) for _ in range(self.concurrency)]
+            with tqdm(total=len(distributions), desc="Processing distributions") as progress:
+                while len(results) < len(distributions):
+                    result = await result_queue.get()
+                    results.append(result)
+                    if on_result:
+                        on_result(result)
+                    progress.update(1)
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=False)
+            self.hosts.close()
+
+        if self.cache:
+            self.cache.save()
+        return results
+
+
+def _bytes_read(response) -> int:
+    """Bytes leídos del socket (comprimidos, como viajaron) según urllib3; 0 si la respuesta no lo expone"""
+    try:
+        return int(response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
 
-        return results
\ No newline at end of file
+def _prepend(first: bytes, chunks):
+    yield first
+    yield from chunks
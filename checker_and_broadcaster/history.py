@@ -0,0 +1,195 @@
+import os
+import shutil
+import logging
+from checker_and_broadcaster import state as st
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_MARK = b'"kind":"checkpoint"'
+
+
+class StateHistory:
+    """Historial append-only de estados. Cada corrida guarda sólo los datasets que cambiaron respecto de la
+    anterior (delta) y cada checkpoint_every corridas se guarda el estado completo (checkpoint), de modo que
+    reconstruir cualquier corrida nunca aplica más de checkpoint_every - 1 deltas.
+    Al lado del historial se mantiene un índice (<path>.idx) con una línea "corrida tipo inicio fin" por
+    registro, para no releer el historial completo en cada corrida. Si el índice no coincide con el tamaño del
+    historial se reconstruye con una pasada por el archivo"""
+
+    def __init__(self, path, checkpoint_every=10):
+        self.path = str(path)
+        self.index_path = f"{self.path}.idx"
+        self.checkpoint_every = max(1, int(checkpoint_every))
+
+    def _read_records(self, start=0):
+        """Descripcion: Recorre los registros del historial desde un offset en bytes
+        Returns: generador de (offset, registro)"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if line.strip():
+                    yield offset, st.loads(line)
+                offset += len(line)
+
+    def _size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    @staticmethod
+    def _parse_entry(line):
+        run, kind, start, end = line.split()
+        return int(run), kind, int(start), int(end)
+
+    @staticmethod
+    def _format_entry(entry):
+        return "%d %s %d %d\n" % entry
+
+    def _write_index(self, entries):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(self._format_entry(entry) for entry in entries)
+        os.replace(tmp_path, self.index_path)
+
+    def _rebuild_index(self):
+        """Descripcion: Recorre el historial leyendo sólo el comienzo de cada registro y reescribe el índice
+        Returns: devuelve la lista de (corrida, tipo, inicio, fin)"""
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    head = line[:64]
+                    run = int(head.split(b",", 1)[0].split(b":", 1)[1])
+                    kind = "checkpoint" if CHECKPOINT_MARK in head else "delta"
+                    entries.append((run, kind, offset, offset + len(line)))
+                offset += len(line)
+        self._write_index(entries)
+        logger.info(f"Índice del historial reconstruido: {len(entries)} corridas")
+        return entries
+
+    def _index(self):
+        """Descripcion: Lee el índice y lo reconstruye si falta o quedó desfasado respecto del historial
+        Returns: devuelve la lista de (corrida, tipo, inicio, fin)"""
+        try:
+            with open(self.index_path) as f:
+                entries = [self._parse_entry(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            entries = None
+        if entries is None or (entries[-1][3] if entries else 0) != self._size():
+            entries = self._rebuild_index()
+        return entries
+
+    def _scan(self):
+        """Descripcion: Ubica la última corrida y el offset de cada checkpoint a partir del índice
+        Returns: devuelve (última corrida, {corrida: offset de checkpoint})"""
+        entries = self._index()
+        checkpoints = {run: start for run, kind, start, _ in entries if kind == "checkpoint"}
+        return (entries[-1][0] if entries else 0), checkpoints
+
+    def last_run(self):
+        """Descripcion: Número de la última corrida guardada. Lee sólo el final del índice; si no coincide con
+        el historial se reconstruye
+        Returns: devuelve el número o 0 si el historial está vacío"""
+        try:
+            with open(self.index_path, "rb") as f:
+                f.seek(max(0, os.path.getsize(self.index_path) - 256))
+                tail = f.read().splitlines()
+            run, _, _, end = self._parse_entry(tail[-1].decode())
+            if end == self._size():
+                return run
+        except (OSError, ValueError, IndexError):
+            pass
+        return self._scan()[0]
+
+    def runs(self):
+        """Descripcion: Lista las corridas guardadas con su fecha de cosecha y tipo de registro
+        Returns: devuelve una lista de diccionarios"""
+        return [{"run": record["run"], "kind": record["kind"], "harvested_at": record.get("harvested_at")}
+                for _, record in self._read_records()]
+
+    def state_at(self, run=None):
+        """Descripcion: Reconstruye el estado de una corrida a partir del último checkpoint anterior y los
+        deltas que le siguen. Si no se indica corrida se reconstruye la última
+        Returns: devuelve el estado o None si la corrida no existe"""
+        last_run, checkpoints = self._scan()
+        run = last_run if run is None else run
+        bases = [r for r in checkpoints if r <= run]
+        if not bases or run > last_run:
+            return None
+        state = None
+        for _, record in self._read_records(checkpoints[max(bases)]):
+            if record["run"] > run:
+                break
+            if record["kind"] == "checkpoint":
+                state = record["state"]
+            else:
+                data = state["data"]
+                data.update(record["changed"])
+                for dataset_id in record["removed"]:
+                    data.pop(dataset_id, None)
+                state["harvested_at"] = record.get("harvested_at")
+        state["total_datasets"] = len(state["data"])
+        state["total_distributions"] = sum(len(v["distributions"]) for v in state["data"].values())
+        return state
+
+    @staticmethod
+    def diff(previous, current):
+        """Descripcion: Calcula los datasets agregados o modificados y los eliminados entre dos estados
+        Returns: devuelve (changed, removed)"""
+        prev_data = previous.get("data", {})
+        curr_data = current.get("data", {})
+        changed = {dataset_id: dataset for dataset_id, dataset in curr_data.items()
+                   if prev_data.get(dataset_id) != dataset}
+        removed = [dataset_id for dataset_id in prev_data if dataset_id not in curr_data]
+        return changed, removed
+
+    def append(self, state):
+        """Descripcion: Agrega una corrida al historial, como checkpoint si corresponde o como delta contra la
+        corrida anterior
+        Returns: devuelve el número de corrida asignado"""
+        last_run, checkpoints = self._scan()
+        run = last_run + 1
+        last_checkpoint = max(checkpoints) if checkpoints else None
+        if last_checkpoint is None or run - last_checkpoint >= self.checkpoint_every:
+            record = {"run": run, "kind": "checkpoint", "harvested_at": state.get("harvested_at"),
+                      "state": state}
+        else:
+            changed, removed = self.diff(self.state_at(last_run), state)
+            record = {"run": run, "kind": "delta", "harvested_at": state.get("harvested_at"),
+                      "changed": changed, "removed": removed}
+        line = st.dumps(record) + b"\n"
+        start = self._size()
+        with open(self.path, "ab") as f:
+            f.write(line)
+        with open(self.index_path, "a") as f:
+            f.write(self._format_entry((run, record["kind"], start, start + len(line))))
+        logger.info(f"Historial de estados: corrida {run} guardada como {record['kind']}")
+        return run
+
+    def prune(self, keep):
+        """Descripcion: Compacta el historial descartando los registros anteriores al checkpoint desde el que
+        se reconstruyen las últimas keep corridas. Se corta siempre en un checkpoint, así que pueden quedar
+        hasta checkpoint_every - 1 corridas de más. Los números de corrida no cambian
+        Returns: devuelve la cantidad de corridas borradas"""
+        entries = self._index()
+        if keep <= 0 or not entries:
+            return 0
+        oldest_kept = entries[-1][0] - keep + 1
+        bases = [entry for entry in entries if entry[1] == "checkpoint" and entry[0] <= oldest_kept]
+        if not bases or bases[-1][2] == 0:
+            return 0
+        cut = bases[-1][2]
+        tmp_path = f"{self.path}.tmp"
+        with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+            src.seek(cut)
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, self.path)
+        kept = [(run, kind, start - cut, end - cut) for run, kind, start, end in entries if start >= cut]
+        self._write_index(kept)
+        removed = len(entries) - len(kept)
+        logger.info(f"Historial de estados: se borraron {removed} corridas anteriores a {kept[0][0]}")
+        return removed
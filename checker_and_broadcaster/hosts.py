@@ -0,0 +1,156 @@
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+def get_host(url: str) -> str:
+    """Devuelve el host (netloc en minúsculas) de una url"""
+    return urlsplit(url).netloc.lower()
+
+
+class TokenBucket:
+    """
+    Token bucket con reservas: cada pedido toma un token y, si no hay, recibe el tiempo que tiene
+    que esperar. Los tokens pueden quedar negativos, así los pedidos se encolan en orden de llegada
+    """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Reserva un token y devuelve los segundos a esperar antes de usarlo"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class HostHealth:
+    """
+    Estado de un host durante la corrida: latencia suavizada (estilo RTO de TCP) para derivar el timeout
+    y fallas consecutivas para el circuit breaker
+    """
+    def __init__(self):
+        self.latency = None
+        self.deviation = 0.0
+        self.failures = 0
+        self.open = False
+
+
+class HostPool:
+    """
+    Sesiones HTTP con keep-alive compartidas por host y un token bucket por host que limita la
+    cantidad de pedidos por segundo a cada servidor
+    """
+    def __init__(self, rate_per_host: Optional[float] = 10.0, burst: float = 5, pool_maxsize: int = 10,
+                 verify: bool = False, min_timeout: float = 5, max_timeout: float = 30,
+                 failure_threshold: int = 5, backoff_base: float = 1, backoff_cap: float = 30):
+        self.rate_per_host = rate_per_host
+        self.burst = burst
+        self.pool_maxsize = pool_maxsize
+        self.verify = verify
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._sessions: Dict[str, requests.Session] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._health: Dict[str, HostHealth] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str) -> requests.Session:
+        host = get_host(url)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                session.verify = self.verify
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def reserve(self, url: str) -> float:
+        """Reserva un turno para el host de la url y devuelve los segundos a esperar"""
+        if not self.rate_per_host:
+            return 0.0
+        host = get_host(url)
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_host, self.burst)
+                self._buckets[host] = bucket
+        return bucket.reserve()
+
+    def acquire(self, url: str) -> None:
+        """Bloquea hasta que el host de la url tenga un token disponible"""
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _get_health(self, url: str) -> HostHealth:
+        host = get_host(url)
+        with self._lock:
+            health = self._health.get(host)
+            if health is None:
+                health = self._health[host] = HostHealth()
+            return health
+
+    def timeout(self, url: str) -> float:
+        """
+        Timeout derivado de la latencia observada del host: latencia + 4 desvíos, acotado entre
+        min_timeout y max_timeout. Sin mediciones se usa max_timeout
+        """
+        health = self._get_health(url)
+        if health.latency is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, health.latency + 4 * health.deviation))
+
+    def record_success(self, url: str, latency: float) -> None:
+        health = self._get_health(url)
+        with self._lock:
+            if health.latency is None:
+                health.latency, health.deviation = latency, latency / 2
+            else:
+                health.deviation = 0.75 * health.deviation + 0.25 * abs(health.latency - latency)
+                health.latency = 0.875 * health.latency + 0.125 * latency
+            health.failures = 0
+
+    def record_failure(self, url: str) -> None:
+        """Suma una falla consecutiva; al llegar a failure_threshold abre el breaker por el resto de la corrida"""
+        health = self._get_health(url)
+        with self._lock:
+            health.failures += 1
+            if health.failures >= self.failure_threshold and not health.open:
+                health.open = True
+                logger.warning(f"Circuit breaker abierto para {get_host(url)} tras {health.failures} fallas")
+
+    def is_open(self, url: str) -> bool:
+        return self._get_health(url).open
+
+    def backoff(self, attempt: int) -> float:
+        """Backoff exponencial con full jitter: un valor al azar entre 0 y base * 2^attempt (acotado)"""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
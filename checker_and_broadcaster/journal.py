@@ -0,0 +1,76 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+from checker_and_broadcaster import state as st
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlJournal:
+    """
+    Diario append-only de los resultados del conteo de distribuciones. Cada fila [id, url, size, error]
+    se escribe apenas termina, así que si el proceso muere a mitad del crawl la siguiente ejecución de
+    la misma corrida retoma desde las distribuciones que faltan
+    """
+    def __init__(self, path: str, window: timedelta = timedelta(hours=12), fsync_every: int = 100):
+        self.path = path
+        self.window = window
+        self.fsync_every = fsync_every
+        self._file = None
+        self._pending_sync = 0
+
+    def _entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    yield st.loads(line)
+                except st.StateError:
+                    # la última línea puede haber quedado cortada si el proceso murió escribiéndola
+                    logger.warning(f"Línea inválida en el diario {self.path}, se ignora")
+
+    def resume(self, distributions: Dict[str, Dict]) -> List[Dict]:
+        """
+        Busca en el diario las distribuciones ya contadas sin error dentro de la ventana, para la misma url.
+        Returns: lista de entradas {"at", "result", "estimated"}, la última por distribución
+        """
+        cutoff = datetime.now(timezone.utc) - self.window
+        completed = {}
+        for entry in self._entries():
+            distribution_id, url, _, error = entry["result"]
+            if error or datetime.fromisoformat(entry["at"]) < cutoff:
+                continue
+            if distributions.get(distribution_id, {}).get("url") == url:
+                completed[distribution_id] = entry
+        return list(completed.values())
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, result: List, estimated: bool = False) -> None:
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "ab")
+            if self._file.tell() > 0 and not self._ends_with_newline():
+                # cierra la línea cortada por una caída para no pegarle la siguiente entrada
+                self._file.write(b"\n")
+        entry = {"at": datetime.now(timezone.utc).isoformat(), "result": result, "estimated": estimated}
+        self._file.write(st.dumps(entry) + b"\n")
+        # flush deja la línea en el sistema operativo (sobrevive a que muera el proceso); fsync cada
+        # fsync_every líneas la baja a disco por si se cae la máquina
+        self._file.flush()
+        self._pending_sync += 1
+        if self._pending_sync >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._pending_sync = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
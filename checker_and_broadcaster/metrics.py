@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from checker_and_broadcaster import hosts
+from checker_and_broadcaster import state as st
+
+OUTCOMES = ("counted", "skipped", "failed")
+PREFIX = "datob"
+
+
+class RunMetrics:
+    """
+    Métricas de una corrida del checker: duración de cada etapa, bytes descargados y distribuciones
+    contadas, salteadas (revalidadas por cache o retomadas del diario) y fallidas por host, y cantidad de
+    eventos por tipo. Se exportan como textfile de Prometheus (para el textfile collector de node_exporter)
+    y como resumen json de la corrida
+    """
+    def __init__(self, run_id: Optional[str] = None):
+        self.run_id = run_id
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self.success = None
+        self.stages = {}
+        self.hosts = {}
+        self.events = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Mide el tiempo de reloj del bloque y lo acumula en la etapa name, aunque el bloque falle"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def _host(self, url: str) -> Dict:
+        host = hosts.get_host(url) or "desconocido"
+        if host not in self.hosts:
+            self.hosts[host] = {"bytes": 0, **{outcome: 0 for outcome in OUTCOMES}}
+        return self.hosts[host]
+
+    def add_bytes(self, url: str, amount: int) -> None:
+        if amount:
+            with self._lock:
+                self._host(url)["bytes"] += amount
+
+    def record_distribution(self, url: str, outcome: str) -> None:
+        if outcome not in OUTCOMES:
+            raise ValueError(f"Resultado desconocido: {outcome}. Opciones: {', '.join(OUTCOMES)}")
+        with self._lock:
+            self._host(url)[outcome] += 1
+
+    def set_events(self, kind: str, frame, key: str) -> None:
+        """Cuenta los ids distintos de la columna key de un DataFrame de eventos, que trae una fila por tema
+        (None o vacío cuentan como cero)"""
+        self.events[kind] = 0 if frame is None or len(frame) == 0 else int(frame[key].nunique())
+
+    def finish(self, success: bool = True) -> None:
+        self.finished_at = datetime.now(timezone.utc)
+        self.success = success
+
+    def summary(self) -> Dict:
+        """Returns: diccionario con todas las métricas de la corrida"""
+        with self._lock:
+            per_host = {host: dict(values) for host, values in sorted(self.hosts.items())}
+            stages = dict(self.stages)
+        totals = {key: sum(values[key] for values in per_host.values()) for key in ("bytes",) + OUTCOMES}
+        return {"run_id": self.run_id,
+                "started_at": self.started_at.isoformat(),
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "success": self.success,
+                "stages": stages,
+                "distributions": totals,
+                "hosts": per_host,
+                "events": dict(self.events)}
+
+    def to_prometheus(self) -> str:
+        """Returns: las métricas en el formato de texto de Prometheus. El run_id queda sólo en el resumen json:
+        como label crearía series nuevas en cada corrida"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                selector = f"{{{','.join(labels)}}}" if labels else ""
+                lines.append(f"{PREFIX}_{name}{selector} {_number(value)}")
+
+        metric("stage_duration_seconds", "gauge", "Duración de cada etapa de la corrida",
+               [([f'stage="{_escape(stage)}"'], seconds) for stage, seconds in summary["stages"].items()])
+        metric("bytes_downloaded", "gauge", "Bytes descargados por host",
+               [([f'host="{_escape(host)}"'], values["bytes"]) for host, values in summary["hosts"].items()])
+        metric("distributions", "gauge", "Distribuciones por host y resultado",
+               [([f'host="{_escape(host)}"', f'outcome="{outcome}"'], values[outcome])
+                for host, values in summary["hosts"].items() for outcome in OUTCOMES])
+        metric("events", "gauge", "Eventos detectados por tipo",
+               [([f'type="{_escape(kind)}"'], count) for kind, count in summary["events"].items()])
+        metric("run_start_timestamp_seconds", "gauge", "Inicio de la corrida",
+               [([], self.started_at.timestamp())])
+        if self.finished_at:
+            metric("run_end_timestamp_seconds", "gauge", "Fin de la corrida", [([], self.finished_at.timestamp())])
+            metric("last_run_timestamp_seconds", "gauge", "Fin de la última corrida terminada, bien o mal",
+                   [([], self.finished_at.timestamp())])
+        if self.success is not None:
+            metric("run_success", "gauge", "1 si la corrida terminó bien", [([], int(self.success))])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str) -> None:
+        _write_atomic(path, st.dumps(self.summary()))
+
+    def write_prometheus(self, path: str) -> None:
+        # el textfile collector puede leer en cualquier momento: se escribe a un temporal y se renombra
+        _write_atomic(path, self.to_prometheus().encode("utf-8"))
+
+
+def _write_atomic(path: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional
+from checker_and_broadcaster import utils
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+
+
+class MissingsStore:
+    """
+    Registro de datasets (o distribuciones) que desaparecieron del portal, para no anunciarlos como nuevos
+    si vuelven. Guarda por id el título, cuándo se detectó la ausencia (first_seen) y la última corrida en
+    que seguía ausente (last_seen), con índices por id y por título para consultas O(1). Las entradas con
+    first_seen más viejo que ttl vencen: si el dataset vuelve después, se anuncia como nuevo.
+    Los cambios se acumulan en memoria y se escriben juntos con save, de forma atómica. Acepta el formato
+    anterior {id: título} y lo migra al guardar. Con entries se arranca de una copia de las entradas (el
+    snapshot de una corrida cacheada) en vez de leer path
+    """
+    def __init__(self, path: str, ttl: Optional[timedelta] = None, now: Optional[datetime] = None,
+                 entries: Optional[Dict[str, Dict]] = None):
+        self.path = path
+        self.ttl = ttl
+        self.now = (now or datetime.now(timezone.utc)).isoformat()
+        self.entries = {}
+        self._titles = {}
+        self.dirty = False
+        if entries is None:
+            self._load()
+        else:
+            for key, entry in entries.items():
+                self._add(key, dict(entry))
+        self.expire()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        raw = utils.read_json(self.path)
+        if not isinstance(raw, dict):
+            logger.error(f"No se pudo leer {self.path}, se arranca sin faltantes: {raw}")
+            return
+        if raw.get("version") == VERSION and isinstance(raw.get("missing"), dict):
+            entries = raw["missing"]
+        else:
+            # formato anterior {id: título}: no se sabe desde cuándo faltan, se toma la fecha de la migración
+            entries = {key: {"title": title, "first_seen": self.now, "last_seen": self.now}
+                       for key, title in raw.items()}
+            self.dirty = True
+        for key, entry in entries.items():
+            self._add(key, entry)
+
+    def _add(self, key: str, entry: Dict) -> None:
+        self._discard(key)
+        self.entries[key] = entry
+        self._titles.setdefault(entry.get("title"), set()).add(key)
+
+    def _discard(self, key: str) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        keys = self._titles[entry.get("title")]
+        keys.discard(key)
+        if not keys:
+            del self._titles[entry.get("title")]
+        return True
+
+    def has_id(self, key: str) -> bool:
+        return key in self.entries
+
+    def has_title(self, title: str) -> bool:
+        return title in self._titles
+
+    def ids(self) -> frozenset:
+        return frozenset(self.entries)
+
+    def titles(self) -> frozenset:
+        return frozenset(title for title in self._titles if title is not None)
+
+    def mark_missing(self, absent: Dict[str, Optional[str]]) -> None:
+        """Registra los ausentes {id: título}; a los que ya estaban se les actualiza last_seen"""
+        for key, title in absent.items():
+            first_seen = self.entries.get(key, {}).get("first_seen", self.now)
+            self._add(key, {"title": title, "first_seen": first_seen, "last_seen": self.now})
+            self.dirty = True
+
+    def refresh(self, present: Iterable[str]) -> None:
+        """Actualiza last_seen de los faltantes que tampoco están entre los ids presentes en esta corrida"""
+        present = present if isinstance(present, (set, frozenset, dict)) else set(present)
+        for key, entry in self.entries.items():
+            if key not in present and entry.get("last_seen") != self.now:
+                entry["last_seen"] = self.now
+                self.dirty = True
+
+    def mark_found(self, found_ids: Iterable[str], found_titles: Iterable[str] = ()) -> None:
+        """Quita los faltantes que volvieron, por id o por título"""
+        removed = {key for key in found_ids if key in self.entries}
+        for title in found_titles:
+            removed.update(self._titles.get(title, ()))
+        for key in removed:
+            self.dirty |= self._discard(key)
+
+    def expire(self) -> None:
+        if not self.ttl:
+            return
+        cutoff = (datetime.fromisoformat(self.now) - self.ttl).isoformat()
+        expired = [key for key, entry in self.entries.items() if entry.get("first_seen", self.now) < cutoff]
+        for key in expired:
+            self._discard(key)
+        if expired:
+            logger.info(f"Vencieron {len(expired)} faltantes de {self.path}")
+            self.dirty = True
+
+    def save(self) -> bool:
+        """Descripcion: Escribe todos los cambios de la corrida de una vez (archivo temporal + rename)
+        Returns: devuelve True si había cambios para escribir"""
+        if not self.dirty:
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": VERSION, "missing": self.entries}, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        return True
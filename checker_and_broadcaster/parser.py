@@ -1,11 +1,21 @@
 import requests
 import yaml
-import json
 import logging
 import pandas as pd
 import os
-from checker_and_broadcaster import utils
+import copy
+import shutil
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from checker_and_broadcaster import distribution_processor as dp
+from checker_and_broadcaster import state as st
+from checker_and_broadcaster import history
+from checker_and_broadcaster import sql_state
+from checker_and_broadcaster import stages
+from checker_and_broadcaster import catalog_stream
+from checker_and_broadcaster import missings
+from checker_and_broadcaster import metrics as run_metrics
 from dotenv import load_dotenv
 import handler_subscriber.models as mod
 from sqlalchemy import create_engine
@@ -14,29 +24,217 @@ from sqlalchemy.orm import sessionmaker
 load_dotenv()
 bot_token = os.getenv("BOT_TOKEN")
 database_url = os.getenv("DATABASE_URL")
+distribution_engine = os.getenv("DISTRIBUTION_ENGINE", "threads")
+estimate_threshold = os.getenv("ESTIMATE_THRESHOLD_BYTES")
+incremental_harvest = os.getenv("CKAN_INCREMENTAL", "").lower() in ("1", "true", "si")
+checkpoint_every = int(os.getenv("STATE_CHECKPOINT_EVERY", "10"))
+state_backend = os.getenv("STATE_BACKEND", "json")
+# corridas que se conservan en las tablas catalogo_* con el backend sql
+state_keep_runs = int(os.getenv("STATE_KEEP_RUNS", "10"))
+# corridas que se conservan en assets/runs (0: todas); se puede cambiar con --keep-runs
+keep_runs = int(os.getenv("KEEP_RUNS", "10"))
+# días que un dataset puede faltar del portal antes de que, si vuelve, se lo anuncie como nuevo (0: nunca vence)
+missings_ttl_days = int(os.getenv("MISSINGS_TTL_DAYS", "365"))
+# textfile para el collector de node_exporter; por defecto assets/metrics.prom
+metrics_textfile = os.getenv("METRICS_TEXTFILE")
 logger = logging.getLogger(__name__)
 
+# CKAN_BASE_URL permite apuntar el parser a otro portal o a un servidor local de pruebas
+ckan_base_url = os.getenv("CKAN_BASE_URL", "https://datos.gob.ar").rstrip("/")
+CKAN_PACKAGE_SEARCH = f"{ckan_base_url}/api/3/action/package_search"
+DATASET_BASE_URL = f"{ckan_base_url}/dataset/"
+CKAN_PAGE_SIZE = 1000
+CKAN_HARVEST_WORKERS = 4
+HARVEST_MARGIN = timedelta(minutes=10)
+
 class Parser:
-   def __init__(self,db_engine,session_class):
+   def __init__(self,db_engine,session_class,run_id=None,start="harvest",end="diff",persistance_directory=None,
+                profiler=None,keep_runs=keep_runs):
+      """Descripcion: El trabajo del parser se divide en etapas (harvest, count, diff, dump) cuyas salidas
+      quedan cacheadas en assets/runs/<run_id>. Por defecto se ejecutan harvest, count y diff como antes;
+      con run_id y start se re-ejecuta una corrida a partir de la salida cacheada de la etapa anterior.
+      Re-ejecutar etapas que ya tienen salida cacheada es un replay: parte de los faltantes guardados en el
+      cache de harvest y escribe faltantes, dumps, estado y métricas en el directorio de la corrida, sin tocar
+      los archivos vigentes. Retomar una corrida que no terminó sigue escribiendo en los vigentes.
+      Al terminar bien se borran las corridas cacheadas más viejas que las últimas keep_runs"""
       self.db_engine = db_engine
       self.db_session = session_class()
       base_dir = os.path.dirname(os.path.abspath(__file__))
-      self.persistance_directory = os.path.join(base_dir, "..", "assets")
+      self.persistance_directory = persistance_directory or os.path.join(base_dir, "..", "assets")
       os.makedirs(self.persistance_directory, exist_ok=True)
+      self.run_id = run_id or stages.new_run_id()
+      self.stage_cache = stages.StageCache(os.path.join(self.persistance_directory, "runs"), self.run_id)
+      self.keep_runs = keep_runs
+      # handler_subscriber.profiling.Profiler opcional: cada etapa medida también se perfila
+      self._init_runtime_state(
+         state_store=sql_state.SqlStateStore(db_engine, state_keep_runs) if state_backend == "sql" else None,
+         metrics=run_metrics.RunMetrics(self.run_id), profiler=profiler)
+      self.replay = any(self.stage_cache.has(stage) for stage in stages.stage_range(start, end))
+      self.colnames_ds_events = ["dataset_id", "dataset_title", "temas_alias", "nodo_alias", "maintainer", "url",
+                                 "event_type"]
+      self.colnames_dist_events = ["distribution_id", "distribution_name"] + self.colnames_ds_events
+      self.previous_state = None
+      self.current_state = None
+      self.dataset_events = None
+      self.distribution_events = None
+      self.datapoint_events = None
+      self.run(start, end)
+
+   def _init_runtime_state(self, state_store=None, metrics=None, profiler=None):
+      """Descripcion: Inicializa el estado de la corrida que no sale de los archivos ni de la red: el backend sql,
+      las métricas, el profiler y los caches de faltantes e índices. Los parsers armados a mano (tests y
+      benchmarks) que no pasan por __init__ lo llaman directamente"""
+      self.state_store = state_store
+      self.metrics = metrics
+      self.profiler = profiler
+      self.replay = False
+      self.previous_run = None
+      self.previous_history_run = None
+      self.current_run = None
+      self.connection_errors = None
+      self.estimated_distributions = set()
+      self._missings_stores = {}
+      self._missings_snapshot = {}
+      self._distribution_indexes = {}
+
+   @property
+   def output_directory(self):
+      """Directorio donde la corrida escribe faltantes, dumps y estado: el de la corrida en un replay"""
+      return self.stage_cache.run_directory if self.replay else self.persistance_directory
+
+   def run(self, start="harvest", end="diff"):
+      """Descripcion: Ejecuta las etapas entre start y end. Si no se arranca desde harvest, primero se
+      restauran las salidas cacheadas de todas las etapas anteriores de la misma corrida"""
+      selected = stages.stage_range(start, end)
+      try:
+         for stage in stages.STAGES[:stages.STAGES.index(start)]:
+            getattr(self, f"_restore_{stage}")(self.stage_cache.load(stage))
+         for stage in selected:
+            logger.info(f"Corrida {self.run_id}: etapa {stage}")
+            with self._timed(stage):
+               payload = getattr(self, f"_stage_{stage}")()
+            if payload is not None:
+               self.stage_cache.save(stage, payload)
+      except Exception:
+         # si una etapa falla el parser nunca llega a checker_main: las métricas de la falla se escriben acá
+         self.metrics.finish(success=False)
+         try:
+            self.export_metrics()
+         except Exception as e:
+            logger.error(f"No se pudieron escribir las métricas de la corrida fallida: {e}")
+         raise
+      self.export_metrics()
+      removed = stages.StageCache.prune(self.stage_cache.directory, self.keep_runs, current=self.run_id)
+      if removed:
+         logger.info(f"Se borraron {len(removed)} corridas cacheadas viejas")
+
+   def _timed(self, name):
+      """Descripcion: Mide el bloque como una etapa de las métricas de la corrida y del profiler, si los hay
+      Returns: devuelve un context manager"""
+      timers = contextlib.ExitStack()
+      if self.metrics:
+         timers.enter_context(self.metrics.timer(name))
+      if self.profiler:
+         timers.enter_context(self.profiler.stage(name))
+      return timers
+
+   def export_metrics(self):
+      """Descripcion: Escribe las métricas de la corrida como textfile de Prometheus y como resumen json en el
+      directorio de la corrida"""
+      for kind, events, key in (("nuevo_dataset", self.dataset_events, "dataset_id"),
+                                ("nueva_distribucion", self.distribution_events, "distribution_id"),
+                                ("nuevo_datapoint", self.datapoint_events, "distribution_id")):
+         self.metrics.set_events(kind, events, key)
+      self.metrics.write_json(os.path.join(self.stage_cache.run_directory, "metrics.json"))
+      if self.replay:
+         self.metrics.write_prometheus(os.path.join(self.output_directory, "metrics.prom"))
+      else:
+         self.metrics.write_prometheus(metrics_textfile or os.path.join(self.persistance_directory, "metrics.prom"))
+
+   def _stage_harvest(self):
+      """Descripcion: Lee suscripciones, faltantes y el estado previo y cosecha el catálogo actual sin tamaños
+      Returns: devuelve la salida a cachear"""
       self.missing_dataset_ids = self._get_missing_ids("missings.json")
       self.missing_dataset_titles = self._get_missing_titles("missings.json")
       self.missing_distri_ids = self._get_missing_ids("missings_distri.json")
       self.missing_distri_titles = self._get_missing_titles("missings_distri.json")
-      self.connection_errors = None
       self.parseable_datasets = self._fetch_datasets_to_parse()
-      self.previous_state = self._get_previous_state()
-      self.current_state = self._get_current_state()
-      self.colnames_ds_events = ["dataset_id", "dataset_title", "temas_alias", "nodo_alias", "maintainer", "url",
-                                 "event_type"]
-      self.colnames_dist_events = ["distribution_id", "distribution_name"] + self.colnames_ds_events
-      self.dataset_events = self._get_dataset_events()
-      self.distribution_events = self._get_distribution_events()
-      self.datapoint_events = self._get_datapoint_events()
+      self.previous_run = self.state_store.last_run() if self.state_store else None
+      with self._timed("harvest_previous_state"):
+         self.previous_state = self._get_previous_state()
+         self.previous_history_run = self._previous_history_run()
+      with self._timed("harvest_catalog"):
+         self.current_state = self._get_current_state()
+      # el estado previo no se copia: se referencia por su corrida en la base o en el historial. Los faltantes
+      # sí se copian como estaban al cosechar, para que un replay del diff no dependa de los archivos vigentes
+      return {"missings": {path: self._missings(path).entries for path in ("missings.json", "missings_distri.json")},
+              "parseable_datasets": self.parseable_datasets,
+              "previous_run": self.previous_run,
+              "previous_history_run": self.previous_history_run,
+              "current_state": self.current_state}
+
+   def _restore_harvest(self, payload):
+      self._missings_snapshot = payload["missings"]
+      self.missing_dataset_ids = self._get_missing_ids("missings.json")
+      self.missing_dataset_titles = self._get_missing_titles("missings.json")
+      self.missing_distri_ids = self._get_missing_ids("missings_distri.json")
+      self.missing_distri_titles = self._get_missing_titles("missings_distri.json")
+      self.parseable_datasets = payload["parseable_datasets"]
+      self.previous_run = payload["previous_run"]
+      self.previous_history_run = payload["previous_history_run"]
+      self.previous_state = self._load_previous_state_ref()
+      self.current_state = payload["current_state"]
+
+   def _stage_count(self):
+      """Descripcion: Calcula el tamaño de las distribuciones de los datasets con suscriptores
+      Returns: devuelve la salida a cachear"""
+      self._count_distributions()
+      if self.state_store is None:
+         self.current_run = None
+      elif self.replay and self.stage_cache.has("count"):
+         # un replay no registra otra corrida: pasaría a ser la anterior de la próxima corrida real
+         self.current_run = self.stage_cache.load("count")["current_run"]
+      else:
+         self.current_run = self.state_store.save_run(self.current_state, self.estimated_distributions)
+      return {"current_state": self.current_state,
+              "estimated_distributions": sorted(self.estimated_distributions),
+              "connection_errors": stages.frame_to_records(self.connection_errors),
+              "current_run": self.current_run}
+
+   def _restore_count(self, payload):
+      self.current_state = payload["current_state"]
+      self.estimated_distributions = set(payload["estimated_distributions"])
+      self.connection_errors = stages.records_to_frame(payload["connection_errors"])
+      self.current_run = payload["current_run"]
+
+   def _stage_diff(self):
+      """Descripcion: Compara el estado previo con el actual y arma los eventos
+      Returns: devuelve la salida a cachear"""
+      with self._timed("diff_dataset_events"):
+         self.dataset_events = self._get_dataset_events()
+      with self._timed("diff_distribution_events"):
+         self.distribution_events = self._get_distribution_events()
+      with self._timed("diff_datapoint_events"):
+         self.datapoint_events = self._get_datapoint_events()
+      self.save_missings()
+      return {"dataset_events": stages.frame_to_records(self.dataset_events),
+              "distribution_events": stages.frame_to_records(self.distribution_events),
+              "datapoint_events": stages.frame_to_records(self.datapoint_events)}
+
+   def _restore_diff(self, payload):
+      self.dataset_events = stages.records_to_frame(payload["dataset_events"])
+      self.distribution_events = stages.records_to_frame(payload["distribution_events"])
+      self.datapoint_events = stages.records_to_frame(payload["datapoint_events"])
+
+   def _stage_dump(self):
+      """Descripcion: Escribe los yaml de temas, nodos y datasets, el reporte de errores y el estado actual
+      Returns: devuelve la marca de corrida terminada"""
+      for name, dump in (("nodes", self.dump_current_nodes), ("themes", self.dump_current_themes),
+                         ("datasets", self.dump_current_datasets), ("error_report", self.dump_error_report),
+                         ("state", self.save_current_state)):
+         with self._timed(f"dump_{name}"):
+            dump()
+      return {"dumped_at": datetime.now(timezone.utc).isoformat()}
 
    def _fetch_datasets_to_parse(self):
       try:
@@ -51,176 +249,282 @@ class Parser:
           logger.error("No se pudo conectar con la tabla SuscripcionDataset para buscar datasets a parsear")
           return []
 
-   def _get_missing_ids(self,path):
-      try:
-         missing_path = os.path.join(self.persistance_directory,path)
-         missing = utils.read_json(missing_path)
-         missing_ids = list(missing.keys())
-         return missing_ids
-      except:
-         return []
-
-   def _get_missing_titles(self,path):
-      try:
-         missing_path = os.path.join(self.persistance_directory,path)
-         missing = utils.read_json(missing_path)
-         missing_titles = list(missing.values())
-         return missing_titles
-      except:
-         return []
+   def _missings(self, path="missings.json"):
+      """Descripcion: Store de faltantes de path, leído una sola vez por corrida (las entradas vencidas se
+      descartan al leerlo). Si la corrida se restauró del cache parte del snapshot de harvest; si no, del archivo
+      vigente. Se guarda en output_directory
+      Returns: devuelve un missings.MissingsStore"""
+      stores = self._missings_stores
+      if path not in stores:
+         ttl = timedelta(days=missings_ttl_days) if missings_ttl_days else None
+         source = os.path.join(self.persistance_directory, path)
+         target = os.path.join(self.output_directory, path)
+         entries = self._missings_snapshot.get(path)
+         if entries is None and target != source:
+            entries = missings.MissingsStore(source, ttl=ttl).entries
+         stores[path] = missings.MissingsStore(target, ttl=ttl, entries=entries)
+      return stores[path]
+
+   def _get_missing_ids(self,path="missings.json"):
+      """Descripcion: Ids faltantes al empezar la corrida; es una copia, no cambia al actualizar el store"""
+      return self._missings(path).ids()
+
+   def _get_missing_titles(self,path="missings.json"):
+      """Descripcion: Títulos faltantes al empezar la corrida; es una copia, no cambia al actualizar el store"""
+      return self._missings(path).titles()
 
    def _update_missings(self, found_ids, found_titles,path):
-       missing_path = os.path.join(self.persistance_directory, path)
-       if os.path.exists(missing_path):
-           missing = utils.read_json(missing_path)
-       else:
-           missing = {}
-       final_missing = {
-           k: v for k, v in missing.items()
-           if k not in found_ids and v not in found_titles
-       }
-       utils.write_json(missing_path, final_missing)
+       self._missings(path).mark_found(found_ids, found_titles)
+
+   def save_missings(self):
+      """Descripcion: Escribe en un solo paso los cambios de la corrida en cada archivo de faltantes"""
+      for store in self._missings_stores.values():
+         store.save()
+
+   def _not_missing(self, updates):
+      """Descripcion: Filtra las filas cuyo dataset figura entre los faltantes, por id o por título, con una
+      búsqueda O(1) por fila en los conjuntos de faltantes
+      Returns: devuelve el dataframe filtrado"""
+      ids, titles = self.missing_dataset_ids, self.missing_dataset_titles
+      keep = [dataset_id not in ids and title not in titles
+              for dataset_id, title in zip(updates["dataset_id"], updates["dataset_title"])]
+      return updates.loc[keep]
 
    def _get_previous_state(self):
+         """Descripcion: Lee el estado de la corrida anterior
+         Returns: devuelve el estado o None si todavía no hay estado previo (primera corrida). Un estado que no
+         se puede leer o no respeta el esquema corta la corrida en vez de compararse como si estuviera vacío"""
+         if self.state_store is not None:
+            return self.state_store.load_state(self.previous_run)
          state_path = os.path.join(self.persistance_directory, "last_ckan_state.json")
-         state = utils.read_json(state_path)
+         state = st.load_state(state_path)
+         if isinstance(state, FileNotFoundError):
+            logger.warning(f"No hay estado previo en {state_path}: se toma como primera corrida")
+            return None
+         if isinstance(state, st.StateError):
+            logger.error(f"El estado previo no respeta el esquema: {state}")
+            raise state
+         if isinstance(state, Exception):
+            raise state
          return state
 
-   def _get_current_state(self):
-       try:
-           full_datasets = self._get_raw_state()
-           total_dist = sum(len(v["resources"]) for v in full_datasets.values())
-           ckan_state = {"total_datasets": len(full_datasets),
-                         "total_distributions": total_dist,
-                         "data": {}}
-           full_distributions = {}
-           data = ckan_state["data"]
-
-           for dataset_id, dataset_attr in full_datasets.items():
-               data[dataset_id] = {"org": {},
-                                   "temas": {},
-                                   "title": dataset_attr['title'],
-                                   "name": dataset_attr['name'],
-                                   "distributions": {}}
-
-               data[dataset_id]['org']['maintainer'] = dataset_attr['maintainer']
-               data[dataset_id]['org']['nodo_title'] = dataset_attr['organization']['title']
-               data[dataset_id]['org']['nodo_alias'] = dataset_attr['organization']['name']
-               data[dataset_id]['temas']['temas_alias'] = [
-                   g['name'] for g in dataset_attr['groups']
-               ]
-               data[dataset_id]['temas']['temas_nombres'] = [
-                   g['display_name'] for g in dataset_attr['groups']
-               ]
+   def _state_history(self):
+      return history.StateHistory(os.path.join(self.persistance_directory, "state_history.jsonl"),
+                                  checkpoint_every=checkpoint_every)
 
-               dataset_distributions = {}
-               for distribution in dataset_attr['resources']:
-                   id = distribution['id']
-                   dataset_distributions[id] = {
-                       "url": distribution['url'],
-                       "name": distribution['name'],
-                       "size": None
-                   }
-                   if dataset_id in self.parseable_datasets:
-                       full_distributions[id] = {
-                           "url": distribution['url'],
-                           "size": None
-                       }
-               data[dataset_id]['distributions'] = dataset_distributions
-
-           processor = dp.DistributionProcessor()
-           results = processor.process_distributions_concurrent(full_distributions)
-           results_df = pd.DataFrame(results, columns=["distribution_id", "url", "size", "error"])
-           errors = results_df.loc[results_df['error'].notna() & (results_df['error'] != "")]
-           print(len(errors))
-           self.connection_errors = errors
-
-
-           for dataset_attr in ckan_state['data'].values():
-               for distribution_id, distribution_attr in dataset_attr['distributions'].items():
-                   # Filtrar resultados para esta distribución
-                   mask = results_df["distribution_id"] == distribution_id
-                   matching_rows = results_df[mask]
-
-                   if len(matching_rows) == 0:
-                       distribution_attr['size'] = None
-                       continue
-
-                   size_value = matching_rows.iloc[0]['size']
-
-
-                   if hasattr(size_value, 'item'):
-                       try:
-                           distribution_attr['size'] = size_value.item()
-                       except:
-                           distribution_attr['size'] = float(size_value) if size_value is not None else None
-                   elif pd.isna(size_value):
-                       distribution_attr['size'] = None
-                   else:
-                       distribution_attr['size'] = float(size_value) if size_value is not None else None
+   def _previous_history_run(self):
+      """Descripcion: Corrida del historial que guarda el estado previo, para que el cache de harvest lo referencie
+      en vez de copiarlo. last_ckan_state.json y el historial se escriben juntos al terminar cada corrida; si el
+      historial todavía no existe se lo inicia con el estado previo
+      Returns: devuelve el número de corrida o None si no hay estado previo o se usa el backend sql"""
+      if self.state_store is not None or self.previous_state is None:
+         return None
+      state_history = self._state_history()
+      if self.replay:
+         return state_history.last_run() or None
+      return state_history.last_run() or state_history.append(self.previous_state)
+
+   def _load_previous_state_ref(self):
+      """Descripcion: Recupera el estado previo referenciado por el cache de harvest
+      Returns: devuelve el estado o None si la corrida no tenía estado previo"""
+      if self.previous_history_run is not None:
+         state = self._state_history().state_at(self.previous_history_run)
+         if state is None:
+            raise stages.StageError(f"El historial no tiene la corrida {self.previous_history_run}")
+         return st.validate(state)
+      if self.state_store is not None and self.previous_run is not None:
+         return self.state_store.load_state(self.previous_run)
+      return None
+
+   @staticmethod
+   def _project_package(dataset_attr):
+      """Descripcion: Se queda sólo con los campos de un paquete de la API que usa el estado
+      Returns: devuelve el paquete reducido"""
+      return {"id": dataset_attr['id'],
+              "title": dataset_attr['title'],
+              "name": dataset_attr['name'],
+              "maintainer": dataset_attr['maintainer'],
+              "organization": {"title": dataset_attr['organization']['title'],
+                               "name": dataset_attr['organization']['name']},
+              "groups": [{"name": g['name'], "display_name": g['display_name']} for g in dataset_attr['groups']],
+              "resources": [{"id": r['id'], "url": r['url'], "name": r['name']} for r in dataset_attr['resources']]}
+
+   def _build_dataset_entry(self, dataset_attr):
+       """Arma la entrada del estado de un dataset a partir de un paquete de la API"""
+       return {"org": {"maintainer": dataset_attr['maintainer'],
+                       "nodo_title": dataset_attr['organization']['title'],
+                       "nodo_alias": dataset_attr['organization']['name']},
+               "temas": {"temas_alias": [g['name'] for g in dataset_attr['groups']],
+                         "temas_nombres": [g['display_name'] for g in dataset_attr['groups']]},
+               "title": dataset_attr['title'],
+               "name": dataset_attr['name'],
+               "distributions": {
+                   distribution['id']: {"url": distribution['url'],
+                                        "name": distribution['name'],
+                                        "size": None}
+                   for distribution in dataset_attr['resources']
+               }}
 
+   def _get_current_state(self):
+       try:
+           harvested_at = datetime.now(timezone.utc).isoformat()
+           data = None
+           previous = self.previous_state or {}
+           since = previous.get("harvested_at")
+           if incremental_harvest and since:
+               data = self._get_incremental_data(since)
+           if data is None:
+               data = self._get_raw_state(project=self._build_dataset_entry)
+
+           ckan_state = {"total_datasets": len(data),
+                         "total_distributions": sum(len(v["distributions"]) for v in data.values()),
+                         "harvested_at": harvested_at,
+                         "data": data}
            return ckan_state
        except Exception as e:
            raise e
 
+   def _count_distributions(self):
+       """Descripcion: Calcula el tamaño de las distribuciones de los datasets a parsear y lo escribe en el
+       estado actual a medida que llega cada resultado. Los errores quedan en connection_errors"""
+       data = self.current_state["data"]
+       parseable_datasets = set(self.parseable_datasets)
+       full_distributions = {
+           distribution_id: {"url": distribution['url'], "size": None}
+           for dataset_id, dataset in data.items() if dataset_id in parseable_datasets
+           for distribution_id, distribution in dataset['distributions'].items()
+       }
+
+       # índice distribución -> entrada del estado, para escribir cada tamaño apenas se calcula
+       distribution_index = {}
+       for dataset in data.values():
+           for distribution_id, distribution in dataset['distributions'].items():
+               distribution['size'] = None
+               distribution_index[distribution_id] = distribution
+       errors = []
+
+       def merge_result(result):
+           distribution_id, _, size, error = result
+           distribution = distribution_index.get(distribution_id)
+           if distribution is not None:
+               distribution['size'] = float(size) if size is not None else None
+           if error:
+               errors.append(result)
+
+       cache_path = os.path.join(self.output_directory, "distribution_cache.json")
+       live_cache_path = os.path.join(self.persistance_directory, "distribution_cache.json")
+       if self.replay and not os.path.exists(cache_path) and os.path.exists(live_cache_path):
+           # el replay revalida contra una copia del cache vivo sin modificarlo
+           shutil.copyfile(live_cache_path, cache_path)
+       # los resultados se escriben en el diario de la corrida: re-ejecutar la etapa count de la misma
+       # corrida retoma el crawl en vez de empezarlo de cero
+       journal_path = os.path.join(self.stage_cache.run_directory, "count_journal.jsonl")
+       processor = dp.DistributionProcessor(
+           cache_path=cache_path, engine=distribution_engine,
+           estimate_threshold=int(estimate_threshold) if estimate_threshold else None,
+           journal_path=journal_path, metrics=self.metrics)
+       processor.process_distributions_concurrent(full_distributions, on_result=merge_result)
+       self.estimated_distributions = processor.estimated
+       logger.info(f"{len(errors)} distribuciones con error")
+       self.connection_errors = pd.DataFrame(errors, columns=["distribution_id", "url", "size", "error"])
+
+   def _dataset_changes(self):
+      """Descripcion: Busca en memoria los datasets nuevos y los que desaparecieron entre el estado anterior y
+      el actual
+      Returns: devuelve (dataframe de datasets nuevos, {dataset_id: title} de ausentes)"""
+      prev_data = self.previous_state.get('data', {})
+      curr_data = self.current_state.get('data', {})
+      new_datasets = curr_data.keys() - prev_data.keys()
+      absent_datasets = prev_data.keys() - curr_data.keys()
+      rows = []
+      base_url = DATASET_BASE_URL
+      for element in new_datasets:
+         dataset = curr_data.get(element, {})
+         rows.append({
+            "dataset_id": element,
+            "dataset_title": dataset.get("title"),
+            "temas_alias": dataset.get("temas", {}).get("temas_alias"),
+            "nodo_alias": dataset.get("org", {}).get("nodo_alias"),
+            "maintainer": dataset.get("org", {}).get("maintainer"),
+            "url": base_url + dataset["name"] if isinstance(dataset.get("name"), str) else None,
+            "event_type": "nuevo_dataset"
+         })
+      absent = {element: prev_data.get(element, {}).get("title") for element in absent_datasets}
+      return pd.DataFrame(rows, columns=self.colnames_ds_events), absent
+
    def _get_dataset_events(self):
       """Descripcion: Compara el estado anterior y el actual y busca datasets nuevos que no esten
-      en missings (datasets que estaban faltantes temporalmente)
+      en missings (datasets que estaban faltantes temporalmente). Con el backend sql la comparación
+      se resuelve en la base
         Returns: devuelve un dataframe de pandas o None """
       final_updates = None
       if self.previous_state and self.current_state:
-            prev_datasets = list(self.previous_state.get('data', {}).keys())
-            curr_datasets = list(self.current_state.get('data', {}).keys())
-            new_datasets = list(set(curr_datasets) - set(prev_datasets))
-            absent_datasets = list(set(prev_datasets)-set(curr_datasets))
-
-            if len(new_datasets)>0:
-               rows = []
-               base_url = "https://datos.gob.ar/dataset/"
-               curr_data = self.current_state.get("data", {})
-               for element in new_datasets:
-                  dataset = curr_data.get(element, {})
-                  rows.append({
-                     "dataset_id": element,
-                     "dataset_title": dataset.get("title"),
-                     "temas_alias": dataset.get("temas", {}).get("temas_alias"),
-                     "nodo_alias": dataset.get("org", {}).get("nodo_alias"),
-                     "maintainer": dataset.get("org", {}).get("maintainer"),
-                     "url": base_url + dataset["name"] if isinstance(dataset.get("name"), str) else None,
-                     "event_type": "nuevo_dataset"
-                  })
-
-               dataset_updates = pd.DataFrame(rows, columns=self.colnames_ds_events)
-
-               filt_updates_a = dataset_updates.loc[
-                  ~dataset_updates["dataset_id"].isin(self.missing_dataset_ids)
-               ]
-               filt_updates_b = filt_updates_a.loc[
-                  ~filt_updates_a["dataset_title"].isin(self.missing_dataset_titles)
-               ]
-               final_updates = filt_updates_b.explode("temas_alias", ignore_index=True)
+            store = self.state_store
+            if store is not None:
+               dataset_updates, absent_datasets = store.dataset_changes(self.previous_run, self.current_run,
+                                                                      DATASET_BASE_URL)
+               dataset_updates = dataset_updates[self.colnames_ds_events]
+            else:
+               dataset_updates, absent_datasets = self._dataset_changes()
+
+            if len(dataset_updates)>0:
+               final_updates = self._not_missing(dataset_updates).explode("temas_alias", ignore_index=True)
                found_ids = set(dataset_updates["dataset_id"].tolist())
                found_titles = set(dataset_updates["dataset_title"].tolist())
 
                self._update_missings(found_ids, found_titles,"missings.json")
 
-
-            if len(absent_datasets)>0:
-               diff_datasets = list(set(prev_datasets) - set(curr_datasets))
-               prev_data = self.previous_state.get("data", {})
-               missing_path = os.path.join(self.persistance_directory, "missings.json")
-               os.makedirs(os.path.dirname(missing_path), exist_ok=True)
-               if not os.path.exists(missing_path):
-                   c_missings = {}
-               else:
-                   c_missings = utils.read_json(missing_path)
-
-               for element in diff_datasets:
-                   dataset = prev_data.get(element, {})
-                   c_missings[element] = dataset.get("title")
-               utils.write_json(missing_path, c_missings)
+            # los cambios quedan en memoria y se escriben juntos al terminar el diff (save_missings)
+            store = self._missings("missings.json")
+            store.mark_missing(absent_datasets)
+            store.refresh(self.current_state.get("data", {}))
       return final_updates
 
+   def _get_distribution_index(self, state):
+      """Descripcion: Índice distribution_id -> dataset_id de un estado, armado en una sola pasada y
+      reutilizado por todos los métodos que comparan estados
+      Returns: devuelve un diccionario (vacío si el estado no es válido)"""
+      cached = self._distribution_indexes.get(id(state))
+      if cached is not None and cached[0] is state:
+         return cached[1]
+      index = {}
+      if isinstance(state, dict):
+         for dataset_id, dataset_info in state.get('data', {}).items():
+            for dist_id in dataset_info.get('distributions', {}):
+               index[dist_id] = dataset_id
+      self._distribution_indexes[id(state)] = (state, index)
+      return index
+
+   def _distribution_changes(self):
+      """Descripcion: Busca en memoria las distribuciones nuevas y las que desaparecieron entre el estado
+      anterior y el actual
+      Returns: devuelve (dataframe de distribuciones nuevas, {distribution_id: name} de ausentes)"""
+      prev_index = self._get_distribution_index(self.previous_state)
+      curr_index = self._get_distribution_index(self.current_state)
+      new_distributions = curr_index.keys() - prev_index.keys()
+      absent_distri = prev_index.keys() - curr_index.keys()
+      rows = []
+      curr_data = self.current_state.get("data", {})
+      for dist_id in new_distributions:
+         dataset_id = curr_index[dist_id]
+         dataset_info = curr_data[dataset_id]
+         dist_info = dataset_info['distributions'][dist_id]
+         rows.append({
+            "distribution_id": dist_id,
+            "distribution_name": dist_info['name'],
+            "dataset_id": dataset_id,
+            "dataset_title": dataset_info['title'],
+            "temas_alias": dataset_info['temas']['temas_alias'],
+            "nodo_alias": dataset_info['org']['nodo_alias'],
+            "maintainer": dataset_info['org']['maintainer'],
+            "url": dist_info['url'],
+            "event_type": "nueva_distribucion"
+         })
+      prev_data = self.previous_state.get("data", {})
+      absent = {dist_id: prev_data[prev_index[dist_id]]['distributions'][dist_id].get("name")
+                for dist_id in absent_distri}
+      return pd.DataFrame(rows, columns=self.colnames_dist_events), absent
+
    def _get_distribution_events(self):
       """Descripcion: Compara el estado anterior y el actual y busca distribuciones nuevas siempre
       y cuando estas no sean parte de datasets nuevos o no sean parte de datasets que reaparecieron
@@ -228,167 +532,164 @@ class Parser:
       Returns: devuelve un dataframe de pandas o None """
       final_dist_updates = None
       if self.previous_state and self.current_state:
-
-            prev_distributions = [
-               element
-               for _, v in self.previous_state.get('data').items()
-               for element in v['distributions']
-            ]
-            curr_distributions = [
-               element
-               for _, v in self.current_state.get('data').items()
-               for element in v['distributions']
-            ]
-
-            new_distributions = list(set(curr_distributions) - set(prev_distributions))
-            absent_distri = list(set(prev_distributions)-set(curr_distributions))
-
-            if len(new_distributions)>0:
-               rows = []
-               curr_data = self.current_state.get("data", {})
-
-               for element in new_distributions:
-                  for dataset_id, dataset_info in curr_data.items():
-                     for dist_id, dist_info in dataset_info.get('distributions', {}).items():
-                        if dist_id == element:
-                           rows.append({
-                              "distribution_id": dist_id,
-                              "distribution_name": dist_info['name'],
-                              "dataset_id": dataset_id,
-                              "dataset_title": dataset_info['title'],
-                              "temas_alias": dataset_info['temas']['temas_alias'],
-                              "nodo_alias": dataset_info['org']['nodo_alias'],
-                              "maintainer": dataset_info['org']['maintainer'],
-                              "url": dist_info['url'],
-                              "event_type": "nueva_distribucion"
-                           })
+            store = self.state_store
+            if store is not None:
+               distribution_updates, absent_distri = store.distribution_changes(self.previous_run,
+                                                                                self.current_run)
+               distribution_updates = distribution_updates[self.colnames_dist_events]
+            else:
+               distribution_updates, absent_distri = self._distribution_changes()
+
+            if len(distribution_updates)>0:
+               found_ids = set(distribution_updates['distribution_id'].tolist())
                new_datasets = (
                   self.dataset_events['dataset_id'].unique().tolist()
                   if isinstance(self.dataset_events, pd.DataFrame) and len(self.dataset_events) > 0
                   else []
                )
-               distribution_updates = pd.DataFrame(rows, columns=self.colnames_dist_events)
                distribution_updates = distribution_updates[
                   ~distribution_updates['dataset_id'].isin(new_datasets)
                ]
-               distribution_updates = distribution_updates[
-                  ~distribution_updates['dataset_id'].isin(self.missing_dataset_ids)
-               ]
-               distribution_updates = distribution_updates[
-                  ~distribution_updates['dataset_title'].isin(self.missing_dataset_titles)
-               ]
+               distribution_updates = self._not_missing(distribution_updates)
 
                final_dist_updates = distribution_updates.explode("temas_alias", ignore_index=True)
+               self._update_missings(found_ids, (), "missings_distri.json")
 
-
-            if len(absent_distri)>0:
-
-
-
+            store = self._missings("missings_distri.json")
+            store.mark_missing(absent_distri)
+            store.refresh(self._get_distribution_index(self.current_state))
 
       return final_dist_updates
 
-   def _get_raw_state(self):
-      """Esta función se conecta con datos.gob.ar y devuelve un diccionario con información de todos los datasets
-      si la conexión fue existosa y si no un diccionario vacio"""
-      urls = [
-         "https://datos.gob.ar/api/3/action/package_search?rows=1000",
-         "https://datos.gob.ar/api/3/action/package_search?rows=1000&start=1000"
-      ]
+   def _fetch_package_page(self, session, start, fq=None, project=None, flat_fields=None):
+      """Descarga una página de package_search; fq filtra los paquetes. fl= sólo se manda con flat_fields: CKAN lo
+      resuelve contra Solr y devuelve los campos aplanados (sin resources ni organization anidados), así que sirve
+      para campos simples como id y no para proyectar el paquete. La respuesta se decodifica en streaming: cada paquete pasa por project apenas se lee y el paquete crudo se descarta, así nunca está la
+      página entera en memoria
+      Returns: diccionario {"count", "results"} con los paquetes ya proyectados"""
+      params = {"rows": CKAN_PAGE_SIZE, "start": start}
+      if flat_fields:
+         params["fl"] = ",".join(flat_fields)
+      if fq:
+         params["fq"] = fq
+      with session.get(CKAN_PACKAGE_SEARCH, params=params, timeout=60, stream=True) as response:
+         response.raise_for_status()
+         reader = catalog_stream.PackageSearchReader(
+            response.iter_content(chunk_size=catalog_stream.CHUNK_SIZE))
+         results = [project(package) if project else package for package in reader]
+      return {"count": reader.count, "results": results}
+
+   def _fetch_all_pages(self, session, fq=None, project=None, flat_fields=None):
+      """Lee count de la primera página y descarga el resto de las páginas en paralelo.
+      Returns: lista de páginas (listas de paquetes proyectados) en el orden de la API"""
+      first_page = self._fetch_package_page(session, 0, fq, project, flat_fields)
+      starts = range(CKAN_PAGE_SIZE, first_page['count'], CKAN_PAGE_SIZE)
+      with ThreadPoolExecutor(max_workers=CKAN_HARVEST_WORKERS) as executor:
+         pages = executor.map(
+            lambda start: self._fetch_package_page(session, start, fq, project, flat_fields)['results'], starts)
+         return [first_page['results'], *pages]
+
+   def _get_raw_state(self, fq=None, project=None):
+      """Esta función se conecta con el portal (datos.gob.ar por defecto) y devuelve un diccionario con información de todos los datasets
+      (o de los que cumplen fq), por id. Descarga las páginas en paralelo y reduce cada paquete con project (por defecto
+      _project_package, que conserva sólo los campos que usa _get_current_state) mientras se lee la respuesta, así que con
+      project=_build_dataset_entry se obtienen directamente las entradas del estado"""
+      project = project or self._project_package
+
+      def with_id(dataset_attr):
+         return dataset_attr['id'], project(dataset_attr)
 
       try:
-         full_datasets = {
-            dataset['id']: {k: v for k, v in dataset.items()}
-            for url in urls
-            for dataset in requests.get(url).json()['result']['results']
-         }
-         return full_datasets
+         with requests.Session() as session:
+            results = self._fetch_all_pages(session, fq, with_id)
+
+         return {dataset_id: entry for page in results for dataset_id, entry in page}
       except Exception as e:
          raise e
 
+   def _get_current_ids(self):
+      """Listado liviano (sólo id) de todos los datasets publicados, en el orden de la API"""
+      with requests.Session() as session:
+         pages = self._fetch_all_pages(session, project=lambda dataset_attr: dataset_attr['id'], flat_fields=["id"])
+      return [dataset_id for page in pages for dataset_id in page]
+
+   def _get_incremental_data(self, since):
+      """Descripcion: Cosecha incremental. Descarga completos sólo los paquetes con metadata_modified posterior a
+      since (con un margen por demoras de indexación) y arma el resto a partir del estado anterior. El listado de
+      ids detecta los datasets dados de baja
+      Returns: el diccionario data del estado o None si hay que hacer una cosecha completa"""
+      since = datetime.fromisoformat(since) - HARVEST_MARGIN
+      fq = f"metadata_modified:[{since.strftime('%Y-%m-%dT%H:%M:%SZ')} TO *]"
+      changed = self._get_raw_state(fq=fq, project=self._build_dataset_entry)
+      current_ids = self._get_current_ids()
+      prev_data = self.previous_state.get('data', {})
+
+      data = {}
+      for dataset_id in current_ids:
+         if dataset_id in changed:
+            data[dataset_id] = changed[dataset_id]
+         elif dataset_id in prev_data:
+            data[dataset_id] = copy.deepcopy(prev_data[dataset_id])
+         else:
+            # un dataset que no está en el estado anterior ni en los modificados: se cosecha todo
+            logger.warning(f"{dataset_id} no está en el estado anterior, se hace una cosecha completa")
+            return None
+      logger.info(f"Cosecha incremental: {len(changed)} datasets modificados de {len(current_ids)}")
+      return data
+
+   def _get_size_series(self, state):
+      """Descripcion: Aplana un estado en una serie de tamaños indexada por distribution_id. Los tamaños que
+      no son numéricos quedan como NaN
+      Returns: devuelve una serie de pandas de floats"""
+      ids = []
+      sizes = []
+      for dataset_info in state.get('data', {}).values():
+         for dist_id, dist_info in dataset_info.get('distributions', {}).items():
+            ids.append(dist_id)
+            sizes.append(dist_info.get('size'))
+      series = pd.to_numeric(pd.Series(sizes, index=ids, dtype=object), errors='coerce')
+      return series[~series.index.duplicated(keep='last')]
+
    def _get_datapoint_events(self):
       """Descripcion: Compara el tamaño de estado previo contra el estado actual. Si la distribución
-      no estaba en el estado previo(es nueva) o si su tamaño era None, no es incorporada en los datapoint events
+      no estaba en el estado previo(es nueva) o si su tamaño era None, no es incorporada en los datapoint events.
+      La comparación se hace de una vez sobre las series de tamaños alineadas por distribution_id y sólo se arman
+      filas para las distribuciones que crecieron. La columna estimated marca los aumentos calculados sobre un
+      tamaño estimado y no contado
       Returns: devuelve un dataframe de pandas o None """
+      store = self.state_store
+      if store is not None and self.previous_state and self.current_state:
+         grown = store.grown_distributions(self.previous_run, self.current_run)
+         return grown[self.colnames_dist_events + ["estimated"]] if len(grown) > 0 else None
       if self.previous_state and self.current_state:
-         prev_distributions = [
-            element
-            for _, v in self.previous_state.get('data', {}).items()
-            for element in v.get('distributions', [])
-         ]
-         curr_distributions = [
-            element
-            for _, v in self.current_state.get('data', {}).items()
-            for element in v.get('distributions', [])
-         ]
-         common_distributions = set(prev_distributions).intersection(set(curr_distributions))
-
-         def _find_distribution_info(data, dist_id):
-            """Devuelve (size, dist_info, dataset_id, dataset_info) de una distribución si existe."""
-            for dataset_id, dataset_info in data.items():
-               distributions = dataset_info.get("distributions", {})
-               if dist_id in distributions:
-                  d_info = distributions[dist_id]
-                  size = d_info.get("size")
-
-
-                  if hasattr(size, 'item'):  # Para Series/DataArray
-                     try:
-                        size = size.item()
-                     except ValueError:
-                        # Si el Series tiene más de un elemento
-                        if hasattr(size, '__len__') and len(size) == 1:
-                           size = size.iloc[0] if hasattr(size, 'iloc') else size[0]
-                        else:
-                           size = None
-                  elif hasattr(size, '__len__') and not isinstance(size, (str, bytes)):
-                     # Para arrays/listas
-                     if len(size) == 1:
-                        size = size[0]
-                     elif len(size) == 0:
-                        size = None
-
-
-                  if size is not None:
-                     try:
-
-                        size = float(size)
-                     except (ValueError, TypeError):
-
-                        size = None
-
-                  return size, d_info, dataset_id, dataset_info
-            return None, None, None, None
+         prev_sizes = self._get_size_series(self.previous_state)
+         curr_sizes = self._get_size_series(self.current_state)
+         # las distribuciones nuevas quedan con NaN y la comparación da False
+         grown = curr_sizes.index[(curr_sizes > prev_sizes.reindex(curr_sizes.index)).to_numpy()]
 
          rows = []
          curr_data = self.current_state.get("data", {})
-         prev_data = self.previous_state.get("data", {})
-
-         for dist_id in common_distributions:
-            curr_size, curr_dist_info, curr_dataset_id, curr_dataset_info = _find_distribution_info(curr_data, dist_id)
-            prev_size, _, _, _ = _find_distribution_info(prev_data, dist_id)
-
-
-            if (prev_size is not None and curr_size is not None and
-                    isinstance(curr_size, (int, float)) and isinstance(prev_size, (int, float))):
-
-
-               if curr_size > prev_size:
-                  rows.append({
-                     "distribution_id": dist_id,
-                     "distribution_name": curr_dist_info.get("name", ""),
-                     "dataset_id": curr_dataset_id or "",
-                     "dataset_title": curr_dataset_info.get("title", "") if curr_dataset_info else "",
-                     "temas_alias": curr_dataset_info.get("temas", {}).get("temas_alias",
-                                                                           "") if curr_dataset_info else "",
-                     "nodo_alias": curr_dataset_info.get("org", {}).get("nodo_alias", "") if curr_dataset_info else "",
-                     "maintainer": curr_dataset_info.get("org", {}).get("maintainer", "") if curr_dataset_info else "",
-                     "url": curr_dist_info.get("url", "") if curr_dist_info else "",
-                     "event_type": "nuevo_datapoint",
-                  })
-
-
-         return pd.DataFrame(rows, columns=self.colnames_dist_events) if rows else None
+         curr_index = self._get_distribution_index(self.current_state)
+         estimated = self.estimated_distributions
+
+         for dist_id in grown:
+            dataset_id = curr_index[dist_id]
+            dataset_info = curr_data[dataset_id]
+            dist_info = dataset_info["distributions"][dist_id]
+            rows.append({
+               "distribution_id": dist_id,
+               "distribution_name": dist_info.get("name", ""),
+               "dataset_id": dataset_id,
+               "dataset_title": dataset_info.get("title", ""),
+               "temas_alias": dataset_info.get("temas", {}).get("temas_alias", ""),
+               "nodo_alias": dataset_info.get("org", {}).get("nodo_alias", ""),
+               "maintainer": dataset_info.get("org", {}).get("maintainer", ""),
+               "url": dist_info.get("url", ""),
+               "event_type": "nuevo_datapoint",
+               "estimated": dist_id in estimated,
+            })
+
+         return pd.DataFrame(rows, columns=self.colnames_dist_events + ["estimated"]) if rows else None
       else:
          logger.info("No se detectaron eventos de datapoints: falta alguno de los estados")
          return None
@@ -403,7 +704,7 @@ class Parser:
          flat_themes = [t for theme_list in superthemes for t in theme_list]
          flat_aliases = [a for alias_list in aliases for a in alias_list]
          alias_themes = dict(zip(flat_aliases, flat_themes))
-         theme_path = os.path.join(self.persistance_directory, "superthemes.yaml")
+         theme_path = os.path.join(self.output_directory, "superthemes.yaml")
          with open(theme_path, "w", encoding="utf-8") as f:
             yaml.dump(alias_themes, f, allow_unicode=True, default_flow_style=False)
       else:
@@ -416,7 +717,7 @@ class Parser:
          current_datasets = {}
          for dataset_id, dataset_atrr in self.current_state.get('data').items():
             current_datasets[dataset_id] = dataset_atrr['name']
-         dataset_path = os.path.join(self.persistance_directory, "datasets.yaml")
+         dataset_path = os.path.join(self.output_directory, "datasets.yaml")
          with open(dataset_path, "w", encoding="utf-8") as f:
             yaml.dump(current_datasets, f, sort_keys=False, allow_unicode=True)
 
@@ -431,12 +732,12 @@ class Parser:
             nodes.append(dataset_atrr['org']['nodo_title'])
             aliases.append(dataset_atrr['org']['nodo_alias'])
          nodo_alias = dict(zip(aliases,nodes))
-         nodo_path = os.path.join(self.persistance_directory, "organizations.yaml")
+         nodo_path = os.path.join(self.output_directory, "organizations.yaml")
          with open(nodo_path, "w", encoding="utf-8") as f:
             yaml.dump(nodo_alias, f, allow_unicode=True, default_flow_style=False)
 
    def dump_error_report(self):
-         error_path = os.path.join(self.persistance_directory, "error_report.csv")
+         error_path = os.path.join(self.output_directory, "error_report.csv")
          if isinstance(self.connection_errors,pd.DataFrame):
             self.connection_errors.to_csv(error_path,index=False)
          else:
@@ -445,10 +746,21 @@ class Parser:
    def save_current_state(self):
       if not self.current_state:
          return
+      elif self.state_store is not None:
+         # con el backend sql el estado ya quedó guardado en el count: recién ahora la corrida pasa a ser la
+         # anterior de la próxima. Un replay reusa una corrida que ya se marcó en su momento
+         if not self.replay and self.current_run is not None:
+            self.state_store.complete_run(self.current_run)
       else:
-         state_path = os.path.join(self.persistance_directory, "last_ckan_state.json")
-         with open(state_path, "w", encoding="utf-8") as f:
-            json.dump(self.current_state, f, sort_keys=False, ensure_ascii=False)
+         state_path = os.path.join(self.output_directory, "last_ckan_state.json")
+         st.save_state(state_path, self.current_state)
+         if not self.replay:
+            # un replay no es una corrida nueva del portal: el historial no cambia
+            state_history = self._state_history()
+            state_history.append(self.current_state)
+            if self.keep_runs:
+               # las corridas cacheadas referencian su estado previo en el historial: se conserva uno más
+               state_history.prune(self.keep_runs + 1)
 
 
    def serialize_events(self):
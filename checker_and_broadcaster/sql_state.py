@@ -0,0 +1,234 @@
+import io
+import logging
+import pandas as pd
+from sqlalchemy import delete, func, insert, select, text, update
+import handler_subscriber.models as mod
+
+logger = logging.getLogger(__name__)
+
+CATALOG_TABLES = [mod.CatalogoCorrida.__table__, mod.CatalogoDataset.__table__,
+                  mod.CatalogoDatasetTema.__table__, mod.CatalogoDistribucion.__table__]
+
+NEW_DATASETS = text("""
+    SELECT c.dataset_id, c.title AS dataset_title, t.tema_alias AS temas_alias, c.nodo_alias, c.maintainer,
+           :base_url || c.name AS url
+    FROM catalogo_datasets c
+    LEFT JOIN catalogo_datasets p ON p.run_id = :prev AND p.dataset_id = c.dataset_id
+    LEFT JOIN catalogo_dataset_temas t ON t.run_id = c.run_id AND t.dataset_id = c.dataset_id
+    WHERE c.run_id = :curr AND p.dataset_id IS NULL
+""")
+
+ABSENT_DATASETS = text("""
+    SELECT p.dataset_id, p.title
+    FROM catalogo_datasets p
+    LEFT JOIN catalogo_datasets c ON c.run_id = :curr AND c.dataset_id = p.dataset_id
+    WHERE p.run_id = :prev AND c.dataset_id IS NULL
+""")
+
+NEW_DISTRIBUTIONS = text("""
+    SELECT c.distribution_id, c.name AS distribution_name, c.dataset_id, d.title AS dataset_title,
+           t.tema_alias AS temas_alias, d.nodo_alias, d.maintainer, c.url
+    FROM catalogo_distribuciones c
+    JOIN catalogo_datasets d ON d.run_id = c.run_id AND d.dataset_id = c.dataset_id
+    LEFT JOIN catalogo_distribuciones p ON p.run_id = :prev AND p.distribution_id = c.distribution_id
+    LEFT JOIN catalogo_dataset_temas t ON t.run_id = c.run_id AND t.dataset_id = c.dataset_id
+    WHERE c.run_id = :curr AND p.distribution_id IS NULL
+""")
+
+ABSENT_DISTRIBUTIONS = text("""
+    SELECT p.distribution_id, p.name
+    FROM catalogo_distribuciones p
+    LEFT JOIN catalogo_distribuciones c ON c.run_id = :curr AND c.distribution_id = p.distribution_id
+    WHERE p.run_id = :prev AND c.distribution_id IS NULL
+""")
+
+# sólo se cuentan tamaños de datasets con suscriptores, así que el join con suscripciones_dataset
+# descarta de entrada el resto del catálogo
+GROWN_DISTRIBUTIONS = text("""
+    SELECT c.distribution_id, c.name AS distribution_name, c.dataset_id, d.title AS dataset_title,
+           t.tema_alias AS temas_alias, d.nodo_alias, d.maintainer, c.url, c.estimated
+    FROM catalogo_distribuciones c
+    JOIN catalogo_distribuciones p ON p.run_id = :prev AND p.distribution_id = c.distribution_id
+    JOIN catalogo_datasets d ON d.run_id = c.run_id AND d.dataset_id = c.dataset_id
+    LEFT JOIN catalogo_dataset_temas t ON t.run_id = c.run_id AND t.dataset_id = c.dataset_id
+    WHERE c.run_id = :curr AND c.size > p.size
+      AND c.dataset_id IN (SELECT dataset FROM suscripciones_dataset)
+""")
+
+
+def copy_csv(rows) -> io.StringIO:
+    """Descripcion: Codifica filas para COPY ... FROM STDIN WITH (FORMAT csv). El texto va siempre entre comillas
+    (con las comillas internas duplicadas), así las comas y los saltos de línea no cortan el campo y el texto
+    vacío no se confunde con NULL, que se escribe como campo vacío sin comillas
+    Returns: devuelve un buffer posicionado al principio"""
+    def field(value):
+        if value is None:
+            return ""
+        if isinstance(value, str):
+            return '"' + value.replace('"', '""') + '"'
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value)
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+class SqlStateStore:
+    """Persiste cada estado del catálogo como tablas normalizadas (datasets, temas y distribuciones con su
+    tamaño por corrida) y calcula las novedades con consultas por conjuntos en la base de suscriptores.
+    Con keep_runs sólo se conservan las últimas corridas completas (nunca menos de dos: la actual y la anterior)"""
+
+    def __init__(self, engine, keep_runs=None):
+        self.engine = engine
+        self.keep_runs = max(keep_runs, 2) if keep_runs else None
+        mod.Base.metadata.create_all(bind=engine, tables=CATALOG_TABLES + [mod.SuscripcionDataset.__table__])
+
+    def last_run(self):
+        """Descripcion: Busca la última corrida completa. Las corridas que no llegaron al dump se ignoran
+        Returns: devuelve el run_id o None si todavía no hay corridas completas"""
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.max(mod.CatalogoCorrida.run_id))
+                                .where(mod.CatalogoCorrida.completa)).scalar()
+
+    def complete_run(self, run_id):
+        """Descripcion: Marca una corrida como completa, a partir de lo cual pasa a ser la última corrida, y
+        aplica la retención de corridas"""
+        corridas = mod.CatalogoCorrida.__table__
+        with self.engine.begin() as conn:
+            conn.execute(update(corridas).where(corridas.c.run_id == run_id).values(completa=True))
+        if self.keep_runs:
+            self.prune(self.keep_runs)
+
+    def _bulk_load(self, conn, table, columns, rows):
+        """Descripcion: Carga filas en bloque. En Postgres usa COPY sobre la conexión de psycopg2 dentro de la
+        misma transacción; en otros motores cae a un insert con executemany"""
+        if not rows:
+            return
+        if conn.dialect.name == "postgresql":
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                                   copy_csv(rows))
+            finally:
+                cursor.close()
+        else:
+            conn.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+    def save_run(self, state, estimated=()):
+        """Descripcion: Guarda un estado como una nueva corrida, incompleta hasta que se llame a complete_run
+        Returns: devuelve el run_id asignado"""
+        estimated = set(estimated)
+        datasets, temas, distributions = [], [], []
+        with self.engine.begin() as conn:
+            run_id = conn.execute(insert(mod.CatalogoCorrida.__table__).values(
+                harvested_at=state.get("harvested_at"))).inserted_primary_key[0]
+            for dataset_id, dataset in state.get("data", {}).items():
+                org = dataset.get("org", {})
+                datasets.append((run_id, dataset_id, dataset.get("title"), dataset.get("name"),
+                                 org.get("maintainer"), org.get("nodo_title"), org.get("nodo_alias")))
+                tema_info = dataset.get("temas", {})
+                for alias, nombre in zip(tema_info.get("temas_alias", []), tema_info.get("temas_nombres", [])):
+                    temas.append((run_id, dataset_id, alias, nombre))
+                for dist_id, dist in dataset.get("distributions", {}).items():
+                    size = dist.get("size")
+                    distributions.append((run_id, dist_id, dataset_id, dist.get("name"), dist.get("url"),
+                                          size if size == size else None, dist_id in estimated))
+            self._bulk_load(conn, mod.CatalogoDataset.__table__,
+                            ["run_id", "dataset_id", "title", "name", "maintainer", "nodo_title", "nodo_alias"],
+                            datasets)
+            self._bulk_load(conn, mod.CatalogoDatasetTema.__table__,
+                            ["run_id", "dataset_id", "tema_alias", "tema_nombre"], temas)
+            self._bulk_load(conn, mod.CatalogoDistribucion.__table__,
+                            ["run_id", "distribution_id", "dataset_id", "name", "url", "size", "estimated"],
+                            distributions)
+        logger.info(f"Corrida {run_id} guardada: {len(datasets)} datasets, {len(distributions)} distribuciones")
+        return run_id
+
+    def prune(self, keep):
+        """Descripcion: Borra las filas de catalogo_* de las corridas anteriores a las últimas keep completas,
+        incluidas las incompletas más viejas. Se borran explícitamente las tablas hijas porque no todos los
+        motores aplican ON DELETE CASCADE
+        Returns: devuelve la cantidad de corridas borradas"""
+        corridas = mod.CatalogoCorrida.__table__
+        with self.engine.begin() as conn:
+            oldest_kept = conn.execute(select(corridas.c.run_id).where(corridas.c.completa)
+                                       .order_by(corridas.c.run_id.desc()).offset(keep - 1).limit(1)).scalar()
+            if oldest_kept is None:
+                return 0
+            for table in reversed(CATALOG_TABLES):
+                removed = conn.execute(delete(table).where(table.c.run_id < oldest_kept)).rowcount
+        if removed:
+            logger.info(f"Se borraron {removed} corridas anteriores a {oldest_kept}")
+        return removed
+
+    def load_state(self, run_id):
+        """Descripcion: Reconstruye el estado en el formato de last_ckan_state.json a partir de una corrida
+        Returns: devuelve el estado o None si la corrida no existe"""
+        if run_id is None:
+            return None
+        with self.engine.connect() as conn:
+            harvested_at = conn.execute(select(mod.CatalogoCorrida.harvested_at)
+                                        .where(mod.CatalogoCorrida.run_id == run_id)).scalar()
+            data = {}
+            datasets = mod.CatalogoDataset.__table__
+            for row in conn.execute(select(datasets).where(datasets.c.run_id == run_id)):
+                data[row.dataset_id] = {"org": {"maintainer": row.maintainer, "nodo_title": row.nodo_title,
+                                                "nodo_alias": row.nodo_alias},
+                                        "temas": {"temas_alias": [], "temas_nombres": []},
+                                        "title": row.title, "name": row.name, "distributions": {}}
+            for dataset_id, alias, nombre in conn.execute(
+                    select(mod.CatalogoDatasetTema.dataset_id, mod.CatalogoDatasetTema.tema_alias,
+                           mod.CatalogoDatasetTema.tema_nombre)
+                    .where(mod.CatalogoDatasetTema.run_id == run_id).order_by(mod.CatalogoDatasetTema.id)):
+                data[dataset_id]["temas"]["temas_alias"].append(alias)
+                data[dataset_id]["temas"]["temas_nombres"].append(nombre)
+            for dist_id, dataset_id, name, url, size in conn.execute(
+                    select(mod.CatalogoDistribucion.distribution_id, mod.CatalogoDistribucion.dataset_id,
+                           mod.CatalogoDistribucion.name, mod.CatalogoDistribucion.url,
+                           mod.CatalogoDistribucion.size)
+                    .where(mod.CatalogoDistribucion.run_id == run_id)):
+                data[dataset_id]["distributions"][dist_id] = {"url": url, "name": name, "size": size}
+        if harvested_at is None and not data:
+            return None
+        return {"total_datasets": len(data),
+                "total_distributions": sum(len(v["distributions"]) for v in data.values()),
+                "harvested_at": harvested_at,
+                "data": data}
+
+    def _query(self, statement, **params):
+        with self.engine.connect() as conn:
+            return pd.read_sql_query(statement, conn, params=params)
+
+    def dataset_changes(self, prev, curr, base_url):
+        """Descripcion: Datasets nuevos (una fila por tema) y datasets que desaparecieron entre dos corridas.
+        base_url es la url de los datasets del portal cosechado (DATASET_BASE_URL en el parser)
+        Returns: devuelve (dataframe de nuevos, {dataset_id: title} de ausentes)"""
+        new = self._query(NEW_DATASETS, prev=prev, curr=curr, base_url=base_url)
+        new["event_type"] = "nuevo_dataset"
+        absent = self._query(ABSENT_DATASETS, prev=prev, curr=curr)
+        return new, dict(zip(absent["dataset_id"], absent["title"]))
+
+    def distribution_changes(self, prev, curr):
+        """Descripcion: Distribuciones nuevas (una fila por tema) y distribuciones que desaparecieron
+        Returns: devuelve (dataframe de nuevas, {distribution_id: name} de ausentes)"""
+        new = self._query(NEW_DISTRIBUTIONS, prev=prev, curr=curr)
+        new["event_type"] = "nueva_distribucion"
+        absent = self._query(ABSENT_DISTRIBUTIONS, prev=prev, curr=curr)
+        return new, dict(zip(absent["distribution_id"], absent["name"]))
+
+    def grown_distributions(self, prev, curr):
+        """Descripcion: Distribuciones de datasets con suscriptores cuyo tamaño creció entre dos corridas,
+        con los temas agrupados en una lista como en los datapoint events en memoria
+        Returns: devuelve un dataframe de pandas (vacío si no hubo cambios)"""
+        grown = self._query(GROWN_DISTRIBUTIONS, prev=prev, curr=curr)
+        keys = [c for c in grown.columns if c != "temas_alias"]
+        grown = (grown.groupby(keys, dropna=False, sort=False)["temas_alias"]
+                 .agg(lambda temas: [t for t in temas if t is not None]).reset_index())
+        grown["estimated"] = grown["estimated"].astype(bool)
+        grown["event_type"] = "nuevo_datapoint"
+        return grown
@@ -0,0 +1,98 @@
+import os
+import shutil
+from datetime import datetime, timezone
+import pandas as pd
+from checker_and_broadcaster import state as st
+
+STAGES = ("harvest", "count", "diff", "dump")
+
+
+class StageError(RuntimeError):
+    """No se puede ejecutar una etapa porque falta la salida cacheada de la etapa anterior"""
+
+
+def new_run_id():
+    """Descripcion: Genera el identificador de una corrida a partir de la fecha en UTC
+    Returns: devuelve un string ordenable, p. ej. 20250101T030000Z"""
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def stage_range(start, end):
+    """Descripcion: Lista las etapas entre start y end inclusive, en orden
+    Returns: devuelve una lista de nombres de etapa o lanza StageError"""
+    if start not in STAGES or end not in STAGES or STAGES.index(start) > STAGES.index(end):
+        raise StageError(f"Rango de etapas inválido: {start} -> {end}")
+    return list(STAGES[STAGES.index(start):STAGES.index(end) + 1])
+
+
+def frame_to_records(df):
+    """Descripcion: Serializa un dataframe de eventos para el cache. None se mantiene como None"""
+    if not isinstance(df, pd.DataFrame):
+        return None
+    return {"columns": list(df.columns), "records": df.astype(object).where(df.notna(), None).values.tolist()}
+
+
+def records_to_frame(payload):
+    """Descripcion: Reconstruye un dataframe guardado con frame_to_records"""
+    if payload is None:
+        return None
+    return pd.DataFrame(payload["records"], columns=payload["columns"])
+
+
+class StageCache:
+    """Salidas de cada etapa del parser, guardadas en <directorio>/<run_id>/<etapa>.json para poder
+    re-ejecutar cualquier etapa a partir de la anterior sin repetir la cosecha ni el conteo"""
+
+    def __init__(self, directory, run_id):
+        self.directory = directory
+        self.run_id = run_id
+        self.run_directory = os.path.join(directory, run_id)
+
+    def path(self, stage):
+        return os.path.join(self.run_directory, f"{stage}.json")
+
+    def has(self, stage):
+        return os.path.exists(self.path(stage))
+
+    def save(self, stage, payload):
+        """Descripcion: Guarda la salida de una etapa de forma atómica"""
+        os.makedirs(self.run_directory, exist_ok=True)
+        tmp_path = f"{self.path(stage)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(st.dumps(payload))
+        os.replace(tmp_path, self.path(stage))
+
+    def load(self, stage):
+        """Descripcion: Lee la salida cacheada de una etapa
+        Returns: devuelve el payload o lanza StageError si la etapa no se ejecutó en esta corrida"""
+        if not self.has(stage):
+            raise StageError(f"La corrida {self.run_id} no tiene la salida de la etapa {stage}")
+        with open(self.path(stage), "rb") as f:
+            return st.loads(f.read())
+
+    @staticmethod
+    def runs(directory):
+        """Descripcion: Lista las corridas con salidas cacheadas
+        Returns: devuelve los run_id ordenados de la más vieja a la más reciente"""
+        if not os.path.isdir(directory):
+            return []
+        return sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+
+    @staticmethod
+    def latest_run(directory):
+        """Descripcion: Busca la corrida más reciente con salidas cacheadas
+        Returns: devuelve el run_id o None"""
+        runs = StageCache.runs(directory)
+        return runs[-1] if runs else None
+
+    @staticmethod
+    def prune(directory, keep, current=None):
+        """Descripcion: Borra los directorios de las corridas más viejas y conserva las últimas keep; current
+        nunca se borra aunque no esté entre ellas. keep=0 conserva todas
+        Returns: devuelve la lista de run_id borrados"""
+        if not keep:
+            return []
+        removed = [run for run in StageCache.runs(directory)[:-keep] if run != current]
+        for run in removed:
+            shutil.rmtree(os.path.join(directory, run), ignore_errors=True)
+        return removed
@@ -0,0 +1,173 @@
+import json
+import os
+from typing import Dict, List, Optional, TypedDict
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa json de la librería estándar
+    orjson = None
+
+
+class StateError(ValueError):
+    """El archivo de estado no respeta el esquema esperado"""
+
+
+class Org(TypedDict):
+    maintainer: Optional[str]
+    nodo_title: Optional[str]
+    nodo_alias: Optional[str]
+
+
+class Temas(TypedDict):
+    temas_alias: List[str]
+    temas_nombres: List[str]
+
+
+class Distribution(TypedDict):
+    url: Optional[str]
+    name: Optional[str]
+    size: Optional[float]
+
+
+class Dataset(TypedDict):
+    org: Org
+    temas: Temas
+    title: Optional[str]
+    name: Optional[str]
+    distributions: Dict[str, Distribution]
+
+
+class _StateBase(TypedDict):
+    total_datasets: int
+    total_distributions: int
+    data: Dict[str, Dataset]
+
+
+class State(_StateBase, total=False):
+    harvested_at: str
+
+
+def _fail(message, *where):
+    raise StateError(f"{'.'.join(where)}: {message}")
+
+
+def _expect(value, kind, *where):
+    if value.__class__ is not kind:
+        _fail(f"se esperaba {kind.__name__}, llegó {type(value).__name__}", *where)
+    return value
+
+
+def _check_texts(record, keys, *where):
+    for key in keys:
+        value = record.get(key)
+        if value is not None and value.__class__ is not str:
+            _fail(f"se esperaba texto, llegó {type(value).__name__}", *where, key)
+
+
+def _validate_distributions(distributions, *where):
+    """Descripcion: Valida las distribuciones de un dataset y normaliza los tamaños en el lugar: los enteros
+    pasan a float y NaN a None. Es el bucle más caliente de la decodificación, por eso evita llamadas por campo"""
+    for dist_id, dist in distributions.items():
+        if dist.__class__ is not dict:
+            _fail(f"se esperaba dict, llegó {type(dist).__name__}", *where, dist_id)
+        url = dist.get("url")
+        name = dist.get("name")
+        if (url is not None and url.__class__ is not str) or (name is not None and name.__class__ is not str):
+            _check_texts(dist, ("url", "name"), *where, dist_id)
+        size = dist.get("size")
+        if size.__class__ is float:
+            if size != size:
+                dist["size"] = None
+        elif size.__class__ is int:
+            dist["size"] = float(size)
+        elif size is not None:
+            _fail(f"tamaño inválido {size!r}", *where, dist_id, "size")
+
+
+def _validate_dataset(dataset, *where):
+    _expect(dataset, dict, *where)
+    _check_texts(dataset, ("title", "name"), *where)
+    org = _expect(dataset.setdefault("org", {}), dict, *where, "org")
+    _check_texts(org, ("maintainer", "nodo_title", "nodo_alias"), *where, "org")
+    temas = _expect(dataset.setdefault("temas", {}), dict, *where, "temas")
+    _expect(temas.setdefault("temas_alias", []), list, *where, "temas", "temas_alias")
+    _expect(temas.setdefault("temas_nombres", []), list, *where, "temas", "temas_nombres")
+    _validate_distributions(_expect(dataset.setdefault("distributions", {}), dict, *where, "distributions"),
+                            *where, "distributions")
+
+
+def validate(raw) -> State:
+    """Descripcion: Valida un estado ya parseado y normaliza sus tipos en el lugar (los tamaños quedan como
+    float o None, los totales se recalculan a partir de data)
+    Returns: devuelve el mismo estado validado o lanza StateError"""
+    _expect(raw, dict, "estado")
+    data = _expect(raw.get("data"), dict, "data")
+    for dataset_id, dataset in data.items():
+        _validate_dataset(dataset, "data", dataset_id)
+    raw["total_datasets"] = len(data)
+    raw["total_distributions"] = sum(len(v["distributions"]) for v in data.values())
+    harvested_at = raw.get("harvested_at")
+    if harvested_at is not None and harvested_at.__class__ is not str:
+        _fail("se esperaba texto", "harvested_at")
+    return raw
+
+
+def loads(payload: bytes):
+    """Descripcion: Parsea JSON con orjson si está disponible. Acepta NaN de los archivos viejos cayendo a json
+    Returns: devuelve el objeto parseado o lanza StateError"""
+    try:
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(payload)
+    except ValueError as e:
+        raise StateError(f"JSON inválido: {e}") from e
+
+
+def dumps(obj) -> bytes:
+    """Descripcion: Serializa a JSON con orjson si está disponible
+    Returns: devuelve bytes en utf-8"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode(payload: bytes) -> State:
+    """Descripcion: Decodifica y valida un estado serializado. Usa orjson si está disponible y cae a json
+    para los archivos viejos, que pueden traer NaN como tamaño
+    Returns: devuelve el estado validado o lanza StateError"""
+    raw = loads(payload)
+    return validate(raw)
+
+
+def encode(state: State) -> bytes:
+    """Descripcion: Serializa un estado. Los NaN se escriben como null para que el archivo sea JSON válido
+    Returns: devuelve bytes en utf-8"""
+    if orjson is not None:
+        return orjson.dumps(state)
+    try:
+        return json.dumps(state, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    except ValueError:
+        return dumps(validate(state))
+
+
+def load_state(path):
+    """Descripcion: Lee y valida un archivo de estado
+    Returns: devuelve el estado o la excepción, igual que utils.read_json"""
+    try:
+        with open(path, "rb") as f:
+            return decode(f.read())
+    except Exception as e:
+        return e
+
+
+def save_state(path, state):
+    """Descripcion: Escribe un estado de forma atómica (archivo temporal + rename)
+    Returns: devuelve True si se pudo escribir"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encode(state))
+    os.replace(tmp_path, path)
+    return True
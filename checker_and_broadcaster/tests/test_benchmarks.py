@@ -0,0 +1,12 @@
+from checker_and_broadcaster.benchmarks import bench_parser
+
+
+def test_benchmark_smoke():
+    """El benchmark corre sobre una escala mínima y reporta todas las etapas"""
+    report = bench_parser.run(scales=[0.05], repeat=1, new_rate=0.1, absent_rate=0.05, grown_rate=0.2)
+    stages = {r["stage"]: r for r in report["results"]}
+    assert set(stages) == set(bench_parser.STAGES)
+    assert all(r["seconds_min"] >= 0 and r["peak_bytes"] > 0 for r in report["results"])
+    assert stages["dataset_events"]["rows"] > 0
+    assert stages["datapoint_events"]["rows"] > 0
+    assert bench_parser.compare(report, report)[0].endswith("tiempo x1.00  memoria x1.00")
@@ -0,0 +1,36 @@
+import json
+import pytest
+from checker_and_broadcaster.catalog_stream import CatalogStreamError, PackageSearchReader
+
+
+def chunked(content, size):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def test_reader_yields_packages_for_any_chunking():
+    packages = [{"id": f"p{i}", "title": "Ñandú " * i, "resources": [{"id": "r", "size": 1.5e3}], "private": False}
+                for i in range(30)]
+    response = {"help": "https://datos.gob.ar/api/3/action/help_show?name=package_search", "success": True,
+                "result": {"count": 1234, "facets": {}, "results": packages, "sort": "score desc",
+                           "search_facets": {}}}
+    content = json.dumps(response, ensure_ascii=False, indent=1).encode("utf-8")
+    for size in (1, 2, 5, 64, 1 << 16):
+        reader = PackageSearchReader(chunked(content, size))
+        assert list(reader) == packages
+        assert reader.count == 1234
+
+    # count puede venir después de results
+    reader = PackageSearchReader([b'{"result": {"results": [], "count": 7}, "success": true}'])
+    assert list(reader) == [] and reader.count == 7
+
+
+@pytest.mark.parametrize("content", [
+    b'{"success": true, "result": {"count": 2, "results": [{"id": "a"}, {"id": "b',
+    b'{"success": false, "error": {"message": "Solr error"}, "result": {"count": 0, "results": []}}',
+    b'{"success": true, "result": {"results": [{"id": "a"}]}}',
+    b'<html>502 Bad Gateway</html>',
+    b'',
+])
+def test_reader_rejects_invalid_responses(content):
+    with pytest.raises(CatalogStreamError):
+        list(PackageSearchReader(chunked(content, 3)))
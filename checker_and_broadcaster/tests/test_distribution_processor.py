@@ -0,0 +1,344 @@
+import asyncio
+import datetime
+import gzip
+import io
+import zipfile
+import checker_and_broadcaster.distribution_processor as dp
+from checker_and_broadcaster.counters import count_archive_rows, count_csv_rows, count_json_rows
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, lines=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.lines = lines or []
+        self.consumed = False
+        self.elapsed = datetime.timedelta(milliseconds=50)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_lines(self):
+        self.consumed = True
+        return iter(self.lines)
+
+    def iter_content(self, chunk_size=1):
+        self.consumed = True
+        return iter([b"\n".join(self.lines)])
+
+
+def patch_get(monkeypatch, fake_get):
+    """Reemplaza el GET de las sesiones compartidas por host"""
+    monkeypatch.setattr(dp.requests.Session, "get", lambda session, url, **kwargs: fake_get(url, **kwargs))
+
+
+def test_validator_cache_reuses_size(tmp_path, monkeypatch):
+    """La segunda corrida no debe leer el cuerpo: reutiliza el conteo ante un 304 o con el mismo ETag"""
+    cache_path = str(tmp_path / "distribution_cache.json")
+    url = "http://example.org/data.csv"
+    calls = []
+
+    def fake_get(url, headers=None, **kwargs):
+        calls.append(dict(headers))
+        if headers.get("If-None-Match") == '"v1"' and len(calls) == 2:
+            return FakeResponse(304)
+        return FakeResponse(200, {"ETag": '"v1"', "Content-Type": "text/csv"}, [b"a,b", b"1,2", b"3,4"])
+
+    patch_get(monkeypatch, fake_get)
+
+    first = dp.DistributionProcessor(cache_path=cache_path, delay=0)
+    assert first.process_distributions_concurrent({"d1": {"url": url}}) == [["d1", url, 3, None]]
+
+    second = dp.DistributionProcessor(cache_path=cache_path, delay=0)
+    assert second.process_distributions_concurrent({"d1": {"url": url}}) == [["d1", url, 3, None]]
+    assert calls[1]["If-None-Match"] == '"v1"'
+
+    # el servidor ignora el GET condicional pero el ETag no cambió
+    third = dp.DistributionProcessor(cache_path=cache_path, delay=0)
+    response = FakeResponse(200, {"ETag": '"v1"'}, [b"x"])
+    patch_get(monkeypatch, lambda *args, **kwargs: response)
+    assert third.process_distributions_concurrent({"d1": {"url": url}}) == [["d1", url, 3, None]]
+    assert not response.consumed
+
+
+def test_async_engine_matches_threads(monkeypatch):
+    """El motor asincrónico debe devolver las mismas filas que el de threads"""
+    def fake_get(url, headers=None, **kwargs):
+        if url.endswith("missing.csv"):
+            return FakeResponse(404)
+        return FakeResponse(200, {"Content-Type": "text/csv"}, [b"a"] * int(url.split("/")[-1].split(".")[0]))
+
+    patch_get(monkeypatch, fake_get)
+    distributions = {f"d{i}": {"url": f"http://example.org/{i}.csv"} for i in range(1, 30)}
+    distributions["bad"] = {"url": "http://example.org/missing.csv"}
+
+    threads = dp.DistributionProcessor(delay=0).process_distributions_concurrent(distributions)
+    engine = dp.DistributionProcessor(delay=0, engine="async", concurrency=4, queue_size=2)
+    rows = engine.process_distributions_concurrent(distributions)
+    assert sorted(rows) == sorted(threads)
+    assert ["bad", "http://example.org/missing.csv", None, "HTTP 404"] in rows
+
+
+def test_async_engine_reports_rate_limiter_errors(monkeypatch):
+    """Una falla antes de la descarga también publica su resultado en vez de colgar el loop de resultados"""
+    engine = dp.DistributionProcessor(delay=0, engine="async", concurrency=2, queue_size=1)
+
+    def reserve(url):
+        if url.endswith("2.csv"):
+            raise RuntimeError("bucket roto")
+        return 0.0
+
+    monkeypatch.setattr(engine.hosts, "reserve", reserve)
+    patch_get(monkeypatch, lambda *args, **kwargs: FakeResponse(200, {"Content-Type": "text/csv"}, [b"a"]))
+    distributions = {f"d{i}": {"url": f"http://example.org/{i}.csv"} for i in range(1, 5)}
+    rows = asyncio.run(asyncio.wait_for(engine.process_distributions_async(distributions), timeout=10))
+    assert ["d2", "http://example.org/2.csv", None, "Unexpected error: bucket roto"] in rows
+    assert len(rows) == 4
+
+
+def test_token_bucket_per_host():
+    """Cada host tiene su propio bucket: agotar uno no demora al otro"""
+    pool = dp.hosts.HostPool(rate_per_host=10, burst=2)
+    assert pool.reserve("http://a.gob.ar/1.csv") == 0
+    assert pool.reserve("http://a.gob.ar/2.csv") == 0
+    assert 0.05 < pool.reserve("http://A.gob.ar/3.csv") <= 0.1
+    assert pool.reserve("http://b.gob.ar/1.csv") == 0
+    assert pool.session("http://a.gob.ar/x") is pool.session("http://a.gob.ar/y")
+    assert pool.session("http://a.gob.ar/x") is not pool.session("http://b.gob.ar/x")
+
+
+def test_csv_counter_quotes_and_blank_lines():
+    """Las líneas vacías no cuentan, los saltos de línea entre comillas tampoco, sin importar el corte de buffers"""
+    content = b'id,texto\r\n1,"linea uno\nlinea dos"\r\n\r\n2,"con ""comillas""\n"\n3,fin'
+    for size in range(1, len(content) + 1):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        assert count_csv_rows(chunks) == 4
+    # una comilla sin cerrar vuelve al conteo por líneas
+    assert count_csv_rows([b'a "b\nc\n\nd']) == 3
+
+
+def test_json_counter_single_pass():
+    """Arrays, primera clave con array de un objeto y JSON Lines, con cualquier corte de buffers"""
+    documents = {
+        b'[{"a": "x]"}, 12345, 1.5e3, null]': (4, None),
+        b'{"meta": {"n": [1]}, "data": [[1, 2], {"b": 2}], "otros": [1]}': (2, None),
+        b'{"sin_arrays": 1}': (1, None),
+        b'{"a": 1}\n\n  {"a": [2, 3]}\n': (2, None),
+        b'"texto"': (None, "Unexpected JSON structure: <class 'str'>"),
+    }
+    for content, expected in documents.items():
+        for size in range(1, len(content) + 1):
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            assert count_json_rows(chunks) == expected
+
+
+class RangeServer:
+    """Servidor falso que respeta Range y ETag sobre un contenido que se puede modificar"""
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers))
+        etag = f'"{hash(self.content)}"'
+        base = {"ETag": etag, "Accept-Ranges": "bytes", "Content-Type": "text/csv"}
+        if headers.get("If-None-Match") == etag:
+            return FakeResponse(304)
+        if "Range" in headers:
+            start = int(headers["Range"][len("bytes="):-1])
+            if start >= len(self.content):
+                return FakeResponse(416)
+            body = self.content[start:]
+            content_range = f"bytes {start}-{len(self.content) - 1}/{len(self.content)}"
+            return FakeResponse(206, {**base, "Content-Range": content_range}, [body])
+        return FakeResponse(200, base, [self.content])
+
+
+def test_incremental_range_count(tmp_path, monkeypatch):
+    """Un csv que sólo crece se cuenta pidiendo la cola; si se reescribe se cuenta completo"""
+    server = RangeServer(b"a,b\n" + b"1,2\n" * 300)
+    patch_get(monkeypatch, server.get)
+    cache_path = str(tmp_path / "distribution_cache.json")
+    url = "http://example.org/serie.csv"
+
+    def run():
+        processor = dp.DistributionProcessor(cache_path=cache_path, delay=0)
+        return processor.process_distributions_concurrent({"d1": {"url": url}})[0][2]
+
+    assert run() == 301
+    server.content += b'3,"con\nsalto"\n4,5\n'
+    assert run() == 303
+    assert server.requests[-1]["Range"] == f"bytes={301 * 4 - dp.TAIL_SIZE}-"
+    assert run() == 303
+    server.content = b"x,y\n" + b"9,9\n" * 400
+    assert run() == 401
+    assert "Range" not in server.requests[-1]
+
+
+def test_archive_counters():
+    """gzip con varios miembros, zip con descriptores de datos (escrito como stream) y hojas de xlsx"""
+    csv = b"a,b\n" + b"1,2\n" * 500
+
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.data = bytearray()
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            self.data += b
+            return len(b)
+
+    def build_zip(files):
+        stream = Unseekable()
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files.items():
+                with archive.open(name, "w") as member:
+                    member.write(content)
+        return bytes(stream.data)
+
+    sheet = b"<worksheet><sheetData>" + b'<row r="1"><c><v>1</v></c></row>' * 300 + b"</sheetData></worksheet>"
+    cases = [
+        ("gzip", "http://h.gob.ar/serie.csv.gz", gzip.compress(csv) + gzip.compress(b"3,4\n"), (502, None)),
+        ("zip", "http://h.gob.ar/datos.zip", build_zip({"leeme.pdf": b"x", "a.csv": csv, "b.txt": b"q\n"}), (502, None)),
+        ("xlsx", "http://h.gob.ar/libro.xlsx", build_zip({"xl/worksheets/sheet1.xml": sheet}), (300, None)),
+        ("zip", "http://h.gob.ar/otros.zip", build_zip({"a.pdf": b"x"}), (None, "Zip sin archivos csv para contar")),
+    ]
+    for archive_format, url, content, expected in cases:
+        for size in (7, 1000, len(content)):
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            assert count_archive_rows(archive_format, url, chunks) == expected
+
+
+def test_circuit_breaker_fast_fails_host(monkeypatch):
+    """Tras failure_threshold fallas de un host el resto de sus distribuciones falla sin pedidos"""
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        if "caido" in url:
+            raise dp.requests.exceptions.ConnectionError()
+        return FakeResponse(200, {"Content-Type": "text/csv"}, [b"a"])
+
+    patch_get(monkeypatch, fake_get)
+    monkeypatch.setattr(dp.time, "sleep", lambda seconds: None)
+    processor = dp.DistributionProcessor(delay=0, max_workers=1, max_retries=2)
+    distributions = {f"d{i}": {"url": f"http://caido.gob.ar/{i}.csv"} for i in range(5)}
+    distributions["ok"] = {"url": "http://sano.gob.ar/1.csv"}
+    rows = {row[0]: row for row in processor.process_distributions_concurrent(distributions)}
+
+    assert len([url for url in calls if "caido" in url]) == processor.hosts.failure_threshold
+    assert sum(row[3] == "Circuit open for host caido.gob.ar" for row in rows.values()) == 4
+    assert rows["ok"][2] == 1
+    assert processor.hosts.timeout("http://sano.gob.ar/") == processor.hosts.min_timeout
+
+
+def test_estimated_size_with_exact_reconciliation(tmp_path, monkeypatch):
+    """Un csv grande se estima a partir de una muestra y se vuelve a contar exacto cada exact_every corridas"""
+    content = b"id,valor\n" + b"".join(b"%06d,abcdefgh\n" % i for i in range(2000))
+    server = RangeServer(content)
+
+    def get_without_ranges(url, headers=None, **kwargs):
+        response = server.get(url, headers={k: v for k, v in headers.items() if k != "Range"})
+        response.headers = {k: v for k, v in response.headers.items() if k != "Accept-Ranges"}
+        response.headers["Content-Length"] = str(len(server.content))
+        return response
+
+    patch_get(monkeypatch, get_without_ranges)
+    cache_path = str(tmp_path / "distribution_cache.json")
+    url = "http://example.org/grande.csv"
+
+    def run():
+        processor = dp.DistributionProcessor(cache_path=cache_path, delay=0, estimate_threshold=1000,
+                                             sample_bytes=500, exact_every=2)
+        size = processor.process_distributions_concurrent({"d1": {"url": url}})[0][2]
+        return size, "d1" in processor.estimated
+
+    assert run() == (2001, False)
+    server.content += b"".join(b"%06d,abcdefgh\n" % i for i in range(20))
+    size, estimated = run()
+    assert estimated and abs(size - 2021) <= 2
+    server.content += b"999999,abcdefgh\n"
+    assert run()[1]
+    server.content += b"999999,abcdefgh\n"
+    assert run() == (2023, False)
+
+
+def test_crawl_resumes_from_journal(tmp_path, monkeypatch):
+    """Las distribuciones contadas antes de que el proceso muriera no se vuelven a descargar; las que
+    terminaron con error sí"""
+    journal_path = str(tmp_path / "count_journal.jsonl")
+    distributions = {f"d{i}": {"url": f"http://example.org/{i}.csv"} for i in range(1, 6)}
+    distributions["bad"] = {"url": "http://example.org/missing.csv"}
+
+    def fake_get(url, headers=None, **kwargs):
+        if url.endswith("missing.csv") or url.endswith("4.csv") or url.endswith("5.csv"):
+            return FakeResponse(404)
+        return FakeResponse(200, {"Content-Type": "text/csv"}, [b"a"] * int(url.split("/")[-1].split(".")[0]))
+
+    patch_get(monkeypatch, fake_get)
+    # primera ejecución: simula una caída después de escribir la mitad de una línea
+    dp.DistributionProcessor(delay=0, max_retries=0, journal_path=journal_path).process_distributions_concurrent(
+        {k: v for k, v in distributions.items() if k in ("d1", "d2", "d3", "bad")})
+    with open(journal_path, "ab") as f:
+        f.write(b'{"at":"2025')
+
+    requested = []
+
+    def second_get(url, headers=None, **kwargs):
+        requested.append(url)
+        return FakeResponse(200, {"Content-Type": "text/csv"}, [b"a"] * 7)
+
+    patch_get(monkeypatch, second_get)
+    seen = []
+    processor = dp.DistributionProcessor(delay=0, journal_path=journal_path)
+    rows = processor.process_distributions_concurrent(distributions, on_result=seen.append)
+    assert sorted(requested) == sorted(["http://example.org/4.csv", "http://example.org/5.csv",
+                                        "http://example.org/missing.csv"])
+    assert {row[0]: row[2] for row in rows} == {"d1": 1, "d2": 2, "d3": 3, "d4": 7, "d5": 7, "bad": 7}
+    assert sorted(seen) == sorted(rows)
+
+    with open(journal_path, "rb") as f:
+        assert sum(1 for line in f if line.startswith(b'{"at"') and line.endswith(b"}\n")) == 7
+
+    # una url distinta invalida la entrada del diario
+    moved = {"d1": {"url": "http://example.org/moved.csv"}}
+    assert dp.DistributionProcessor(delay=0, journal_path=journal_path).process_distributions_concurrent(
+        moved) == [["d1", "http://example.org/moved.csv", 7, None]]
+
+
+def test_only_network_and_server_errors_are_retried(monkeypatch):
+    """Un archivo mal formado se pide una sola vez; los 5xx y los cortes a mitad de la descarga se reintentan"""
+    calls = []
+
+    class BrokenResponse(FakeResponse):
+        def __init__(self, error):
+            super().__init__(200, {"Content-Type": "text/csv"})
+            self.error = error
+
+        def iter_content(self, chunk_size=1):
+            raise self.error
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        if "malformado" in url:
+            return BrokenResponse(ValueError("fila inválida"))
+        if "cortado" in url:
+            return BrokenResponse(dp.requests.exceptions.ChunkedEncodingError("corte"))
+        return FakeResponse(503 if "caido" in url else 404)
+
+    patch_get(monkeypatch, fake_get)
+    monkeypatch.setattr(dp.time, "sleep", lambda seconds: None)
+    processor = dp.DistributionProcessor(delay=0, max_workers=1, max_retries=2)
+    distributions = {name: {"url": f"http://{name}.gob.ar/1.csv"}
+                     for name in ("malformado", "cortado", "caido", "ausente")}
+    rows = {row[0]: row for row in processor.process_distributions_concurrent(distributions)}
+
+    assert {name: sum(name in url for url in calls) for name in distributions} == \
+        {"malformado": 1, "cortado": 3, "caido": 3, "ausente": 1}
+    assert rows["malformado"][3].startswith("CSV/Text parsing error")
+    assert rows["caido"][3] == "HTTP 503" and rows["ausente"][3] == "HTTP 404"
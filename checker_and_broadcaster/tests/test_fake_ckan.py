@@ -0,0 +1,58 @@
+import checker_and_broadcaster.parser as pars
+import checker_and_broadcaster.distribution_processor as dp
+from checker_and_broadcaster.benchmarks.bench_parser import generate_state
+from checker_and_broadcaster.benchmarks.fake_ckan import FakeCkan
+
+
+class Harvester(pars.Parser):
+    def __init__(self):
+        self._init_runtime_state()
+
+
+def test_parser_and_processor_against_fake_ckan(tmp_path, monkeypatch):
+    """El parser cosecha del servidor local y el processor cuenta, revalida y cuenta incrementalmente sus
+    distribuciones igual que contra el portal real"""
+    state = generate_state(0.02, seed=3)
+    with FakeCkan(state, hosts=2, max_rows=300) as fake:
+        monkeypatch.setattr(pars, "CKAN_PACKAGE_SEARCH", f"{fake.base_url}/api/3/action/package_search")
+        monkeypatch.setattr(pars, "CKAN_PAGE_SIZE", 7)
+        raw = Harvester()._get_raw_state()
+        assert set(raw) == set(state["data"])
+        entry = Harvester()._build_dataset_entry(raw[next(iter(state["data"]))])
+        assert entry["org"] == state["data"][next(iter(state["data"]))]["org"]
+        # la cosecha completa proyecta cada paquete directo a su entrada del estado
+        harvester = Harvester()
+        harvester.previous_state = None
+        current = harvester._get_current_state()
+        assert list(current["data"]) == list(state["data"])
+        assert {k: v["temas"] for k, v in current["data"].items()} == {k: v["temas"] for k, v in state["data"].items()}
+        assert current["total_distributions"] == state["total_distributions"]
+
+        distributions = {r["id"]: {"url": r["url"]} for p in raw.values() for r in p["resources"]}
+        cache_path = str(tmp_path / "distribution_cache.json")
+        rows = dp.DistributionProcessor(delay=0, cache_path=cache_path).process_distributions_concurrent(
+            distributions)
+        # el csv sintético tiene una fila de encabezado
+        assert {r[0]: r[2] for r in rows} == {d: fake.rows(d) + 1 for d in distributions}
+
+        requests_before = fake.requests
+        fake.grow(fraction=0.5, rows=25)
+        rows = dp.DistributionProcessor(delay=0, cache_path=cache_path).process_distributions_concurrent(
+            distributions)
+        assert {r[0]: r[2] for r in rows} == {d: fake.rows(d) + 1 for d in distributions}
+        assert fake.requests - requests_before == len(distributions)
+
+
+def test_fake_ckan_errors_and_incremental_filter():
+    state = generate_state(0.01, seed=1)
+    with FakeCkan(state, hosts=1, error_rate=1.0) as fake:
+        url = fake.packages[0]["resources"][0]["url"]
+        dist_id = fake.packages[0]["resources"][0]["id"]
+        rows = dp.DistributionProcessor(delay=0, max_retries=0).process_distributions_concurrent(
+            {dist_id: {"url": url}})
+        assert rows[0][2] is None and "500" in rows[0][3]
+        assert fake.package_search({"fq": ["metadata_modified:[2999-01-01T00:00:00Z TO *]"]})["result"]["count"] == 0
+        assert fake.package_search({"rows": ["5"]})["result"]["count"] == len(state["data"])
+        # con fl= los campos anidados llegan aplanados, como en CKAN
+        package = fake.package_search({"rows": ["1"], "fl": ["id,organization,resources"]})["result"]["results"][0]
+        assert package == {"id": fake.packages[0]["id"], "organization": fake.packages[0]["organization"]["name"]}
@@ -0,0 +1,74 @@
+import copy
+from checker_and_broadcaster.history import StateHistory
+
+
+def make_state(harvested_at, datasets):
+    data = {dataset_id: {"org": {"maintainer": "m", "nodo_title": "Nodo", "nodo_alias": "nodo"},
+                         "temas": {"temas_alias": [], "temas_nombres": []},
+                         "title": dataset_id, "name": dataset_id,
+                         "distributions": {f"{dataset_id}-d": {"url": "u", "name": "n", "size": size}}}
+            for dataset_id, size in datasets.items()}
+    return {"total_datasets": len(data), "total_distributions": len(data), "harvested_at": harvested_at,
+            "data": data}
+
+
+def test_history_rebuilds_every_run(tmp_path):
+    """Con checkpoint cada 3 corridas se guardan checkpoint, delta, delta, checkpoint y cualquier
+    corrida se reconstruye igual a como se guardó"""
+    states = [make_state("t1", {"a": 1.0, "b": 2.0}),
+              make_state("t2", {"a": 1.0, "b": 3.0}),
+              make_state("t3", {"a": 1.0, "c": None}),
+              make_state("t4", {"a": 5.0, "c": None})]
+    store = StateHistory(tmp_path / "history.jsonl", checkpoint_every=3)
+    for state in states:
+        store.append(copy.deepcopy(state))
+
+    assert [r["kind"] for r in store.runs()] == ["checkpoint", "delta", "delta", "checkpoint"]
+    for run, state in enumerate(states, start=1):
+        assert store.state_at(run) == state
+    assert store.state_at() == states[-1]
+    assert store.state_at(9) is None
+
+
+def test_delta_only_stores_changed_datasets(tmp_path):
+    store = StateHistory(tmp_path / "history.jsonl", checkpoint_every=10)
+    store.append(make_state("t1", {"a": 1.0, "b": 2.0}))
+    store.append(make_state("t2", {"a": 1.0, "b": 4.0}))
+    lines = (tmp_path / "history.jsonl").read_bytes().splitlines()
+    assert b'"a"' not in lines[1]
+    assert b'"b"' in lines[1]
+
+
+def test_index_is_rebuilt_when_stale(tmp_path):
+    """El índice evita releer el historial y se reconstruye si falta o no coincide con el archivo"""
+    store = StateHistory(tmp_path / "history.jsonl", checkpoint_every=2)
+    states = [make_state(f"t{i}", {"a": float(i)}) for i in range(1, 4)]
+    for state in states:
+        store.append(copy.deepcopy(state))
+    index = (tmp_path / "history.jsonl.idx").read_text().splitlines()
+    assert [line.split()[:2] for line in index] == [["1", "checkpoint"], ["2", "delta"], ["3", "checkpoint"]]
+
+    (tmp_path / "history.jsonl.idx").unlink()
+    assert store.last_run() == 3
+    assert store.state_at(2) == states[1]
+    (tmp_path / "history.jsonl.idx").write_text("1 checkpoint 0 10\n")
+    assert store.last_run() == 3
+    assert StateHistory(tmp_path / "history.jsonl").state_at(3) == states[2]
+
+
+def test_prune_keeps_last_runs(tmp_path):
+    """La compactación corta en un checkpoint y las corridas conservadas se reconstruyen igual"""
+    store = StateHistory(tmp_path / "history.jsonl", checkpoint_every=2)
+    states = [make_state(f"t{i}", {"a": float(i), "b": 1.0}) for i in range(1, 7)]
+    for state in states:
+        store.append(copy.deepcopy(state))
+    assert store.prune(0) == 0
+    # para reconstruir las corridas 4 a 6 hace falta el checkpoint de la 3
+    assert store.prune(3) == 2
+    assert [r["run"] for r in store.runs()] == [3, 4, 5, 6]
+    assert store.state_at(2) is None
+    for run in range(3, 7):
+        assert store.state_at(run) == states[run - 1]
+    assert store.prune(3) == 0
+    assert store.append(copy.deepcopy(states[0])) == 7
+    assert store.state_at(7) == states[0]
@@ -0,0 +1,68 @@
+import json
+import pandas as pd
+import pytest
+import checker_and_broadcaster.distribution_processor as dp
+from checker_and_broadcaster.benchmarks.bench_parser import generate_state
+from checker_and_broadcaster.benchmarks.fake_ckan import FakeCkan
+from checker_and_broadcaster.metrics import RunMetrics
+
+
+def test_run_metrics_exports(tmp_path):
+    metrics = RunMetrics("run-1")
+    with metrics.timer("harvest"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.timer("count"):
+            raise RuntimeError("falla a mitad de etapa")
+    metrics.add_bytes("http://a.org/x.csv", 100)
+    metrics.record_distribution("http://a.org/x.csv", "counted")
+    metrics.record_distribution("http://A.org/y.csv", "failed")
+    metrics.record_distribution("http://b.org/z.csv", "skipped")
+    # un evento por tema: d1 está en dos temas y cuenta una vez
+    metrics.set_events("nuevo_dataset", pd.DataFrame({"dataset_id": ["d1", "d1", "d2"],
+                                                      "temas_alias": ["agro", "energia", "agro"]}), "dataset_id")
+    metrics.set_events("nuevo_datapoint", None, "distribution_id")
+    metrics.finish(success=True)
+
+    metrics.write_json(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json", encoding="utf-8") as f:
+        summary = json.load(f)
+    assert set(summary["stages"]) == {"harvest", "count"}
+    assert summary["hosts"]["a.org"] == {"bytes": 100, "counted": 1, "skipped": 0, "failed": 1}
+    assert summary["distributions"] == {"bytes": 100, "counted": 1, "skipped": 1, "failed": 1}
+    assert summary["events"] == {"nuevo_dataset": 2, "nuevo_datapoint": 0}
+
+    metrics.write_prometheus(str(tmp_path / "metrics.prom"))
+    text = (tmp_path / "metrics.prom").read_text(encoding="utf-8")
+    assert 'datob_bytes_downloaded{host="a.org"} 100' in text
+    assert 'datob_distributions{host="b.org",outcome="skipped"} 1' in text
+    assert 'datob_events{type="nuevo_dataset"} 2' in text
+    assert 'datob_run_success 1' in text
+    assert f"datob_last_run_timestamp_seconds {metrics.finished_at.timestamp()!r}" in text
+    assert "run-1" not in text
+    assert not (tmp_path / "metrics.prom.tmp").exists()
+    with pytest.raises(ValueError):
+        metrics.record_distribution("http://a.org/x.csv", "perdida")
+
+
+def test_processor_reports_bytes_and_outcomes(tmp_path):
+    """Contra el servidor local: la primera corrida descarga y cuenta todo, la segunda revalida por ETag"""
+    state = generate_state(0.005, seed=2)
+    with FakeCkan(state, hosts=2, max_rows=200) as fake:
+        distributions = {d: {"url": fake._distribution_url(d, dist.get("url"))}
+                         for d, dist in fake.distributions.items()}
+        cache_path = str(tmp_path / "distribution_cache.json")
+
+        cold = RunMetrics("cold")
+        dp.DistributionProcessor(delay=0, cache_path=cache_path, metrics=cold).process_distributions_concurrent(
+            distributions)
+        totals = cold.summary()["distributions"]
+        assert totals["counted"] == len(distributions) and totals["skipped"] == totals["failed"] == 0
+        assert totals["bytes"] > 0
+        assert set(cold.summary()["hosts"]) == {f"127.0.0.{i}:{fake.port}" for i in (1, 2)}
+
+        warm = RunMetrics("warm")
+        dp.DistributionProcessor(delay=0, cache_path=cache_path, metrics=warm).process_distributions_concurrent(
+            distributions)
+        totals = warm.summary()["distributions"]
+        assert totals["skipped"] == len(distributions) and totals["counted"] == 0
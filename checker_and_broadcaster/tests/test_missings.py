@@ -0,0 +1,90 @@
+import copy
+import json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import checker_and_broadcaster.parser as pars
+from checker_and_broadcaster.missings import MissingsStore
+from checker_and_broadcaster.utils import read_json, write_json
+
+assets = Path(__file__).resolve().parent / "test_assets"
+REAPPEARED = "energia_1c181390-5045-475e-94dc-410429be4b17"
+NEW = "energia_5ddbdfbb-b6f9-4bc1-9e71-0055e86cf552"
+
+
+def test_store_migrates_indexes_and_expires(tmp_path):
+    path = str(tmp_path / "missings.json")
+    write_json(path, {"a": "Dataset A", "b": "Dataset B", "c": "Dataset A"})
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    store = MissingsStore(path, ttl=timedelta(days=30), now=start)
+    assert store.has_id("b") and store.has_title("Dataset A") and not store.has_title("Dataset C")
+    store.mark_found(["b"], ["Dataset A"])
+    assert store.ids() == frozenset() and not store.has_title("Dataset A")
+    store.mark_missing({"d": "Dataset D"})
+    # nada se escribe hasta save, y se escribe todo junto en el formato nuevo
+    assert read_json(path) == {"a": "Dataset A", "b": "Dataset B", "c": "Dataset A"}
+    assert store.save() and not store.save()
+    saved = read_json(path)
+    assert saved["version"] == 2
+    assert saved["missing"] == {"d": {"title": "Dataset D", "first_seen": start.isoformat(),
+                                      "last_seen": start.isoformat()}}
+    assert not (tmp_path / "missings.json.tmp").exists()
+
+    later = start + timedelta(days=10)
+    store = MissingsStore(path, ttl=timedelta(days=30), now=later)
+    store.mark_missing({"e": "Dataset E"})
+    store.refresh({"e"})
+    store.save()
+    entries = read_json(path)["missing"]
+    assert entries["d"] == {"title": "Dataset D", "first_seen": start.isoformat(), "last_seen": later.isoformat()}
+    assert entries["e"]["first_seen"] == later.isoformat()
+
+    # d falta hace más de 30 días: vence y, si vuelve, se anuncia como nuevo
+    store = MissingsStore(path, ttl=timedelta(days=30), now=start + timedelta(days=31))
+    assert store.ids() == frozenset({"e"}) and store.dirty
+
+
+class MissingsParser(pars.Parser):
+    def __init__(self, directory, previous_state, current_state):
+        self._init_runtime_state()
+        self.persistance_directory = directory
+        self.previous_state = previous_state
+        self.current_state = current_state
+        self.colnames_ds_events = ["dataset_id", "dataset_title", "temas_alias", "nodo_alias", "maintainer", "url",
+                                   "event_type"]
+        self.colnames_dist_events = ["distribution_id", "distribution_name"] + self.colnames_ds_events
+        self.missing_dataset_ids = self._get_missing_ids()
+        self.missing_dataset_titles = self._get_missing_titles()
+        self.dataset_events = self._get_dataset_events()
+        self.distribution_events = self._get_distribution_events()
+
+
+def test_parser_updates_missings_once_per_run(tmp_path):
+    legacy = read_json(assets / "missings.json")
+    write_json(tmp_path / "missings.json", legacy)
+    previous = read_json(assets / "test_last_ckan_state.json")
+    current = read_json(assets / "test_current_ckan_state.json")
+
+    parser = MissingsParser(tmp_path, previous, current)
+    assert parser.dataset_events["dataset_id"].unique().tolist() == [NEW]
+    assert read_json(tmp_path / "missings.json") == legacy
+    parser.save_missings()
+    assert read_json(tmp_path / "missings.json")["missing"] == {}
+
+    # el dataset nuevo desaparece en la corrida siguiente y al volver no se anuncia
+    without_new = copy.deepcopy(current)
+    removed = without_new["data"].pop(NEW)
+    parser = MissingsParser(tmp_path, current, without_new)
+    parser.save_missings()
+    saved = read_json(tmp_path / "missings.json")["missing"]
+    assert saved[NEW]["title"] == removed["title"]
+    distributions = read_json(tmp_path / "missings_distri.json")["missing"]
+    assert set(distributions) == set(removed["distributions"])
+
+    parser = MissingsParser(tmp_path, without_new, current)
+    assert parser.dataset_events is None or NEW not in parser.dataset_events["dataset_id"].tolist()
+    assert len(parser.distribution_events) == 0
+    parser.save_missings()
+    assert NEW not in read_json(tmp_path / "missings.json")["missing"]
+    assert read_json(tmp_path / "missings_distri.json")["missing"] == {}
+    assert json.loads((tmp_path / "missings.json").read_text(encoding="utf-8"))["version"] == 2
@@ -13,6 +13,7 @@ previous_state_path = "test_last_ckan_state.json"
 
 class TestParser(pars.Parser):
         def __init__(self):
+            self._init_runtime_state()
             base_dir = Path(__file__).resolve().parent
             self.persistance_directory = base_dir/ "test_assets"
             self.restitute_missing()
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import time
+import tracemalloc
+from handler_subscriber import profiling
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += sum(range(1000))
+    return total
+
+
+def test_profiler_stages_and_outputs(tmp_path, monkeypatch):
+    monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+    assert profiling.from_env("checker", directory=str(tmp_path)) is None
+
+    monkeypatch.setenv(profiling.PROFILE_ENV, "1")
+    monkeypatch.setenv("DATOB_PROFILE_INTERVAL", "0.002")
+    monkeypatch.setenv("DATOB_PROFILE_FRAMES", "1")
+    profiler = profiling.from_env("checker", directory=str(tmp_path))
+    try:
+        with profiler.stage("count"):
+            busy(0.2)
+            with profiler.stage("diff"):
+                kept = bytearray(4 << 20)
+                busy(0.1)
+            del kept
+        profiler.stop()
+    finally:
+        profiler.stop()
+    assert not tracemalloc.is_tracing()
+
+    with open(f"{profiler.path_prefix}.memory.json", encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["stages"]["diff"]["peak_bytes"] >= 4 << 20
+    # el pico de la etapa interna también cuenta para la externa
+    assert report["stages"]["count"]["peak_bytes"] >= report["stages"]["diff"]["peak_bytes"]
+    assert report["stages"]["count"]["seconds"] >= 0.3
+    assert "top_allocations" in report["stages"]["count"]
+    assert report["stages"]["count"]["peak_rss_bytes"] >= report["stages"]["diff"]["peak_rss_bytes"] > 4 << 20
+
+    with open(f"{profiler.path_prefix}.folded", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert any(line.startswith("count;") and "busy (test_profiling.py" in line for line in lines)
+    assert any(line.startswith("count;diff;") for line in lines)
+    assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines)
+
+
+def test_wrapped_handler(tmp_path):
+    profiler = profiling.Profiler("bot", directory=str(tmp_path), interval=0.005).start()
+
+    async def suscribir_tema(update, context):
+        return update
+
+    wrapped = profiler.wrap(suscribir_tema)
+    assert wrapped.__name__ == "suscribir_tema"
+    assert asyncio.run(wrapped("update", None)) == "update"
+    assert asyncio.run(wrapped("otro", None)) == "otro"
+    profiler.stop()
+    with open(f"{profiler.path_prefix}.memory.json", encoding="utf-8") as f:
+        stats = json.load(f)["stages"]["suscribir_tema"]
+    # sin tracemalloc sólo se reporta la memoria residente
+    assert stats["calls"] == 2 and "top_allocations" not in stats and "peak_bytes" not in stats
+    assert stats["peak_rss_bytes"] > 0
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,113 @@
+import csv
+import io
+from pathlib import Path
+from sqlalchemy import create_engine, insert
+import handler_subscriber.models as mod
+import checker_and_broadcaster.parser as pars
+from checker_and_broadcaster import sql_state
+from checker_and_broadcaster import state as st
+from checker_and_broadcaster.utils import read_json, write_json
+from checker_and_broadcaster.tests.test_parser_broadcast import TestParser, previous_state_path, current_state_path
+
+assets = Path(__file__).resolve().parent / "test_assets"
+
+
+def restitute_missing():
+    write_json(assets / "missings.json",
+               {"energia_1c181390-5045-475e-94dc-410429be4b17": "Precios en Surtidor - Resolución 314/2016"})
+
+
+class SqlTestParser(pars.Parser):
+    """Los mismos estados y faltantes que TestParser, guardados como corridas en la base para que el diff se
+    resuelva con las consultas de sql_state"""
+    def __init__(self, engine, subscribed):
+        self._init_runtime_state(state_store=sql_state.SqlStateStore(engine))
+        if subscribed:
+            with engine.begin() as conn:
+                conn.execute(insert(mod.SuscripcionDataset.__table__),
+                             [{"user_id": 1, "dataset": dataset_id} for dataset_id in subscribed])
+        self.persistance_directory = assets
+        restitute_missing()
+        self.previous_state = read_json(assets / previous_state_path)
+        self.current_state = read_json(assets / current_state_path)
+        self.previous_run = self.state_store.save_run(self.previous_state)
+        self.current_run = self.state_store.save_run(self.current_state)
+        self.colnames_ds_events = ["dataset_id", "dataset_title", "temas_alias", "nodo_alias", "maintainer", "url",
+                                   "event_type"]
+        self.colnames_dist_events = ["distribution_id", "distribution_name"] + self.colnames_ds_events
+        self.missing_dataset_ids = self._get_missing_ids()
+        self.missing_dataset_titles = self._get_missing_titles()
+        self.dataset_events = self._get_dataset_events()
+        self.distribution_events = self._get_distribution_events()
+        self.datapoint_events = self._get_datapoint_events()
+        restitute_missing()
+
+
+def event_keys(df, key):
+    return sorted(zip(df[key], df["temas_alias"].astype(str)))
+
+
+def test_sql_diff_matches_in_memory_diff():
+    """Las consultas por conjuntos deben detectar los mismos eventos que la comparación en memoria"""
+    in_memory = TestParser()
+    in_memory.restitute_missing()
+    subscribed = in_memory.datapoint_events["dataset_id"].tolist()
+    sql = SqlTestParser(create_engine("sqlite://"), subscribed)
+
+    assert event_keys(sql.dataset_events, "dataset_id") == event_keys(in_memory.dataset_events, "dataset_id")
+    assert (event_keys(sql.distribution_events, "distribution_id") ==
+            event_keys(in_memory.distribution_events, "distribution_id"))
+    assert (sql.datapoint_events["distribution_id"].tolist() ==
+            in_memory.datapoint_events["distribution_id"].tolist())
+    assert list(sql.datapoint_events.columns) == list(in_memory.datapoint_events.columns)
+
+
+def test_datapoints_require_subscription():
+    sql = SqlTestParser(create_engine("sqlite://"), [])
+    assert sql.datapoint_events is None
+
+
+def test_load_state_round_trip():
+    store = sql_state.SqlStateStore(create_engine("sqlite://"))
+    original = st.validate(read_json(assets / current_state_path))
+    run_id = store.save_run(original)
+    assert store.last_run() is None
+    store.complete_run(run_id)
+    assert store.last_run() == run_id
+    loaded = store.load_state(run_id)
+    assert loaded["data"] == original["data"]
+    assert store.load_state(run_id + 1) is None
+
+
+def test_prune_keeps_last_runs():
+    store = sql_state.SqlStateStore(create_engine("sqlite://"), keep_runs=2)
+    state = st.validate(read_json(assets / current_state_path))
+    runs = []
+    for _ in range(3):
+        runs.append(store.save_run(state))
+        store.complete_run(runs[-1])
+    assert store.load_state(runs[0]) is None
+    assert store.load_state(runs[1])["data"] == state["data"]
+    assert store.prune(1) == 1 and store.last_run() == runs[2]
+
+
+def test_incomplete_runs_are_not_previous():
+    """Una corrida que no llegó al dump no es la anterior de la próxima ni cuenta para la retención"""
+    store = sql_state.SqlStateStore(create_engine("sqlite://"), keep_runs=2)
+    state = st.validate(read_json(assets / current_state_path))
+    complete = store.save_run(state)
+    store.complete_run(complete)
+    failed = [store.save_run(state) for _ in range(3)]
+    assert store.last_run() == complete
+    assert store.load_state(complete)["data"] == state["data"]
+    store.complete_run(failed[-1])
+    assert store.last_run() == failed[-1]
+
+
+def test_copy_csv_escapes_text():
+    rows = [(1, 'Dataset "A", con coma', "línea\nnueva", None, "", 2.5, True)]
+    encoded = sql_state.copy_csv(rows).read()
+    assert encoded == '1,"Dataset ""A"", con coma","línea\nnueva",,"",2.5,true\n'
+    # el lector csv recupera los mismos campos (COPY además distingue NULL del texto vacío por las comillas)
+    assert next(csv.reader(io.StringIO(encoded))) == ["1", 'Dataset "A", con coma', "línea\nnueva", "", "", "2.5",
+                                                      "true"]
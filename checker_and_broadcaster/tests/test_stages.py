@@ -0,0 +1,153 @@
+import shutil
+from pathlib import Path
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import checker_and_broadcaster.parser as pars
+from checker_and_broadcaster import sql_state
+from checker_and_broadcaster import state as st
+from checker_and_broadcaster import stages
+from checker_and_broadcaster.utils import read_json
+
+assets = Path(__file__).resolve().parent / "test_assets"
+
+
+@pytest.fixture
+def persistance(tmp_path):
+    shutil.copy(assets / "test_last_ckan_state.json", tmp_path / "last_ckan_state.json")
+    shutil.copy(assets / "missings.json", tmp_path / "missings.json")
+    return tmp_path
+
+
+def make_parser(persistance, **kwargs):
+    engine = create_engine("sqlite://")
+    return pars.Parser(engine, sessionmaker(bind=engine), persistance_directory=str(persistance), **kwargs)
+
+
+def test_diff_replays_from_cached_harvest(persistance, monkeypatch):
+    """Una corrida completa deja cacheadas las salidas de cada etapa y el diff se puede re-ejecutar
+    sin volver a cosechar"""
+    monkeypatch.setattr(pars.Parser, "_get_current_state",
+                        lambda self: read_json(assets / "test_current_ckan_state.json"))
+    first = make_parser(persistance, run_id="run-1")
+    assert all(first.stage_cache.has(stage) for stage in ("harvest", "count", "diff"))
+    assert not first.stage_cache.has("dump")
+    assert len(first.dataset_events) == 1
+    assert len(first.distribution_events) == 1
+    summary = read_json(Path(first.stage_cache.run_directory) / "metrics.json")
+    assert {"harvest", "count", "diff", "diff_dataset_events"} <= set(summary["stages"])
+    assert summary["events"]["nuevo_dataset"] == 1
+    assert (persistance / "metrics.prom").exists()
+    # el estado previo queda referenciado en el historial, no copiado en el cache de harvest
+    harvest = read_json(Path(first.stage_cache.path("harvest")))
+    assert "previous_state" not in harvest and harvest["previous_history_run"] == 1
+
+    def no_harvest(self):
+        raise AssertionError("el replay no debe cosechar")
+
+    monkeypatch.setattr(pars.Parser, "_get_current_state", no_harvest)
+    live = {name: (persistance / name).read_bytes() for name in ("missings.json", "metrics.prom")}
+    # el diff ya corrió: es un replay, parte de los faltantes del cache y no toca los archivos vigentes
+    replay = make_parser(persistance, run_id="run-1", start="diff")
+    assert replay.replay
+    assert replay.dataset_events["dataset_id"].tolist() == first.dataset_events["dataset_id"].tolist()
+    assert replay.distribution_events["distribution_id"].tolist() == \
+        first.distribution_events["distribution_id"].tolist()
+    assert {name: (persistance / name).read_bytes() for name in live} == live
+    run_directory = Path(replay.stage_cache.run_directory)
+    assert (run_directory / "missings.json").exists() and (run_directory / "metrics.prom").exists()
+
+    # el count también es un replay: el cache de distribuciones vive en la carpeta de la corrida
+    live_cache = persistance / "distribution_cache.json"
+    cached = live_cache.read_bytes() if live_cache.exists() else None
+    recounted = make_parser(persistance, run_id="run-1", start="count", end="count")
+    assert recounted.replay and recounted.current_run == first.current_run
+    assert (live_cache.read_bytes() if live_cache.exists() else None) == cached
+
+    # el dump todavía no corrió: retomar la corrida escribe en los archivos vigentes
+    dumped = make_parser(persistance, run_id="run-1", start="dump", end="dump")
+    assert not dumped.replay
+    assert dumped.dataset_events["dataset_id"].tolist() == first.dataset_events["dataset_id"].tolist()
+    assert (persistance / "datasets.yaml").exists()
+    assert read_json(persistance / "last_ckan_state.json")["total_datasets"] == \
+        first.current_state["total_datasets"]
+    assert dumped._state_history().last_run() == 2
+
+    live = {name: (persistance / name).read_bytes()
+            for name in ("missings.json", "last_ckan_state.json", "datasets.yaml", "state_history.jsonl")}
+    redumped = make_parser(persistance, run_id="run-1", start="dump", end="dump")
+    assert redumped.replay and (run_directory / "datasets.yaml").exists()
+    assert read_json(run_directory / "last_ckan_state.json")["total_datasets"] == \
+        first.current_state["total_datasets"]
+    # después del dump el estado previo de la corrida sale del historial y el diff da lo mismo
+    rediffed = make_parser(persistance, run_id="run-1", start="diff")
+    assert rediffed.dataset_events["dataset_id"].tolist() == first.dataset_events["dataset_id"].tolist()
+    assert {name: (persistance / name).read_bytes() for name in live} == live
+
+
+def test_missing_stage_output(persistance):
+    with pytest.raises(stages.StageError):
+        make_parser(persistance, run_id="sin-cache", start="count")
+    with pytest.raises(stages.StageError):
+        stages.stage_range("diff", "harvest")
+
+
+def test_prune_keeps_last_runs(tmp_path):
+    for run_id in ("20250101T000000Z", "20250102T000000Z", "20250103T000000Z", "20250104T000000Z"):
+        (tmp_path / run_id).mkdir()
+    assert stages.StageCache.prune(str(tmp_path), 0) == []
+    removed = stages.StageCache.prune(str(tmp_path), 2, current="20250101T000000Z")
+    assert removed == ["20250102T000000Z"]
+    assert stages.StageCache.runs(str(tmp_path)) == ["20250101T000000Z", "20250103T000000Z", "20250104T000000Z"]
+
+
+def test_successful_run_prunes_old_runs(persistance, monkeypatch):
+    monkeypatch.setattr(pars.Parser, "_get_current_state",
+                        lambda self: read_json(assets / "test_current_ckan_state.json"))
+    for run_id in ("run-1", "run-2", "run-3"):
+        make_parser(persistance, run_id=run_id, keep_runs=2)
+    assert stages.StageCache.runs(str(persistance / "runs")) == ["run-2", "run-3"]
+
+
+def test_count_replay_keeps_sql_runs(persistance, monkeypatch, tmp_path):
+    """Re-ejecutar el count de una corrida no registra otra corrida en el catálogo SQL"""
+    monkeypatch.setattr(pars, "state_backend", "sql")
+    monkeypatch.setattr(pars.Parser, "_get_current_state",
+                        lambda self: read_json(assets / "test_current_ckan_state.json"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'state.db'}")
+    first = pars.Parser(engine, sessionmaker(bind=engine), persistance_directory=str(persistance), run_id="run-1")
+    # la primera corrida todavía no hizo el dump: no es una corrida completa
+    assert sql_state.SqlStateStore(engine).last_run() is None
+    recounted = pars.Parser(engine, sessionmaker(bind=engine), persistance_directory=str(persistance),
+                            run_id="run-1", start="count", end="count")
+    assert recounted.replay and recounted.current_run == first.current_run
+    assert sql_state.SqlStateStore(engine).last_run() is None
+    # la corrida recién pasa a ser la anterior de la próxima cuando termina el dump
+    pars.Parser(engine, sessionmaker(bind=engine), persistance_directory=str(persistance),
+                run_id="run-1", start="dump", end="dump")
+    assert sql_state.SqlStateStore(engine).last_run() == first.current_run
+
+
+def test_failed_stage_exports_metrics(persistance, monkeypatch):
+    """Una etapa que falla deja escrito run_success 0 aunque el parser no se termine de construir"""
+    def broken_harvest(self):
+        raise RuntimeError("CKAN no responde")
+
+    monkeypatch.setattr(pars.Parser, "_get_current_state", broken_harvest)
+    with pytest.raises(RuntimeError):
+        make_parser(persistance, run_id="run-1")
+    assert "datob_run_success 0" in (persistance / "metrics.prom").read_text()
+    assert read_json(persistance / "runs" / "run-1" / "metrics.json")["success"] is False
+
+
+def test_previous_state_errors(persistance, monkeypatch):
+    """Sin estado previo la corrida es la primera; un estado previo inválido corta la corrida"""
+    monkeypatch.setattr(pars.Parser, "_get_current_state",
+                        lambda self: read_json(assets / "test_current_ckan_state.json"))
+    (persistance / "last_ckan_state.json").unlink()
+    first = make_parser(persistance, run_id="run-1")
+    assert first.previous_state is None and first.dataset_events is None
+
+    (persistance / "last_ckan_state.json").write_text('{"total_datasets": "muchos"}')
+    with pytest.raises(st.StateError):
+        make_parser(persistance, run_id="run-2")
@@ -0,0 +1,40 @@
+import pytest
+from pathlib import Path
+from checker_and_broadcaster import state as st
+
+
+assets = Path(__file__).resolve().parent / "test_assets"
+
+
+def test_legacy_state_is_migrated():
+    """Los estados viejos traen NaN como tamaño: al decodificarlos quedan como None y el resto como float"""
+    state = st.load_state(assets / "test_current_ckan_state.json")
+    assert isinstance(state, dict)
+    sizes = [d["size"] for v in state["data"].values() for d in v["distributions"].values()]
+    assert state["total_distributions"] == len(sizes)
+    assert all(size is None or isinstance(size, float) for size in sizes)
+    assert all(size is None or size == size for size in sizes)
+
+
+def test_round_trip(tmp_path):
+    state = {"total_datasets": 0, "total_distributions": 0, "harvested_at": "2025-01-01T00:00:00+00:00",
+             "data": {"ds": {"org": {"maintainer": "m", "nodo_title": "Nodo", "nodo_alias": "nodo"},
+                             "temas": {"temas_alias": ["econ"], "temas_nombres": ["Economía"]},
+                             "title": "Título", "name": "titulo",
+                             "distributions": {"d1": {"url": "http://x/a.csv", "name": "a", "size": float("nan")},
+                                               "d2": {"url": "http://x/b.csv", "name": "b", "size": 12}}}}}
+    path = tmp_path / "state.json"
+    st.save_state(path, state)
+    loaded = st.load_state(path)
+    distributions = loaded["data"]["ds"]["distributions"]
+    assert distributions["d1"]["size"] is None
+    assert distributions["d2"]["size"] == 12.0
+    assert loaded["total_distributions"] == 2
+    assert loaded["harvested_at"] == "2025-01-01T00:00:00+00:00"
+
+
+def test_invalid_state_is_rejected():
+    with pytest.raises(st.StateError, match="data.ds.distributions.d1.size"):
+        st.validate({"data": {"ds": {"distributions": {"d1": {"url": "u", "size": "grande"}}}}})
+    with pytest.raises(st.StateError):
+        st.decode(b"{no es json")
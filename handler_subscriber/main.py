@@ -1,5 +1,6 @@
 import re
 import os
+import sys
 import yaml
 from telegram import Update,Bot
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler
@@ -9,6 +10,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from models import Base,SuscripcionTema,SuscripcionDataset,SuscripcionNodo
 import logging
+import profiling
 
 load_dotenv()
 bot_token = os.getenv("BOT_TOKEN")
@@ -387,6 +389,8 @@ if __name__ == '__main__':
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     Base.metadata.create_all(bind=engine)
     application = ApplicationBuilder().token(bot_token).build()
+    # DATOB_PROFILE=1 o --profile perfilan cada handler (ver profiling.py)
+    profiler = profiling.from_env("bot", force="--profile" in sys.argv[1:])
     start_handler = CommandHandler('start', start)
     tema_handler = CommandHandler('suscribir_tema',suscribir_tema)
     tema_disp_handler = CommandHandler('temas_disponibles',temas_disponibles)
@@ -398,6 +402,11 @@ if __name__ == '__main__':
     er_tema_handler = CommandHandler('eliminar_tema', eliminar_suscripcion_tema)
     er_dataset_handler = CommandHandler('eliminar_dataset', eliminar_suscripcion_dataset)
     er_all = CommandHandler('eliminar_todas', eliminar_todas)
+    if profiler:
+        for command_handler in (start_handler, tema_handler, tema_disp_handler, dataset_handler, nodo_handler,
+                                nodo_disp_handler, misuscri_handler, er_nodo_handler, er_tema_handler,
+                                er_dataset_handler, er_all):
+            command_handler.callback = profiler.wrap(command_handler.callback)
     application.add_handler(start_handler)
     application.add_handler(tema_disp_handler)
     application.add_handler(tema_handler)
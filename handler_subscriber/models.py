@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, BigInteger, DateTime, func, UniqueConstraint
+from sqlalchemy import Column, Integer, String, BigInteger, DateTime, Float, Boolean, Text, ForeignKey, Index, func, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -28,3 +28,40 @@ class SuscripcionNodo(Base):
     nodo = Column(String(255), nullable=False)
 
 
+class CatalogoCorrida(Base):
+    __tablename__ = "catalogo_corridas"
+    run_id = Column(Integer, primary_key=True)
+    fecha = Column(DateTime(timezone=True), server_default=func.now())
+    harvested_at = Column(String(64))
+    # se marca al terminar el dump: una corrida que falló a mitad de camino no es la anterior de la próxima
+    completa = Column(Boolean, nullable=False, default=False, server_default="0")
+
+class CatalogoDataset(Base):
+    __tablename__ = "catalogo_datasets"
+    run_id = Column(Integer, ForeignKey("catalogo_corridas.run_id", ondelete="CASCADE"), primary_key=True)
+    dataset_id = Column(String(255), primary_key=True)
+    title = Column(Text)
+    name = Column(String(255))
+    maintainer = Column(Text)
+    nodo_title = Column(Text)
+    nodo_alias = Column(String(255))
+
+class CatalogoDatasetTema(Base):
+    __tablename__ = "catalogo_dataset_temas"
+    __table_args__ = (Index("ix_catalogo_dataset_temas_run_dataset", "run_id", "dataset_id"),)
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    run_id = Column(Integer, ForeignKey("catalogo_corridas.run_id", ondelete="CASCADE"), nullable=False)
+    dataset_id = Column(String(255), nullable=False)
+    tema_alias = Column(String(50))
+    tema_nombre = Column(Text)
+
+class CatalogoDistribucion(Base):
+    __tablename__ = "catalogo_distribuciones"
+    __table_args__ = (Index("ix_catalogo_distribuciones_run_dataset", "run_id", "dataset_id"),)
+    run_id = Column(Integer, ForeignKey("catalogo_corridas.run_id", ondelete="CASCADE"), primary_key=True)
+    distribution_id = Column(String(255), primary_key=True)
+    dataset_id = Column(String(255), nullable=False)
+    name = Column(Text)
+    url = Column(Text)
+    size = Column(Float)
+    estimated = Column(Boolean, nullable=False, default=False)
@@ -0,0 +1,253 @@
+"""
+Modo de profiling para el checker y el bot. Se activa con DATOB_PROFILE=1 (o --profile) sin tocar código:
+un thread muestrea las pilas de los demás threads y la memoria residente del proceso cada
+DATOB_PROFILE_INTERVAL segundos, y cada etapa o handler registra su tiempo y su pico de memoria. Con
+DATOB_PROFILE_FRAMES=1 (o más) se suma tracemalloc, que da el pico de memoria de Python y las mayores
+asignaciones por etapa pero hace mucho más lento el código que asigna objetos. Las salidas quedan en
+assets/profiles:
+
+    <nombre>-<fecha>.folded        pilas colapsadas (flamegraph.pl, speedscope, inferno)
+    <nombre>-<fecha>.memory.json   por etapa: llamadas, segundos, cpu y picos de memoria
+"""
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = "DATOB_PROFILE"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets", "profiles")
+# hojas de pila de threads que esperan trabajo: no aportan al perfil y se descartan
+IDLE_FRAMES = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"),
+               ("selectors.py", "select"), ("thread.py", "_worker")}
+
+
+def enabled(force: bool = False) -> bool:
+    return force or os.getenv(PROFILE_ENV, "").lower() in ("1", "true", "si")
+
+
+def from_env(name: str, force: bool = False, directory: Optional[str] = None) -> Optional["Profiler"]:
+    """
+    Descripcion: Crea y arranca un Profiler si el modo está activado por DATOB_PROFILE o por force. El intervalo
+    de muestreo, la profundidad de tracemalloc (0 lo deja apagado) y la cantidad de asignaciones reportadas por
+    etapa se configuran con DATOB_PROFILE_INTERVAL, DATOB_PROFILE_FRAMES y DATOB_PROFILE_TOP
+    Returns: devuelve el Profiler corriendo o None si el modo está apagado
+    """
+    if not enabled(force):
+        return None
+    profiler = Profiler(name, directory=os.getenv("DATOB_PROFILE_DIR", directory or DEFAULT_DIRECTORY),
+                        interval=float(os.getenv("DATOB_PROFILE_INTERVAL", "0.01")),
+                        frames=int(os.getenv("DATOB_PROFILE_FRAMES", "0")),
+                        top=int(os.getenv("DATOB_PROFILE_TOP", "10")))
+    profiler.start()
+    atexit.register(profiler.stop)
+    logger.info(f"Profiling activado: las salidas quedan en {profiler.directory}")
+    return profiler
+
+
+class Profiler:
+    """
+    Profiler por muestreo. El thread de muestreo sólo lee sys._current_frames y /proc/self/statm, así que el
+    costo es fijo por muestra y no depende de cuántas funciones se llamen. Cada muestra se etiqueta con las
+    etapas abiertas en ese momento, que quedan como raíz de la pila en el flame graph. Con frames > 0 se
+    activa tracemalloc; frames=1 guarda sólo la línea de cada asignación, que alcanza para el pico por etapa
+    y las mayores asignaciones
+    """
+    def __init__(self, name: str, directory: str = DEFAULT_DIRECTORY, interval: float = 0.01, frames: int = 0,
+                 top: int = 10):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.started_at = datetime.now(timezone.utc)
+        self.samples = Counter()
+        self.stages = {}
+        self._open = []
+        self._label = ("sin_etapa",)
+        self._names = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._owns_tracemalloc = False
+
+    @property
+    def path_prefix(self) -> str:
+        return os.path.join(self.directory, f"{self.name}-{self.started_at.strftime('%Y%m%dT%H%M%S')}")
+
+    def start(self) -> "Profiler":
+        if self.frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._owns_tracemalloc = True
+        self._thread = threading.Thread(target=self._sample_loop, name="datob-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Detiene el muestreo y escribe las salidas. Se puede llamar más de una vez"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+    def _sample_loop(self) -> None:
+        own = threading.get_ident()
+        idle = set()
+        while not self._stop.wait(self.interval):
+            label = self._label
+            rss = _rss()
+            for stage in list(self._open):
+                stage["rss"] = max(stage["rss"], rss)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or frame.f_code in idle:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    idle.add(code)
+                    continue
+                # las pilas se guardan como tuplas de code objects y se formatean sólo al escribir
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                with self._lock:
+                    self.samples[(label, tuple(stack))] += 1
+
+    def _frame_name(self, code) -> str:
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return name
+
+    def folded(self) -> str:
+        """Returns: las muestras en formato de pilas colapsadas, una línea por pila con su cantidad"""
+        with self._lock:
+            samples = list(self.samples.items())
+        lines = Counter()
+        for (label, stack), count in samples:
+            lines[";".join(label + tuple(self._frame_name(code) for code in reversed(stack)))] += count
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(lines.items()))
+
+    def _mark_peak(self) -> None:
+        # el pico de tracemalloc es global: antes de reiniciarlo se acredita a todas las etapas abiertas
+        _, peak = tracemalloc.get_traced_memory()
+        for stage in self._open:
+            stage["peak"] = max(stage["peak"], peak)
+
+    @contextmanager
+    def stage(self, name: str, snapshot: bool = True):
+        """
+        Descripcion: Mide el bloque como una etapa: tiempo de reloj, tiempo de cpu del proceso, pico de memoria
+        residente y, con tracemalloc, pico de memoria de Python y (con snapshot) las top asignaciones vivas al
+        terminar. Las etapas se pueden anidar
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self._mark_peak()
+            tracemalloc.reset_peak()
+        current = {"name": name, "peak": 0, "rss": _rss(), "wall": time.perf_counter(), "cpu": time.process_time()}
+        self._open.append(current)
+        self._label = tuple(stage["name"] for stage in self._open)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - current["wall"]
+            cpu = time.process_time() - current["cpu"]
+            if tracing:
+                self._mark_peak()
+            rss = _rss()
+            for stage in self._open:
+                stage["rss"] = max(stage["rss"], rss)
+            self._open.remove(current)
+            self._label = tuple(stage["name"] for stage in self._open) or ("sin_etapa",)
+            top = self._top_allocations() if snapshot and tracing and self.top else None
+            with self._lock:
+                stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0,
+                                                      "peak_rss_bytes": 0})
+                stats["calls"] += 1
+                stats["seconds"] += wall
+                stats["cpu_seconds"] += cpu
+                stats["peak_rss_bytes"] = max(stats["peak_rss_bytes"], current["rss"])
+                if tracing:
+                    stats["peak_bytes"] = max(stats.get("peak_bytes", 0), current["peak"])
+                if top is not None:
+                    stats["top_allocations"] = top
+
+    def _top_allocations(self):
+        statistics = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+        return [{"line": str(stat.traceback[0]), "bytes": stat.size, "blocks": stat.count}
+                for stat in statistics[:self.top]]
+
+    def wrap(self, handler):
+        """
+        Descripcion: Envuelve un handler asincrónico del bot para medirlo como una etapa con su nombre. Sin
+        snapshot de asignaciones (sería caro en cada mensaje); las salidas se reescriben como mucho una vez
+        por minuto mientras el bot corre
+        Returns: devuelve el handler envuelto
+        """
+        last_write = [time.monotonic()]
+
+        @functools.wraps(handler)
+        async def wrapped(*args, **kwargs):
+            try:
+                with self.stage(handler.__name__, snapshot=False):
+                    return await handler(*args, **kwargs)
+            finally:
+                if time.monotonic() - last_write[0] > 60:
+                    last_write[0] = time.monotonic()
+                    self.write()
+        return wrapped
+
+    def report(self) -> Dict:
+        with self._lock:
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            samples = sum(self.samples.values())
+        return {"name": self.name, "started_at": self.started_at.isoformat(),
+                "written_at": datetime.now(timezone.utc).isoformat(), "interval": self.interval,
+                "samples": samples, "stages": stages}
+
+    def write(self) -> None:
+        """Escribe el perfil colapsado y el reporte de memoria, reemplazando los de una escritura anterior"""
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(f"{self.path_prefix}.folded", self.folded())
+        _write_atomic(f"{self.path_prefix}.memory.json", json.dumps(self.report(), indent=4))
+
+
+def _rss() -> int:
+    """Memoria residente actual del proceso en bytes; en sistemas sin /proc, el máximo histórico de getrusage"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss viene en KiB en Linux y en bytes en macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _write_atomic(path: str, content: str) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)